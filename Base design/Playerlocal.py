@@ -1,10 +1,21 @@
+import hashlib
+import json
+import math
 import os
 import shutil
 import tkinter as tk
 from tkinter import filedialog, ttk
-from PIL import Image, ImageTk
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from PIL import Image, ImageOps, ImageTk
 import pygame
 import random
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
 import numpy as np
 import soundfile as sf
@@ -17,34 +28,80 @@ PANEL_BG = "#222"
 BUTTON_BG = "#333"
 BUTTON_FG = "white"
 ALBUM_SIZE = 300  # px
+# library index written by BrickifyPWA/Brickify.py when it serves the same folder
+INDEX_DB = os.path.join(MUSIC_FOLDER, ".brickify", "index.db")
+AUDIO_EXTS = (".mp3", ".wav", ".ogg", ".flac")
+# cover thumbnails shared with Brickify.py's /art?size=
+THUMB_FOLDER = os.path.join(MUSIC_FOLDER, ".brickify", "thumbs")
+ALBUM_CACHE_SIZE = 32  # decoded album images kept around
+HISTORY_SIZE = 500  # songs remembered for ⏮
+QUEUE_MENU_ROWS = 50  # queued songs listed in the Queue menu, the rest are only counted
+# waveform envelopes, same .peaks files as Brickify.py's /api/peaks
+PEAKS_FOLDER = os.path.join(MUSIC_FOLDER, ".brickify", "peaks")
+PEAKS_RATE = 50  # windows per second
+PEAKS_MAGIC = b"BRKPEAKS"
+PEAKS_HEADER = 16
+CROSSFADE_SECONDS = 0.0  # overlap between tracks, 0 for a plain gapless switch
+# spectrum frames for the visualizer, computed once per track (see build_spectrum)
+SPECTRUM_FOLDER = os.path.join(MUSIC_FOLDER, ".brickify", "spectrum")
+SPECTRUM_MAGIC = b"BRKSPECT"
+SPECTRUM_HEADER = 20
+SPECTRUM_FPS = 30
+SPECTRUM_BANDS = 32
+SPECTRUM_FFT = 2048
+SPECTRUM_RANGE = (40.0, 16000.0)  # Hz covered by the bands, log spaced
+SPECTRUM_FLOOR_DB = 70.0  # this far below full scale is an empty bar
+SPECTRUM_BATCH = 256  # frames per rfft call
+# beat and onset times for the block game (see build_beats)
+BEATS_FOLDER = os.path.join(MUSIC_FOLDER, ".brickify", "beats")
+BEATS_MAGIC = b"BRKBEATS"
+BEATS_HEADER = 16
+ONSET_FPS = 100  # spectral flux frames per second
+TEMPO_RANGE = (60.0, 180.0)  # bpm
+BEATS_AHEAD = 5  # queued songs analysed ahead of time
+LOUDNESS_TARGET = -18.0  # LUFS every track is turned to, same as Brickify.py's gain
+# timing spans and ui loop lateness for the Stats tab (see PROFILING);
+# `--profile` also starts the sampler and writes the trace on exit
+PROFILE = "--profile" in sys.argv
+TRACE_FILE = os.path.join(MUSIC_FOLDER, ".brickify", "playerlocal-trace.json")
+TRACE_EVENTS = 20000  # newest trace events kept for the file
+STATS_WINDOW = 100    # newest timings per span the Stats tab summarises
+PROFILE_INTERVAL = 0.005  # seconds between samples of the tk thread
+
+# `python Playerlocal.py --bench-gap` measures the silence between tracks
+# instead of starting the player, see bench_gap()
+BENCH_GAP = "--bench-gap" in sys.argv
+if BENCH_GAP:  # no speakers or window needed, the mixer writes into a file
+    BENCH_AUDIO = os.path.join(tempfile.mkdtemp(prefix="playerlocal-gap-"), "mixer.raw")
+    os.environ.update(SDL_AUDIODRIVER="disk", SDL_DISKAUDIOFILE=BENCH_AUDIO, SDL_VIDEODRIVER="dummy")
 
 pygame.mixer.init()
+try:
+    pygame.display.init()  # pygame's event queue (for TRACK_END) lives in the video subsystem
+except pygame.error as e:
+    print("No pygame event queue, watching the mixer instead:", e)
 
 # ---------------------------- GLOBAL STATE --------------------------- #
 playlist_dict = {}
+playlist_menus = {}  # playlist name -> its submenu, filled the first time it opens
+playlist_songs = {}  # playlist name -> (names, paths) once its submenu was opened
 playlist_paths = []
 playlist_names = []
-queue = []
-queue_paths = []
 invisible_queue_paths = []
 invisible_queue_index = 0
 current_index = 0
-current_song_length = 0.0
-current_position = 0.0
-is_paused = False
 is_seeking = False
 seek_preview = 0.0
 shuffle_mode = False
-repeat_mode = "off"
 album_image = None
-song_start_time = 0.0
-seeked_time = 0.0
-history_paths = []
-history_index = -1
+album_cache = OrderedDict()  # (art path, mtime_ns) -> PhotoImage, oldest first
 
 # Visualizer & Game
-visualizer_samples = np.array([])
-visualizer_sample_rate = 44100
+visualizer_peaks = np.zeros((0, 3), np.int16)  # (min, max, rms) per window, filled in the background
+visualizer_peak_rate = PEAKS_RATE  # windows per second of visualizer_peaks
+visualizer_path = None  # track the peaks are (being) loaded for
+visualizer_spectrum = np.zeros((0, SPECTRUM_BANDS), np.uint8)  # one row of band levels per frame
+visualizer_spectrum_rate = SPECTRUM_FPS  # frames per second of visualizer_spectrum
 ripples = []
 
 game_blocks = []
@@ -54,8 +111,152 @@ lives = 5
 game_over = False
 difficulty = "Medium"
 block_speed_dict = {"Easy": 2, "Medium": 4, "Hard": 6}
-spawn_interval_dict = {"Easy": 1500, "Medium": 1000, "Hard": 700}
+spawn_interval_dict = {"Easy": 1500, "Medium": 1000, "Hard": 700}  # ms, until the beat map is in
 last_spawn_time = 0
+game_path = None  # track the beat map below belongs to
+game_beats = np.zeros(0, "float32")  # seconds, see build_beats
+game_onsets = np.zeros(0, "float32")
+beat_jobs = {}  # paths waiting for beat analysis, oldest first (see analyse_later)
+beat_running = None  # path the beat thread is analysing, None when there's no thread
+beat_lock = threading.Lock()
+library_index = None  # {rel folder: [song names]} or None when not usable
+
+# ---------------------------- PROFILING ------------------------------ #
+# span("name") times a block into trace_events (Chrome trace-event "X"
+# events, open the file in chrome://tracing or ui.perfetto.dev) and into a
+# rolling window per name for the Stats tab. the tk loops call loop_tick()
+# to record how late root.after() woke them. the sampler is a thread that
+# reads the tk thread's stack every PROFILE_INTERVAL; consecutive samples
+# with the same frames merge into one event per frame, which shows up as a
+# flame chart under its own thread in the trace. appends to a deque and a
+# dict of deques are atomic under the GIL, so worker threads time
+# themselves without a lock
+trace_events = deque(maxlen=TRACE_EVENTS)
+span_stats = {}  # name -> deque of recent durations in ms
+loop_due = {}    # loop name -> perf_counter when its root.after should fire
+sample_counts = Counter()  # "file:function" -> samples on top of the tk stack
+sampler_thread = None
+sampler_on = False
+sampler_tid = None  # kept after the sampler stops, to name its row in the trace
+TRACE_START = time.perf_counter()
+MAIN_THREAD = threading.main_thread().ident
+
+def trace_us(t):
+    return round((t - TRACE_START) * 1e6)
+
+def record(name, start, end, tid=None, **args):
+    ms = (end - start) * 1000
+    stats = span_stats.get(name)
+    if stats is None:
+        stats = span_stats.setdefault(name, deque(maxlen=STATS_WINDOW))
+    stats.append(ms)
+    trace_events.append({"name": name, "ph": "X", "ts": trace_us(start), "dur": round(ms * 1000),
+                         "pid": os.getpid(), "tid": tid or threading.get_ident(), "args": args})
+
+@contextmanager
+def span(name, **args):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter(), **args)
+
+def loop_tick(name):
+    # lateness of this run of a root.after loop, 0 for its first run
+    now = time.perf_counter()
+    due = loop_due.get(name)
+    if due is not None:
+        late = max(0.0, now - due) * 1000
+        stats = span_stats.get(name + " late")
+        if stats is None:
+            stats = span_stats.setdefault(name + " late", deque(maxlen=STATS_WINDOW))
+        stats.append(late)
+        trace_events.append({"name": name + " late", "ph": "C", "ts": trace_us(now), "pid": os.getpid(),
+                             "args": {"ms": round(late, 2)}})
+
+def loop_after(name, ms, fn):
+    loop_due[name] = time.perf_counter() + ms / 1000
+    root.after(ms, fn)
+
+def frame_name(frame):
+    return "%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+def run_sampler():
+    # open: [(frame name, code object, start time)] outermost first
+    global sampler_thread
+    open_frames = []
+    tid = threading.get_ident()
+    while sampler_on:
+        now = time.perf_counter()
+        frame = sys._current_frames().get(MAIN_THREAD)
+        stack = []
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+        keep = 0
+        while (keep < len(stack) and keep < len(open_frames)
+               and open_frames[keep][1] is stack[keep].f_code):
+            keep += 1
+        for name, _, start in reversed(open_frames[keep:]):
+            trace_events.append({"name": name, "ph": "X", "ts": trace_us(start),
+                                 "dur": trace_us(now) - trace_us(start), "pid": os.getpid(),
+                                 "tid": tid, "cat": "sample"})
+        open_frames = open_frames[:keep] + [(frame_name(f), f.f_code, now) for f in stack[keep:]]
+        if stack:
+            sample_counts[frame_name(stack[-1])] += 1
+        del stack, frame
+        time.sleep(PROFILE_INTERVAL)
+    now = time.perf_counter()
+    for name, _, start in reversed(open_frames):
+        trace_events.append({"name": name, "ph": "X", "ts": trace_us(start),
+                             "dur": trace_us(now) - trace_us(start), "pid": os.getpid(),
+                             "tid": tid, "cat": "sample"})
+    sampler_thread = None
+
+def set_sampler(on):
+    global sampler_on, sampler_thread, sampler_tid
+    sampler_on = on
+    if on and sampler_thread is None:
+        sample_counts.clear()
+        sampler_thread = threading.Thread(target=run_sampler, daemon=True)
+        sampler_thread.start()
+        sampler_tid = sampler_thread.ident
+    elif not on and sampler_thread is not None:
+        sampler_thread.join()  # so its last frames are in trace_events
+
+def save_trace(path=TRACE_FILE):
+    events = list(trace_events)
+    names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": MAIN_THREAD,
+              "args": {"name": "tk"}}]
+    if sampler_tid is not None:
+        names.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": sampler_tid,
+                      "args": {"name": "samples of tk"}})
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, f)
+    except OSError as e:
+        print("Trace error:", e)
+        return None
+    return path
+
+def stats_lines():
+    # one line per span: runs in the window, last, median, 95th percentile, max
+    lines = ["%-28s %5s %9s %9s %9s %9s" % ("ms", "n", "last", "p50", "p95", "max")]
+    for name in sorted(span_stats):
+        values = list(span_stats[name])
+        if not values:
+            continue
+        ordered = sorted(values)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+        lines.append("%-28s %5d %9.1f %9.1f %9.1f %9.1f" % (
+            name[:28], len(values), values[-1], pick(0.5), pick(0.95), ordered[-1]))
+    if sample_counts:
+        total = sum(sample_counts.values())
+        lines += ["", "tk thread samples (%d)" % total]
+        lines += ["%5.1f%%  %s" % (100 * n / total, name) for name, n in sample_counts.most_common(15)]
+    return lines
 # ---------------------------- HELPERS -------------------------------- #
 def format_time(seconds):
     try:
@@ -76,14 +277,49 @@ def ensure_music_folder():
     if not os.path.exists(MUSIC_FOLDER):
         os.makedirs(MUSIC_FOLDER)
 
+def index_path(rel):
+    return os.path.join(MUSIC_FOLDER, *rel.split("/")) if rel else MUSIC_FOLDER
+
+def read_library_index():
+    # only trusted when every indexed folder still has the mtime the server
+    # saw, otherwise something changed behind its back and we walk instead
+    if not os.path.exists(INDEX_DB):
+        return None
+    try:
+        db = sqlite3.connect(INDEX_DB)
+        try:
+            dirs = db.execute("SELECT path, mtime_ns FROM dirs").fetchall()
+            rows = db.execute("SELECT dir, name FROM tracks ORDER BY dir, name").fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+    if not dirs:
+        return None
+    for rel, mtime_ns in dirs:
+        try:
+            if os.stat(index_path(rel)).st_mtime_ns != mtime_ns:
+                return None
+        except OSError:
+            return None
+    tracks = {}
+    for rel, name in rows:
+        tracks.setdefault(rel, []).append(name)
+    return tracks
+
 def scan_playlists():
+    global library_index
     ensure_music_folder()
+    library_index = read_library_index()
+    if library_index is not None:
+        return {rel.replace("/", os.sep): index_path(rel) for rel in library_index}
     result = {}
     for root, dirs, files in os.walk(MUSIC_FOLDER):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
         rel = os.path.relpath(root, MUSIC_FOLDER)
         if rel == ".":
             continue
-        audio_files = [f for f in files if f.lower().endswith((".mp3", ".wav", ".ogg", ".flac"))]
+        audio_files = [f for f in files if f.lower().endswith(AUDIO_EXTS)]
         if audio_files:
             result[rel] = root
     return result
@@ -91,24 +327,386 @@ def scan_playlists():
 def load_playlist(path):
     names = []
     paths = []
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    if library_index is not None and rel in library_index:
+        for d in sorted(library_index):
+            if d == rel or d.startswith(rel + "/"):
+                for f in library_index[d]:
+                    names.append(f)
+                    paths.append(os.path.join(index_path(d), f))
+        return names, paths
     for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
         for f in sorted(files):
-            if f.lower().endswith((".mp3", ".wav", ".ogg", ".flac")):
+            if f.lower().endswith(AUDIO_EXTS):
                 names.append(f)
                 paths.append(os.path.join(root, f))
     return names, paths
 
+def track_length(path):
+    # duration Brickify.py already read from the tags, else from the file
+    # header; never decodes the audio
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    if os.path.exists(INDEX_DB) and not rel.startswith(".."):
+        try:
+            st = os.stat(path)
+            db = sqlite3.connect(INDEX_DB)
+            try:
+                row = db.execute("SELECT duration FROM tags WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                 (rel, st.st_size, st.st_mtime_ns)).fetchone()
+            finally:
+                db.close()
+            if row and row[0]:
+                return float(row[0])
+        except (OSError, sqlite3.Error):
+            pass
+    try:
+        return float(sf.info(path).duration)
+    except Exception:
+        return 0.0
+
+def track_gain(path):
+    # volume factor that brings the track to LOUDNESS_TARGET without
+    # clipping, from the loudness Brickify.py measured (per file sha1); 1.0
+    # for anything it hasn't got to
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    row = None
+    if os.path.exists(INDEX_DB) and not rel.startswith(".."):
+        try:
+            st = os.stat(path)
+            db = sqlite3.connect(INDEX_DB)
+            try:
+                row = db.execute("""SELECT l.lufs, l.peak FROM hashes h JOIN loudness l ON l.sha1 = h.sha1
+                                     WHERE h.path = ? AND h.size = ? AND h.mtime_ns = ?""",
+                                 (rel, st.st_size, st.st_mtime_ns)).fetchone()
+            finally:
+                db.close()
+        except (OSError, sqlite3.Error):
+            pass
+    if not row or row[0] is None:
+        return 1.0
+    gain = LOUDNESS_TARGET - row[0]
+    if row[1]:
+        gain = min(gain, -20 * math.log10(row[1]))
+    return 10 ** (gain / 20)
+
+def peaks_path(path):
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    name = "%s-%x.peaks" % (hashlib.sha1(rel.encode()).hexdigest()[:16], os.stat(path).st_mtime_ns)
+    return os.path.join(PEAKS_FOLDER, name)
+
+def reduce_windows(mono, window):
+    w = mono[:len(mono) // window * window].reshape(-1, window)
+    rows = np.stack([w.min(axis=1), w.max(axis=1), np.sqrt((w * w).mean(axis=1))], axis=1)
+    return np.clip(rows * 32767, -32767, 32767).astype("<i2")
+
+def build_peaks(src, dest):
+    # one block at a time, so an hour of flac never sits in memory
+    info = sf.info(src)
+    window = max(1, info.samplerate // PEAKS_RATE)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = "%s.%d.tmp" % (dest, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(PEAKS_MAGIC + struct.pack("<II", info.samplerate, window))
+        rest = np.zeros(0, "float32")
+        for block in sf.blocks(src, blocksize=window * 1024, dtype="float32", always_2d=True):
+            mono = np.concatenate([rest, block.mean(axis=1)])
+            out.write(reduce_windows(mono, window).tobytes())
+            rest = mono[len(mono) // window * window:]
+        if len(rest):
+            out.write(reduce_windows(rest, len(rest)).tobytes())
+    os.replace(tmp, dest)
+
+def load_peaks(path):
+    # background thread: build the .peaks file if Brickify.py hasn't, then map it
+    global visualizer_peaks, visualizer_peak_rate
+    with span("load_peaks"):
+        try:
+            dest = peaks_path(path)
+            if not os.path.exists(dest):
+                build_peaks(path, dest)
+            with open(dest, "rb") as f:
+                header = f.read(PEAKS_HEADER)
+            if header[:8] != PEAKS_MAGIC:
+                raise ValueError("not a peaks file: " + dest)
+            samplerate, window = struct.unpack("<II", header[8:])
+            rows = np.zeros((0, 3), np.int16)
+            if os.path.getsize(dest) > PEAKS_HEADER:
+                rows = np.memmap(dest, "<i2", "r", offset=PEAKS_HEADER).reshape(-1, 3)
+        except Exception as e:
+            print("Visualizer load error:", e)
+            return
+    if visualizer_path == path:  # still the current song
+        visualizer_peak_rate = samplerate / window
+        visualizer_peaks = rows
+
+def spectrum_path(path):
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    name = "%s-%x.spectrum" % (hashlib.sha1(rel.encode()).hexdigest()[:16], os.stat(path).st_mtime_ns)
+    return os.path.join(SPECTRUM_FOLDER, name)
+
+def spectrum_bands(samplerate):
+    # first rfft bin of each band (plus the end), log spaced but at least a bin wide
+    lo, hi = SPECTRUM_RANGE
+    hi = min(hi, samplerate / 2)
+    edges = np.geomspace(lo, hi, SPECTRUM_BANDS + 1) * SPECTRUM_FFT / samplerate
+    edges = np.maximum(edges.astype(int), 1)
+    for i in range(1, len(edges)):
+        edges[i] = max(edges[i], edges[i - 1] + 1)
+    return edges
+
+def spectrum_frames(mono, hop, window, edges):
+    # one uint8 row per hop: band energy in dB over SPECTRUM_FLOOR_DB..0 dBFS
+    frames = np.lib.stride_tricks.sliding_window_view(mono, SPECTRUM_FFT)[::hop]
+    spec = np.fft.rfft(frames * window, axis=1)
+    power = spec.real ** 2 + spec.imag ** 2
+    bands = np.add.reduceat(power[:, :edges[-1]], edges[:-1], axis=1)
+    # a full-scale sine through the hann window peaks at (fft/4)^2
+    db = 10 * np.log10(bands / (SPECTRUM_FFT / 4) ** 2 + 1e-12)
+    return np.clip((db + SPECTRUM_FLOOR_DB) * 255 / SPECTRUM_FLOOR_DB, 0, 255).astype(np.uint8)
+
+def spectrum_rows(src, samplerate, hop):
+    # short-time spectrum of src, decoded and transformed SPECTRUM_BATCH
+    # frames at a time and yielded as uint8 rows; frame i is centred on
+    # sample i * hop
+    window = np.hanning(SPECTRUM_FFT).astype("float32")
+    edges = spectrum_bands(samplerate)
+    pad = np.zeros(SPECTRUM_FFT // 2, "float32")
+    rest = pad
+    for block in sf.blocks(src, blocksize=hop * SPECTRUM_BATCH, dtype="float32", always_2d=True):
+        mono = np.concatenate([rest, block.mean(axis=1)])
+        n = (len(mono) - SPECTRUM_FFT) // hop + 1
+        if n > 0:
+            yield spectrum_frames(mono[:(n - 1) * hop + SPECTRUM_FFT], hop, window, edges)
+            rest = mono[n * hop:]
+        else:
+            rest = mono
+    tail = np.concatenate([rest, pad])
+    if len(tail) >= SPECTRUM_FFT:
+        yield spectrum_frames(tail, hop, window, edges)
+
+def build_spectrum(src, dest=None):
+    # SPECTRUM_FPS rows written to dest, or returned as (rate, rows) when
+    # there's nowhere to keep them
+    info = sf.info(src)
+    hop = max(1, round(info.samplerate / SPECTRUM_FPS))
+    if not dest:
+        rows = list(spectrum_rows(src, info.samplerate, hop))
+        return info.samplerate / hop, np.concatenate(rows) if rows else np.zeros((0, SPECTRUM_BANDS), np.uint8)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = "%s.%d.tmp" % (dest, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(SPECTRUM_MAGIC + struct.pack("<III", info.samplerate, hop, SPECTRUM_BANDS))
+        for part in spectrum_rows(src, info.samplerate, hop):
+            out.write(part.tobytes())
+    os.replace(tmp, dest)
+
+def read_spectrum(dest):
+    with open(dest, "rb") as f:
+        header = f.read(SPECTRUM_HEADER)
+    if header[:8] != SPECTRUM_MAGIC:
+        raise ValueError("not a spectrum file: " + dest)
+    samplerate, hop, bands = struct.unpack("<III", header[8:])
+    frames = np.zeros((0, bands), np.uint8)
+    if os.path.getsize(dest) > SPECTRUM_HEADER:
+        frames = np.memmap(dest, np.uint8, "r", offset=SPECTRUM_HEADER).reshape(-1, bands)
+    return samplerate / hop, frames
+
+def load_spectrum(path):
+    # background thread: spectrum frames for the visualizer, kept next to the
+    # peaks when the track is in the library, else just held in memory
+    global visualizer_spectrum, visualizer_spectrum_rate
+    with span("load_spectrum"):
+        try:
+            if os.path.relpath(path, MUSIC_FOLDER).startswith(".."):
+                rate, frames = build_spectrum(path)
+            else:
+                dest = spectrum_path(path)
+                if not os.path.exists(dest):
+                    build_spectrum(path, dest)
+                rate, frames = read_spectrum(dest)
+        except Exception as e:
+            print("Spectrum load error:", e)
+            return
+    if visualizer_path == path:
+        visualizer_spectrum_rate = rate
+        visualizer_spectrum = frames
+
+def beats_path(path):
+    rel = os.path.relpath(path, MUSIC_FOLDER).replace(os.sep, "/")
+    name = "%s-%x.beats" % (hashlib.sha1(rel.encode()).hexdigest()[:16], os.stat(path).st_mtime_ns)
+    return os.path.join(BEATS_FOLDER, name)
+
+def onset_strength(src):
+    # spectral flux: how much each band got louder since the previous frame
+    # (the rows are already in dB), summed, less its local average
+    info = sf.info(src)
+    hop = max(1, round(info.samplerate / ONSET_FPS))
+    flux, last = [], None
+    for part in spectrum_rows(src, info.samplerate, hop):
+        rows = part.astype(np.int16)
+        prev = np.concatenate([rows[:1] if last is None else last[None], rows[:-1]])
+        flux.append(np.maximum(rows - prev, 0).sum(axis=1).astype("float32"))
+        last = rows[-1]
+    rate = info.samplerate / hop
+    flux = np.concatenate(flux) if flux else np.zeros(0, "float32")
+    w = max(1, int(rate / 2))
+    local = np.convolve(flux, np.full(w, 1.0 / w, "float32"), mode="same")
+    return rate, np.maximum(flux - local, 0)
+
+def find_onsets(odf, rate):
+    # frames that are the peak of their +-50 ms and clearly above the rest
+    w = max(1, int(rate * 0.05))
+    if len(odf) <= 2 * w:
+        return np.zeros(0, "float32")
+    peaks = np.lib.stride_tricks.sliding_window_view(np.pad(odf, w), 2 * w + 1).max(axis=1)
+    hits = np.flatnonzero((odf == peaks) & (odf > odf.mean() + 0.5 * odf.std()))
+    return (hits / rate).astype("float32")
+
+def find_beats(odf, rate):
+    # tempo from the autocorrelation of the onset curve (favouring ~120 bpm),
+    # phase from the best-scoring grid, then each beat nudged to the
+    # strongest onset near where the previous one predicts it
+    lo, hi = int(rate * 60 / TEMPO_RANGE[1]), int(rate * 60 / TEMPO_RANGE[0])
+    if len(odf) < 2 * hi or not odf.any():
+        return np.zeros(0, "float32")
+    spec = np.fft.rfft(odf - odf.mean(), 2 * len(odf))
+    ac = np.fft.irfft(spec.real ** 2 + spec.imag ** 2)[lo:hi + 1]
+    lags = np.arange(lo, hi + 1)
+    prior = np.exp(-0.5 * (np.log2(lags / (rate * 0.5)) / 0.9) ** 2)  # 0.5 s = 120 bpm
+    period = lags[np.argmax(ac * prior)]
+    phase = max(range(period), key=lambda p: odf[p::period].sum())
+    slack = max(1, period // 10)
+    beats, t = [], phase
+    while t < len(odf):
+        a, b = max(0, t - slack), min(len(odf), t + slack + 1)
+        t = a + int(np.argmax(odf[a:b])) if odf[a:b].any() else t
+        beats.append(t)
+        t += period
+    return (np.array(beats) / rate).astype("float32")
+
+def build_beats(src, dest=None):
+    # (beats, onsets) in seconds, also saved to dest: header with both
+    # counts, then the float32 beat times and the onset times
+    rate, odf = onset_strength(src)
+    beats, onsets = find_beats(odf, rate), find_onsets(odf, rate)
+    if dest:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = "%s.%d.tmp" % (dest, os.getpid())
+        with open(tmp, "wb") as out:
+            out.write(BEATS_MAGIC + struct.pack("<II", len(beats), len(onsets)))
+            out.write(beats.astype("<f4").tobytes())
+            out.write(onsets.astype("<f4").tobytes())
+        os.replace(tmp, dest)
+    return beats, onsets
+
+def read_beats(dest):
+    with open(dest, "rb") as f:
+        header = f.read(BEATS_HEADER)
+        if header[:8] != BEATS_MAGIC:
+            raise ValueError("not a beats file: " + dest)
+        nbeats, nonsets = struct.unpack("<II", header[8:])
+        times = np.frombuffer(f.read(4 * (nbeats + nonsets)), "<f4")
+    return times[:nbeats], times[nbeats:]
+
+def track_beats(path):
+    # the cached map, analysed now if there isn't one yet; tracks outside
+    # the library aren't cached
+    if os.path.relpath(path, MUSIC_FOLDER).startswith(".."):
+        return build_beats(path)
+    dest = beats_path(path)
+    if os.path.exists(dest):
+        return read_beats(dest)
+    return build_beats(path, dest)
+
+def analyse_later(path, first=False):
+    # one background thread works through the songs asked for in order,
+    # first=True (the song that just started) jumps the line
+    global beat_jobs, beat_running
+    with beat_lock:
+        if path == beat_running or (path in beat_jobs and not first):
+            return
+        beat_jobs.pop(path, None)
+        if first:
+            beat_jobs = {path: None, **beat_jobs}
+        else:
+            beat_jobs[path] = None
+        if beat_running is not None:
+            return
+        beat_running = path
+    threading.Thread(target=run_beat_jobs, daemon=True).start()
+
+def run_beat_jobs():
+    global game_beats, game_onsets, beat_running
+    while True:
+        with beat_lock:
+            if not beat_jobs:
+                beat_running = None
+                return
+            path = next(iter(beat_jobs))
+            del beat_jobs[path]
+            beat_running = path
+        try:
+            with span("track_beats"):
+                beats, onsets = track_beats(path)
+            if game_path == path:
+                game_beats, game_onsets = beats, onsets
+        except Exception as e:
+            print("Beat analysis error:", e)
+
+def album_thumbnail(art_path, mtime_ns):
+    # same naming as Brickify.py's make_thumbs() so either side can reuse
+    # what the other already resized
+    rel = os.path.relpath(art_path, MUSIC_FOLDER).replace(os.sep, "/")
+    name = "%s-%x-%d." % (hashlib.sha1(rel.encode()).hexdigest()[:16], mtime_ns, ALBUM_SIZE)
+    shared = not rel.startswith("..")
+    if shared:
+        for ext in ("webp", "jpg"):
+            p = os.path.join(THUMB_FOLDER, name + ext)
+            if os.path.exists(p):
+                return Image.open(p)
+    img = ImageOps.fit(ImageOps.exif_transpose(Image.open(art_path)).convert("RGB"),
+                       (ALBUM_SIZE, ALBUM_SIZE), Image.LANCZOS)
+    if shared:
+        # written aside and renamed in, like make_thumbs(), so the server
+        # never serves a half-written thumbnail (the prefetcher runs this
+        # on its own thread, hence the thread id)
+        dest = os.path.join(THUMB_FOLDER, name + "jpg")
+        tmp = "%s.%d.%d.tmp" % (dest, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(THUMB_FOLDER, exist_ok=True)
+            img.save(tmp, "JPEG", quality=82)
+            os.replace(tmp, dest)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return img
+
 def load_album_image(song_path):
     global album_image
     art_path = find_album_art_for(song_path)
+    key = None
     if art_path:
         try:
-            img = Image.open(art_path).resize((ALBUM_SIZE, ALBUM_SIZE))
+            key = (art_path, os.stat(art_path).st_mtime_ns)
+        except OSError:
+            art_path = None
+    album_image = album_cache.get(key)
+    if album_image is not None:
+        album_cache.move_to_end(key)
+    else:
+        try:
+            img = prefetched_art.pop(key, None) or (album_thumbnail(*key) if key else None)
         except Exception:
+            img = None
+        if img is None:
             img = Image.new("RGB", (ALBUM_SIZE, ALBUM_SIZE), color="#444")
-    else:
-        img = Image.new("RGB", (ALBUM_SIZE, ALBUM_SIZE), color="#444")
-    album_image = ImageTk.PhotoImage(img)
+        album_image = ImageTk.PhotoImage(img)
+        album_cache[key] = album_image
+        if len(album_cache) > ALBUM_CACHE_SIZE:
+            album_cache.popitem(last=False)
     album_label.config(image=album_image)
 
 def random_color():
@@ -117,94 +715,442 @@ def random_color():
     b = random.randint(100, 255)
     return f'#{r:02x}{g:02x}{b:02x}'
 
-# ---------------------------- PLAYER ACTIONS -------------------------- #
-def play_song(path, playlist=None, index=None, use_invisible=True):
-    global current_song_length, current_position, is_paused, song_start_time, seeked_time
-    global invisible_queue_paths, invisible_queue_index, current_index, playlist_paths
-    global history_paths, history_index, playlist_names
-    global visualizer_samples, visualizer_sample_rate
+# ---------------------------- PLAY QUEUE ----------------------------- #
+class PlayQueue:
+    # songs queued to play next. ids sit in a deque, entries in a dict, so
+    # add, pop and remove by id are all O(1): a removed id only leaves the
+    # dict and gets skipped once it reaches the front (or compacted away).
+    # listeners are called as fn(event, id, (name, path)), event "add" or "remove"
+    def __init__(self):
+        self.order = deque()
+        self.entries = {}
+        self.last_id = 0
+        self.listeners = []
 
-    if not path:
-        return
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for qid in self.order:
+            entry = self.entries.get(qid)
+            if entry is not None:
+                yield qid, entry
+
+    def notify(self, event, qid, entry):
+        for fn in self.listeners:
+            fn(event, qid, entry)
+
+    def add(self, name, path):
+        self.last_id += 1
+        self.order.append(self.last_id)
+        self.entries[self.last_id] = (name, path)
+        self.notify("add", self.last_id, (name, path))
+        return self.last_id
+
+    def extend(self, songs):
+        for name, path in songs:
+            self.add(name, path)
+
+    def trim(self):
+        while self.order and self.order[0] not in self.entries:
+            self.order.popleft()
+
+    def peek(self):
+        self.trim()
+        return self.entries[self.order[0]] if self.order else None
+
+    def pop(self):
+        self.trim()
+        if not self.order:
+            return None
+        qid = self.order.popleft()
+        entry = self.entries.pop(qid)
+        self.notify("remove", qid, entry)
+        return entry
+
+    def remove(self, qid):
+        entry = self.entries.pop(qid, None)
+        if entry is None:
+            return
+        if len(self.order) > 2 * len(self.entries) + 64:
+            self.order = deque(i for i in self.order if i in self.entries)
+        self.notify("remove", qid, entry)
+
+class PlayHistory:
+    # back/forward list of played paths, the oldest fall off past `size`
+    def __init__(self, size):
+        self.paths = deque(maxlen=size)
+        self.index = -1
+
+    def played(self, path):
+        if self.index >= 0 and self.paths[self.index] == path:
+            return
+        while len(self.paths) > self.index + 1:  # playing something new drops "forward"
+            self.paths.pop()
+        self.paths.append(path)
+        self.index = len(self.paths) - 1
+
+    def back(self):
+        if self.index <= 0:
+            return None
+        self.index -= 1
+        return self.paths[self.index]
+
+play_queue = PlayQueue()
+history = PlayHistory(HISTORY_SIZE)
+
+# ---------------------------- PLAYBACK ENGINE ------------------------ #
+# owns what pygame.mixer.music is doing: the track, where in it we are,
+# pause and repeat. position is the mixer's own get_pos() (ms played since
+# the last play(), pauses excluded) on top of where that play() started, and
+# the end of a track comes in as a TRACK_END event instead of being guessed.
+# the next track is handed over ahead of time (see PREFETCH) with
+# music.queue(), so SDL_mixer starts it the moment the current one runs dry;
+# with CROSSFADE_SECONDS its decoded head plays as a Sound on a channel while
+# the music fades out, then the music carries on from where the head got to.
+# the mixer volume is the slider times the playing track's loudness gain; a
+# gapless track starts at the previous one's until its TRACK_END is polled
+TRACK_END = pygame.USEREVENT + 1
+PROGRESS_MS = 250      # ui tick while playing
+PROGRESS_IDLE_MS = 1000  # ...and while paused or stopped
+HANDOFF_FADE_MS = 40   # the crossfade head fading out under the music taking over
+
+class PlaybackEngine:
+    def __init__(self):
+        self.path = None
+        self.length = 0.0
+        self.offset = 0.0  # seconds into the track the last play() started from
+        self.paused = False
+        self.ended = False
+        self.repeat = "off"  # off, playlist, song
+        self.on_end = None   # on_end(started): a track finished and isn't repeated,
+                             # started is True when the next one is already playing
+        self.next = None     # (path, length, head Sound or None) to switch to
+        self.queued = False  # self.next is sitting in the mixer's queue
+        self.fading = None   # (head channel, monotonic start) during a crossfade
+        self.volume = 1.0    # the slider
+        self.gain = 1.0      # the track's, see track_gain()
+        self.events = pygame.display.get_init()
+        pygame.mixer.music.set_endevent(TRACK_END)
+
+    def load(self, path, length):
+        with span("mixer.load"):
+            pygame.mixer.music.load(path)  # also empties the mixer's queue
+        with span("track_gain"):
+            self.gain = track_gain(path)
+        self.apply_volume()
+        with span("mixer.play"):
+            pygame.mixer.music.play()
+        self.stop_fade()
+        self.path = path
+        self.length = length
+        self.offset = 0.0
+        self.paused = False
+        self.ended = False
+        self.next = None
+        self.queued = False
+
+    def prepare(self, path, length, head=None):
+        # the track to continue with; head is a Sound of its first seconds
+        # when it should crossfade in
+        if self.next and self.next[0] == path and self.next[2] is head:
+            return
+        if self.fading:
+            return  # too late, this crossfade is already going
+        if self.queued and head is not None:
+            self.drop_queue()
+        self.next = (path, length, head)
+        if head is None and self.events:
+            pygame.mixer.music.queue(path)  # replaces whatever was queued
+            self.queued = True
+
+    def forget_next(self):
+        if self.queued:
+            self.drop_queue()
+        self.next = None
+
+    def drop_queue(self):
+        # pygame can't unqueue: reload and carry on from the same spot
+        pos = self.position()
+        pygame.mixer.music.load(self.path)
+        pygame.mixer.music.play(start=pos)
+        self.offset = pos
+        if self.paused:
+            pygame.mixer.music.pause()
+        self.queued = False
+
+    def set_volume(self, volume):
+        self.volume = volume
+        self.apply_volume()
+
+    def apply_volume(self):
+        pygame.mixer.music.set_volume(min(1.0, self.volume * self.gain))
+
+    def stop_fade(self):
+        if self.fading:
+            self.fading[0].stop()
+            self.fading = None
+
+    def position(self):
+        if self.path is None:
+            return 0.0
+        ms = pygame.mixer.music.get_pos()
+        pos = self.offset + max(ms, 0) / 1000.0
+        return min(pos, self.length) if self.length > 0 else pos
+
+    def seek(self, seconds):
+        if self.path is None:
+            return
+        if self.fading:  # seeking back out of a crossfade cancels it
+            self.stop_fade()
+            pygame.mixer.music.load(self.path)
+        pygame.mixer.music.play(start=seconds)  # keeps the queue
+        self.offset = seconds
+        self.ended = False
+        if self.paused:
+            pygame.mixer.music.pause()
+
+    def toggle_pause(self):
+        if self.paused:
+            pygame.mixer.music.unpause()
+            if self.fading:
+                self.fading[0].unpause()
+        else:
+            pygame.mixer.music.pause()
+            if self.fading:
+                self.fading[0].pause()
+        self.paused = not self.paused
+        return self.paused
 
-    current_position = 0.0
-    seeked_time = 0.0
-    song_start_time = time.time()
+    def next_repeat(self):
+        self.repeat = {"off": "playlist", "playlist": "song", "song": "off"}[self.repeat]
+        if self.repeat == "song":
+            self.forget_next()
+        return self.repeat
 
-    if playlist is not None and index is not None and use_invisible:
-        invisible_queue_paths = playlist
-        invisible_queue_index = index
-        playlist_paths = playlist
-        current_index = index
-        playlist_names, _ = load_playlist(os.path.dirname(playlist[index]))
+    def start_fade(self):
+        path, length, head = self.next
+        head.set_volume(min(1.0, self.volume * track_gain(path)))
+        channel = head.play(fade_ms=int(CROSSFADE_SECONDS * 1000))
+        if channel is None:  # no free channel, settle for gapless
+            self.next = None
+            self.prepare(path, length)
+            return
+        pygame.mixer.music.fadeout(int(CROSSFADE_SECONDS * 1000))
+        self.fading = (channel, time.monotonic())
+
+    def switch(self, offset):
+        # the mixer is already playing self.next
+        self.path, self.length = self.next[:2]
+        self.gain = track_gain(self.path)
+        self.apply_volume()
+        self.offset = offset
+        self.next = None
+        self.queued = False
+        if self.on_end:
+            self.on_end(True)
+
+    def poll(self):
+        if self.path is None or self.paused or self.ended:
+            return
+        if (self.next and self.next[2] is not None and not self.fading
+                and self.position() >= self.length - CROSSFADE_SECONDS):
+            self.start_fade()
+            return
+        if self.events:
+            if not any(e.type == TRACK_END for e in pygame.event.get()):
+                return
+            if pygame.mixer.music.get_busy():
+                if self.queued:  # SDL_mixer just started the queued track
+                    self.switch(0.0)
+                return
+        elif pygame.mixer.music.get_busy():
+            return
+        if self.fading:
+            channel, started = self.fading
+            at = time.monotonic() - started
+            pygame.mixer.music.load(self.next[0])
+            pygame.mixer.music.play(start=at)
+            channel.fadeout(HANDOFF_FADE_MS)
+            self.fading = None
+            self.switch(at)
+        elif self.repeat == "song":
+            pygame.mixer.music.play()
+            self.offset = 0.0
+        elif self.next:  # prepared but not queued (no event queue), start it now
+            pygame.mixer.music.load(self.next[0])
+            pygame.mixer.music.play()
+            self.switch(0.0)
+        else:
+            self.offset = self.length  # get_pos() is -1 now, stay at the end
+            self.ended = True
+            if self.on_end:
+                self.on_end(False)
+
+engine = PlaybackEngine()
+
+# ---------------------------- PREFETCH ------------------------------- #
+# PREFETCH_SECONDS before the end of a track the next entry (queue first,
+# then the playlist) is opened on a worker thread: its length, album art and
+# peaks get ready and the head of the audio is decoded, so the switch itself
+# waits on nothing. the engine gets it on the next ui tick
+PREFETCH_SECONDS = 15
+PREFETCH_HEAD = 2.0  # seconds decoded beyond any crossfade
+prefetch_for = None  # (current path, next path) the last prefetch was started for
+prefetched_track = None  # what the worker came back with
+prefetched_art = {}  # (art path, mtime_ns) -> PIL image for load_album_image()
+
+def peek_next_path():
+    # what play_next_song() would pick, without taking it
+    if engine.repeat == "song":
+        return None
+    if play_queue:
+        return play_queue.peek()[1]
+    if invisible_queue_paths:
+        i = invisible_queue_index + 1
+        if i < len(invisible_queue_paths):
+            return invisible_queue_paths[i]
+        if engine.repeat == "playlist":
+            return invisible_queue_paths[0]
+    return None
 
+def prefetch_track(path):
+    # worker thread: nothing in here touches tk or the mixer
+    global prefetched_track
+    analyse_later(path)
+    started = time.perf_counter()
+    track = {"path": path, "length": track_length(path), "head": None}
+    art_path = find_album_art_for(path)
+    if art_path:
+        try:
+            key = (art_path, os.stat(art_path).st_mtime_ns)
+            if key not in album_cache:
+                prefetched_art.clear()
+                prefetched_art[key] = album_thumbnail(*key)
+        except Exception as e:
+            print("Prefetch art error:", e)
     try:
-        pygame.mixer.music.load(path)
-        pygame.mixer.music.play(start=current_position)
+        dest = peaks_path(path)
+        inside = not os.path.relpath(path, MUSIC_FOLDER).startswith("..")
+        if inside and not os.path.exists(dest):
+            build_peaks(path, dest)
+        dest = spectrum_path(path)
+        if inside and not os.path.exists(dest):
+            build_spectrum(path, dest)
     except Exception as e:
-        print("Playback error:", e)
+        print("Prefetch peaks error:", e)
+    try:
+        with sf.SoundFile(path) as f:
+            track["samplerate"] = f.samplerate
+            track["head"] = f.read(int(f.samplerate * (CROSSFADE_SECONDS + PREFETCH_HEAD)),
+                                   dtype="int16", always_2d=True)
+    except Exception as e:
+        print("Prefetch decode error:", e)
+    record("prefetch_track", started, time.perf_counter(), path=os.path.basename(path))
+    prefetched_track = track
+
+def head_sound(track):
+    # the decoded head as a Sound in the mixer's format, or None to go gapless
+    freq, _, channels = pygame.mixer.get_init()
+    head = track["head"]
+    if CROSSFADE_SECONDS <= 0 or head is None or track.get("samplerate") != freq:
+        return None
+    if head.shape[1] < channels:
+        head = np.repeat(head[:, :1], channels, axis=1)
+    return pygame.sndarray.make_sound(np.ascontiguousarray(head[:, :channels]))
+
+def prefetch_tick():
+    global prefetch_for, prefetched_track
+    if engine.path is None or engine.ended:
+        return
+    nxt = peek_next_path()
+    if nxt is None:
+        if engine.next:
+            engine.forget_next()
+        return
+    key = (engine.path, nxt)
+    if key != prefetch_for:
+        if engine.length - engine.position() > PREFETCH_SECONDS:
+            return
+        prefetch_for = key
+        prefetched_track = None
+        threading.Thread(target=prefetch_track, args=(nxt,), daemon=True).start()
+        return
+    track = prefetched_track
+    if track and track["path"] == nxt and not (engine.next and engine.next[0] == nxt):
+        try:
+            engine.prepare(nxt, track["length"], head_sound(track))
+        except pygame.error as e:
+            print("Prefetch error:", e)
+
+# ---------------------------- PLAYER ACTIONS -------------------------- #
+def play_song(path, playlist=None, index=None, use_invisible=True, started=False):
+    # started: the engine already switched to path (gapless), don't reload it
+    global invisible_queue_paths, invisible_queue_index, current_index, playlist_paths
+    global playlist_names
+    global visualizer_peaks, visualizer_path, visualizer_spectrum
+    global game_path, game_beats, game_onsets, game_spawns
+
+    if not path:
         return
+    with span("play_song", path=os.path.basename(path), gapless=started):
+        if playlist is not None and index is not None and use_invisible:
+            invisible_queue_paths = playlist
+            invisible_queue_index = index
+            playlist_paths = playlist
+            current_index = index
+            with span("load_playlist"):
+                playlist_names, _ = load_playlist(os.path.dirname(playlist[index]))
 
-    if history_index == -1 or (history_paths and path != history_paths[history_index]):
-        history_paths = history_paths[:history_index+1]
-        history_paths.append(path)
-        history_index += 1
+        try:
+            if not (started and engine.path == path):
+                with span("track_length"):
+                    length = track_length(path)
+                engine.load(path, length)
+        except Exception as e:
+            print("Playback error:", e)
+            return
 
-    is_paused = False
+        history.played(path)
 
-    try:
-        snd = pygame.mixer.Sound(path)
-        current_song_length = float(snd.get_length())
-    except:
-        current_song_length = 0.0
+        play_button.config(text="⏸")
+        now_playing_label.config(text=f"Now Playing: {os.path.basename(path)}")
+        with span("load_album_image"):
+            load_album_image(path)
 
-    now_playing_label.config(text=f"Now Playing: {os.path.basename(path)}")
-    load_album_image(path)
+        # Preload visualizer
+        visualizer_path = path
+        visualizer_peaks = np.zeros((0, 3), np.int16)
+        visualizer_spectrum = np.zeros((0, SPECTRUM_BANDS), np.uint8)
+        threading.Thread(target=load_peaks, args=(path,), daemon=True).start()
+        threading.Thread(target=load_spectrum, args=(path,), daemon=True).start()
 
-    # Preload visualizer
-    try:
-        data, samplerate = sf.read(path, dtype='float32')
-        if len(data.shape) > 1:
-            data = data[:,0]
-        visualizer_samples = data
-        visualizer_sample_rate = samplerate
-    except Exception as e:
-        visualizer_samples = np.array([])
-        visualizer_sample_rate = 44100
-        print("Visualizer load error:", e)
+        game_path = path
+        game_beats = game_onsets = np.zeros(0, "float32")
+        game_spawns = None
+        analyse_later(path, first=True)
 
-def play_next_song():
+def play_next_song(started=False):
     global invisible_queue_index
-    if queue_paths:
-        path = queue_paths.pop(0)
-        queue.pop(0)
-        refresh_queue_dropdown()
-        play_song(path, use_invisible=False)
+    if play_queue:
+        _, path = play_queue.pop()
+        play_song(path, use_invisible=False, started=started)
     elif invisible_queue_paths:
         invisible_queue_index += 1
         if invisible_queue_index >= len(invisible_queue_paths):
-            if repeat_mode == "playlist":
+            if engine.repeat == "playlist":
                 invisible_queue_index = 0
             else:
                 return
-        play_song(invisible_queue_paths[invisible_queue_index], use_invisible=False)
+        play_song(invisible_queue_paths[invisible_queue_index], use_invisible=False, started=started)
 
 def play_prev_song():
-    global history_index
-    if history_index > 0:
-        history_index -= 1
-        play_song(history_paths[history_index], use_invisible=False)
+    path = history.back()
+    if path:
+        play_song(path, use_invisible=False)
 
 def toggle_pause():
-    global is_paused
-    if is_paused:
-        pygame.mixer.music.unpause()
-        is_paused = False
-        play_button.config(text="⏸")
-    else:
-        pygame.mixer.music.pause()
-        is_paused = True
-        play_button.config(text="▶")
+    play_button.config(text="▶" if engine.toggle_pause() else "⏸")
 
 def toggle_shuffle():
     global shuffle_mode
@@ -212,19 +1158,9 @@ def toggle_shuffle():
     shuffle_button.config(bg=SPOTIFY_GREEN if shuffle_mode else BUTTON_BG)
 
 def toggle_repeat():
-    global repeat_mode
-    if repeat_mode == "off":
-        repeat_mode = "playlist"
-        repeat_button.config(bg=SPOTIFY_GREEN, text="🔁")
-        repeat_label.config(text="")
-    elif repeat_mode == "playlist":
-        repeat_mode = "song"
-        repeat_button.config(bg=SPOTIFY_GREEN, text="🔁")
-        repeat_label.config(text="loop")
-    else:
-        repeat_mode = "off"
-        repeat_button.config(bg=BUTTON_BG, text="🔁")
-        repeat_label.config(text="")
+    repeat = engine.next_repeat()
+    repeat_button.config(bg=BUTTON_BG if repeat == "off" else SPOTIFY_GREEN, text="🔁")
+    repeat_label.config(text="loop" if repeat == "song" else "")
 
 # ---------------------------- SEEK & PROGRESS ------------------------ #
 def start_seek(event):
@@ -234,77 +1170,335 @@ def start_seek(event):
 
 def seek_to(event):
     global seek_preview
-    if current_song_length > 0:
+    if engine.length > 0:
         widget = event.widget
         x = event.x
         width = widget.winfo_width()
         percent = max(0.0, min(1.0, x/width))
-        seek_preview = percent * current_song_length
-        time_label.config(text=f"{format_time(seek_preview)} / {format_time(current_song_length)}")
-        progress_var.set(percent*100)
+        seek_preview = percent * engine.length
+        show_progress(seek_preview)
 
 def stop_seek(event):
-    global is_seeking, current_position, seeked_time, song_start_time
+    global is_seeking
+    if not is_seeking:
+        return
     is_seeking = False
-    current_position = seek_preview
-    seeked_time = current_position
-    song_start_time = time.time()
     try:
-        pygame.mixer.music.play(start=current_position)
-        if is_paused:
-            pygame.mixer.music.pause()
-    except:
-        pass
+        engine.seek(seek_preview)
+    except pygame.error as e:
+        print("Seek error:", e)
+
+shown_progress = None  # (time text, bar position) currently on screen
+
+def show_progress(position):
+    # only touches the widgets when what they show would actually change
+    global shown_progress
+    length = engine.length
+    text = f"{format_time(position)} / {format_time(length)}"
+    bar = round(min(position / length, 1.0) * 100, 1) if length > 0 else 0.0
+    if shown_progress != (text, bar):
+        if shown_progress is None or shown_progress[0] != text:
+            time_label.config(text=text)
+        if shown_progress is None or shown_progress[1] != bar:
+            progress_var.set(bar)
+        shown_progress = (text, bar)
 
 def update_progress():
-    global current_position
-    if pygame.mixer.music.get_busy() and not is_seeking:
-        current_position = seeked_time + (time.time() - song_start_time)
-    if current_song_length > 0:
-        percent = min(current_position / current_song_length, 1.0)
-        progress_var.set(percent*100)
-        time_label.config(text=f"{format_time(current_position)} / {format_time(current_song_length)}")
-        if current_position >= current_song_length - 0.1 and not is_paused:
-            if repeat_mode == "song":
-                play_song(history_paths[history_index], use_invisible=False)
-            else:
-                play_next_song()
-    root.after(200, update_progress)
+    loop_tick("update_progress")
+    with span("update_progress"):
+        engine.poll()
+        prefetch_tick()
+        if not is_seeking:
+            show_progress(engine.position())
+    playing = engine.path is not None and not engine.paused and not engine.ended
+    loop_after("update_progress", PROGRESS_MS if playing else PROGRESS_IDLE_MS, update_progress)
+
+# ---------------------------- VISUALIZER ----------------------------- #
+# SPECTRUM_BANDS bars on a canvas, created once; each frame looks up the row
+# for the playback position in visualizer_spectrum and moves the bars that
+# changed, so a frame costs the same for a 3 minute song as for a 3 hour mix
+VISUALIZER_HEIGHT = 120
+VISUALIZER_BAR = 12  # px per band, gap included
+visualizer_bars = []
+shown_spectrum = None  # the row currently drawn
+
+def make_visualizer(master):
+    canvas = tk.Canvas(master, width=SPECTRUM_BANDS * VISUALIZER_BAR, height=VISUALIZER_HEIGHT,
+                       bg=BACKGROUND, highlightthickness=0)
+    for i in range(SPECTRUM_BANDS):
+        x = i * VISUALIZER_BAR
+        visualizer_bars.append(canvas.create_rectangle(x + 1, VISUALIZER_HEIGHT, x + VISUALIZER_BAR - 1,
+                                                       VISUALIZER_HEIGHT, fill=SPOTIFY_GREEN, width=0))
+    return canvas
+
+def update_visualizer():
+    global shown_spectrum
+    loop_tick("update_visualizer")
+    playing = engine.path is not None and not engine.paused and not engine.ended
+    frames = visualizer_spectrum
+    row = None
+    if playing and len(frames):
+        row = frames[min(len(frames) - 1, int(engine.position() * visualizer_spectrum_rate))]
+    if row is None:
+        row = np.zeros(SPECTRUM_BANDS, np.uint8)
+    changed = range(SPECTRUM_BANDS) if shown_spectrum is None else np.flatnonzero(row != shown_spectrum)
+    for i in changed:
+        x = i * VISUALIZER_BAR
+        top = VISUALIZER_HEIGHT - int(row[i]) * VISUALIZER_HEIGHT // 255
+        visualizer_canvas.coords(visualizer_bars[i], x + 1, top, x + VISUALIZER_BAR - 1, VISUALIZER_HEIGHT)
+    if len(changed):
+        shown_spectrum = np.array(row)
+    loop_after("update_visualizer", 1000 // SPECTRUM_FPS if playing else PROGRESS_IDLE_MS, update_visualizer)
+
+# ---------------------------- BLOCK GAME ----------------------------- #
+# blocks fall down the Game tab and get clicked away; one that reaches the
+# bottom costs a life. they spawn from the track's beat map (Easy every other
+# beat, Medium every beat, Hard every onset), early by their fall time so
+# they cross the line as the beat hits. game_spawn_index is the next spawn
+# time not yet used: a frame only compares it against the playback position,
+# and a seek or new map puts it back with one searchsorted. until the map is
+# in, spawn_interval_dict's fixed timer stands in
+GAME_FPS = 60
+GAME_HIT_MARGIN = 60  # px from the bottom where the beat lands
+RIPPLE_FRAMES = 12
+game_spawns = None  # spawn times in use, None until picked from the map
+game_spawn_index = 0
+game_last_pos = 0.0
+game_hud = None  # the score/lives text shown
+
+def spawn_times():
+    if difficulty == "Easy":
+        return game_beats[::2]
+    if difficulty == "Hard" and len(game_onsets):
+        return game_onsets
+    return game_beats
+
+def fall_seconds():
+    height = max(1, game_canvas.winfo_height() - GAME_HIT_MARGIN)
+    return height / (block_speed_dict[difficulty] * GAME_FPS)
+
+def spawn_block():
+    width = max(block_size, game_canvas.winfo_width())
+    x = random.randrange(0, width - block_size + 1)
+    item = game_canvas.create_rectangle(x, -block_size, x + block_size, 0, fill=SPOTIFY_GREEN, width=0)
+    game_blocks.append(item)
+
+def reset_game():
+    global score, lives, game_over
+    for item in game_blocks:
+        game_canvas.delete(item)
+    game_blocks.clear()
+    score, lives, game_over = 0, 5, False
+    game_canvas.delete("over")
+
+def set_difficulty(value):
+    global difficulty, game_spawns
+    difficulty = value
+    game_spawns = None
+
+def game_click(event):
+    global score
+    if game_over:
+        reset_game()
+        return
+    for item in game_canvas.find_overlapping(event.x, event.y, event.x, event.y):
+        if item in game_blocks:
+            game_blocks.remove(item)
+            game_canvas.delete(item)
+            score += 1
+            ring = game_canvas.create_oval(event.x, event.y, event.x, event.y, outline="white")
+            ripples.append([ring, event.x, event.y, 0])
+            break
+
+def game_spawn(pos, playing):
+    # the spawns due by this frame, O(1) unless the position jumped
+    global game_spawns, game_spawn_index, game_last_pos, last_spawn_time
+    if not len(game_beats):
+        now = time.monotonic() * 1000
+        if playing and now - last_spawn_time >= spawn_interval_dict[difficulty]:
+            last_spawn_time = now
+            spawn_block()
+        return
+    lead = fall_seconds()
+    if game_spawns is None or not (game_last_pos - 0.1 <= pos <= game_last_pos + 1.0):
+        if game_spawns is None:
+            game_spawns = spawn_times()
+        game_spawn_index = int(np.searchsorted(game_spawns, pos + lead))
+    game_last_pos = pos
+    while game_spawn_index < len(game_spawns) and game_spawns[game_spawn_index] - lead <= pos:
+        game_spawn_index += 1
+        if playing:
+            spawn_block()
+
+def update_game():
+    global lives, game_over, game_hud
+    if notebook.select() != str(game_tab):
+        root.after(PROGRESS_IDLE_MS, update_game)
+        return
+    playing = engine.path is not None and not engine.paused and not engine.ended
+    if not game_over:
+        game_spawn(engine.position(), playing)
+    if playing and not game_over:
+        bottom = game_canvas.winfo_height()
+        for item in list(game_blocks):
+            game_canvas.move(item, 0, block_speed_dict[difficulty])
+            if game_canvas.coords(item)[1] > bottom:
+                game_blocks.remove(item)
+                game_canvas.delete(item)
+                lives -= 1
+        if lives <= 0:
+            game_over = True
+            game_canvas.create_text(game_canvas.winfo_width() // 2, game_canvas.winfo_height() // 2,
+                                    text="Game over - click to play again", fill="white",
+                                    font=("Arial", 18), tags="over")
+    for ripple in list(ripples):
+        ring, x, y, age = ripple
+        ripple[3] = age = age + 1
+        r = age * 3
+        game_canvas.coords(ring, x - r, y - r, x + r, y + r)
+        if age >= RIPPLE_FRAMES:
+            ripples.remove(ripple)
+            game_canvas.delete(ring)
+    hud = f"Score {score}   Lives {lives}"
+    if hud != game_hud:
+        game_canvas.itemconfig(game_hud_text, text=hud)
+        game_hud = hud
+    line = game_canvas.winfo_height() - GAME_HIT_MARGIN
+    game_canvas.coords(game_hit_line, 0, line, game_canvas.winfo_width(), line)
+    root.after(1000 // GAME_FPS, update_game)
+
+def queue_beats(event, qid, entry):
+    # keeps the first BEATS_AHEAD queued songs analysed
+    if event == "add" and len(play_queue) <= BEATS_AHEAD:
+        analyse_later(entry[1])
+    elif event == "remove":
+        for _, (_, path) in islice(play_queue, BEATS_AHEAD - 1, BEATS_AHEAD):
+            analyse_later(path)
+
+# ---------------------------- STATS PANEL ---------------------------- #
+# the Stats tab: stats_lines() redrawn once a second while it's showing
+STATS_MS = 1000
+shown_stats = None
+
+def update_stats():
+    global shown_stats
+    if notebook.select() == str(stats_tab):
+        text = "\n".join(stats_lines())
+        if text != shown_stats:
+            stats_text.config(state="normal")
+            stats_text.delete("1.0", "end")
+            stats_text.insert("1.0", text)
+            stats_text.config(state="disabled")
+            shown_stats = text
+    root.after(STATS_MS, update_stats)
+
+def toggle_sampler():
+    set_sampler(bool(sampler_var.get()))
+
+def save_trace_clicked():
+    path = save_trace()
+    trace_label.config(text=f"Saved {path}" if path else "Couldn't save the trace")
 
 # ---------------------------- QUEUE & PLAYLIST ------------------------ #
+# the Queue menu shows the first QUEUE_MENU_ROWS songs and a footer
+# ("(Queue empty)" or "… N more"); play_queue's notifications add or delete
+# single rows instead of rebuilding it
+queue_rows = []  # queue ids of the menu rows, top to bottom
+queue_footer = False  # the menu ends in a footer entry
+
+def add_queue_row(qid, name, path):
+    song_menu = tk.Menu(queue_mb.menu, tearoff=False, bg=BUTTON_BG, fg="white")
+    song_menu.add_command(label="▶ Play", command=lambda: play_song(path, use_invisible=False))
+    song_menu.add_command(label="❌ Remove from Queue", command=lambda: play_queue.remove(qid))
+    queue_mb.menu.insert_cascade(len(queue_rows), label=name, menu=song_menu)
+    queue_rows.append(qid)
+
+def update_queue_footer():
+    global queue_footer
+    menu = queue_mb.menu
+    hidden = len(play_queue) - len(queue_rows)
+    label = "(Queue empty)" if not play_queue else "… %d more" % hidden if hidden else None
+    if queue_footer and label:
+        menu.entryconfig("end", label=label)
+    elif queue_footer:
+        menu.delete("end")
+    elif label:
+        menu.add_command(label=label, state="disabled")
+    queue_footer = label is not None
+
+def on_queue_change(event, qid, entry):
+    if event == "add":
+        if len(queue_rows) < QUEUE_MENU_ROWS:
+            add_queue_row(qid, *entry)
+    elif qid in queue_rows:
+        i = queue_rows.index(qid)
+        queue_mb.menu.nametowidget(queue_mb.menu.entrycget(i, "menu")).destroy()
+        queue_mb.menu.delete(i)
+        queue_rows.pop(i)
+        for next_qid, (name, path) in islice(play_queue, len(queue_rows), len(queue_rows) + 1):
+            add_queue_row(next_qid, name, path)  # the first hidden song moves up
+    update_queue_footer()
+
 def refresh_queue_dropdown():
+    global queue_footer
     queue_mb.menu.delete(0, "end")
-    if not queue:
-        queue_mb.menu.add_command(label="(Queue empty)", state="disabled")
-        return
-    for i, song in enumerate(queue):
-        song_menu = tk.Menu(queue_mb.menu, tearoff=False, bg=BUTTON_BG, fg="white")
-        song_menu.add_command(label="▶ Play", command=lambda idx=i: play_song(queue_paths[idx], use_invisible=False))
-        song_menu.add_command(label="❌ Remove from Queue", command=lambda idx=i: remove_from_queue(idx))
-        queue_mb.menu.add_cascade(label=song, menu=song_menu)
-
-def remove_from_queue(index):
-    if 0 <= index < len(queue):
-        queue.pop(index)
-        queue_paths.pop(index)
-        refresh_queue_dropdown()
+    for child in list(queue_mb.menu.children.values()):
+        child.destroy()
+    queue_rows.clear()
+    queue_footer = False
+    for qid, (name, path) in islice(play_queue, QUEUE_MENU_ROWS):
+        add_queue_row(qid, name, path)
+    update_queue_footer()
 
 def add_to_queue(name, path):
-    queue.append(name)
-    queue_paths.append(path)
-    refresh_queue_dropdown()
+    play_queue.add(name, path)
+
+# menus are built as they are opened: a playlist's songs are only listed
+# (and their Play/Queue menus only made) when someone actually looks
+def fill_song_menu(menu, name, paths, index):
+    if menu.index("end") is None:
+        menu.add_command(label="▶ Play", command=lambda: play_song(paths[index], paths, index))
+        menu.add_command(label="+ Queue", command=lambda: add_to_queue(name, paths[index]))
+
+def fill_playlist_menu(playlist_name):
+    if playlist_name in playlist_songs:
+        return
+    submenu = playlist_menus[playlist_name]
+    song_names, song_paths = load_playlist(playlist_dict[playlist_name])
+    playlist_songs[playlist_name] = (song_names, song_paths)
+    submenu.add_command(label="+ Queue all", command=lambda: play_queue.extend(zip(song_names, song_paths)))
+    submenu.add_separator()
+    for i, song_name in enumerate(song_names):
+        song_submenu = tk.Menu(submenu, tearoff=False, bg=BUTTON_BG, fg="white")
+        song_submenu.config(postcommand=lambda m=song_submenu, n=song_name, idx=i:
+                            fill_song_menu(m, n, song_paths, idx))
+        submenu.add_cascade(label=song_name, menu=song_submenu)
+
+def add_playlist_entry(playlist_name, index=None):
+    submenu = tk.Menu(master_playlist_mb.menu, tearoff=False, bg=BUTTON_BG, fg="white",
+                      postcommand=lambda: fill_playlist_menu(playlist_name))
+    playlist_menus[playlist_name] = submenu
+    if index is None:
+        master_playlist_mb.menu.add_cascade(label=playlist_name, menu=submenu)
+    else:
+        master_playlist_mb.menu.insert_cascade(index, label=playlist_name, menu=submenu)
+
+def reset_playlist_entry(playlist_name):
+    # forget the songs, the next time the submenu opens it lists the folder again
+    playlist_songs.pop(playlist_name, None)
+    submenu = playlist_menus[playlist_name]
+    for child in list(submenu.children.values()):
+        child.destroy()
+    submenu.delete(0, "end")
 
 def refresh_playlists_dropdown():
     master_playlist_mb.menu.delete(0, "end")
-    for playlist_name, folder in playlist_dict.items():
-        song_names, song_paths = load_playlist(folder)
-        submenu = tk.Menu(master_playlist_mb.menu, tearoff=False, bg=BUTTON_BG, fg="white")
-        for i, song_name in enumerate(song_names):
-            song_submenu = tk.Menu(submenu, tearoff=False, bg=BUTTON_BG, fg="white")
-            song_submenu.add_command(label="▶ Play", command=lambda p=song_paths[i], pl=song_paths, idx=i: play_song(p, pl, idx))
-            song_submenu.add_command(label="+ Queue", command=lambda n=song_name, p=song_paths[i]: add_to_queue(n, p))
-            submenu.add_cascade(label=song_name, menu=song_submenu)
-        master_playlist_mb.menu.add_cascade(label=playlist_name, menu=submenu)
+    for submenu in playlist_menus.values():
+        submenu.destroy()
+    playlist_menus.clear()
+    playlist_songs.clear()
+    for playlist_name in playlist_dict:
+        add_playlist_entry(playlist_name)
     master_playlist_mb.menu.add_separator()
     master_playlist_mb.menu.add_command(label="Add Folder", command=add_playlist_folder)
 
@@ -314,8 +1508,69 @@ def add_playlist_folder():
         dest = os.path.join(MUSIC_FOLDER, os.path.basename(folder))
         if not os.path.exists(dest):
             shutil.copytree(folder, dest)
-        playlist_dict[os.path.basename(dest)] = dest
-        refresh_playlists_dropdown()
+        playlist_name = os.path.basename(dest)
+        playlist_dict[playlist_name] = dest
+        if playlist_name in playlist_menus:
+            reset_playlist_entry(playlist_name)
+        else:
+            # playlists come first in the menu, so this lands just above the separator
+            add_playlist_entry(playlist_name, len(playlist_menus))
+
+# ---------------------------- GAP BENCHMARK --------------------------- #
+# python Playerlocal.py --bench-gap
+# plays two tones back to back through SDL's disk audio driver and measures
+# the silence between them in what the mixer actually wrote out:
+#   reload    the end noticed on a ui tick, then load + play (the old way)
+#   gapless   prefetched and handed to music.queue()
+#   crossfade the same with CROSSFADE_SECONDS = 2
+def bench_gap():
+    global CROSSFADE_SECONDS, invisible_queue_paths, invisible_queue_index
+    folder = os.path.dirname(BENCH_AUDIO)
+    freq, _, channels = pygame.mixer.get_init()
+    tones = []
+    for name, hz in (("a", 440), ("b", 660)):
+        t = np.arange(freq * 4) / freq
+        path = os.path.join(folder, name + ".wav")
+        sf.write(path, np.repeat((np.sin(2 * np.pi * hz * t) * 0.5)[:, None], 2, axis=1), freq)
+        tones.append(path)
+    marks = []
+    for mode in ("reload", "gapless", "crossfade"):
+        CROSSFADE_SECONDS = 2.0 if mode == "crossfade" else 0.0
+        invisible_queue_paths, invisible_queue_index = tones, 0
+        engine.on_end = lambda started: started or engine.load(tones[1], track_length(tones[1]))
+        engine.load(tones[0], track_length(tones[0]))
+        while engine.path != tones[1]:
+            engine.poll()
+            if mode != "reload":
+                prefetch_tick()
+            time.sleep(PROGRESS_MS / 1000)
+        engine.load(tones[0], 0.0)
+        pygame.mixer.music.stop()
+        marks.append(mode)
+        time.sleep(1.5)  # a long silence marks where the next run starts
+    pygame.mixer.quit()
+
+    audio = np.abs(np.fromfile(BENCH_AUDIO, np.int16).reshape(-1, channels)[:, 0].astype(np.int32))
+    ms = freq // 1000
+    loud = audio[:len(audio) // ms * ms].reshape(-1, ms).max(axis=1) > 500  # per millisecond
+    edges = np.flatnonzero(np.diff(loud.astype(np.int8)))
+    runs = [(edges[i] + 1, edges[i + 1] + 1) for i in range(0, len(edges) - 1, 2)]
+    # runs of sound per mode: tone a, (gap), tone b; silences over a second split modes
+    groups, current = [], [runs[0]]
+    for run in runs[1:]:
+        if run[0] - current[-1][1] > 1000:
+            groups.append(current)
+            current = []
+        current.append(run)
+    groups.append(current)
+    print("mixer %d Hz, %d channels" % (freq, channels))
+    for mode, group in zip(marks, groups):
+        gaps = [b[0] - a[1] for a, b in zip(group, group[1:])]
+        print("%-10s gap %4d ms" % (mode, max(gaps) if gaps else 0))
+
+if BENCH_GAP:
+    bench_gap()
+    sys.exit()
 
 # ---------------------------- GUI SETUP ------------------------------- #
 root = tk.Tk()
@@ -332,6 +1587,34 @@ notebook.pack(fill="both", expand=True)
 player_tab = tk.Frame(notebook, bg=BACKGROUND)
 notebook.add(player_tab, text="Player")
 
+game_tab = tk.Frame(notebook, bg=BACKGROUND)
+notebook.add(game_tab, text="Game")
+game_bar = tk.Frame(game_tab, bg=BACKGROUND)
+game_bar.pack(fill="x", pady=4)
+difficulty_var = tk.StringVar(value=difficulty)
+difficulty_menu = tk.OptionMenu(game_bar, difficulty_var, *block_speed_dict, command=set_difficulty)
+difficulty_menu.config(bg=BUTTON_BG, fg="white", highlightthickness=0)
+difficulty_menu.pack(side="left", padx=4)
+game_canvas = tk.Canvas(game_tab, bg=BACKGROUND, highlightthickness=0)
+game_canvas.pack(fill="both", expand=True)
+game_canvas.bind("<Button-1>", game_click)
+game_hit_line = game_canvas.create_line(0, 0, 0, 0, fill="#444", dash=(4, 4))
+game_hud_text = game_canvas.create_text(10, 10, anchor="nw", fill="white", font=("Arial", 14))
+
+stats_tab = tk.Frame(notebook, bg=BACKGROUND)
+notebook.add(stats_tab, text="Stats")
+stats_bar = tk.Frame(stats_tab, bg=BACKGROUND)
+stats_bar.pack(fill="x", pady=4)
+sampler_var = tk.IntVar(value=PROFILE)
+tk.Checkbutton(stats_bar, text="Sample the UI thread", variable=sampler_var, command=toggle_sampler,
+               bg=BACKGROUND, fg="white", selectcolor=BUTTON_BG, activebackground=BACKGROUND).pack(side="left", padx=4)
+tk.Button(stats_bar, text="Save trace", bg=BUTTON_BG, fg=BUTTON_FG, relief="flat",
+          command=save_trace_clicked).pack(side="left", padx=4)
+trace_label = tk.Label(stats_bar, text="", bg=BACKGROUND, fg="#aaa")
+trace_label.pack(side="left", padx=4)
+stats_text = tk.Text(stats_tab, bg=PANEL_BG, fg="white", font=("Courier", 11), relief="flat", state="disabled")
+stats_text.pack(fill="both", expand=True, padx=4, pady=4)
+
 
 # Top Frame
 top_frame = tk.Frame(player_tab, bg=BACKGROUND)
@@ -346,6 +1629,9 @@ queue_mb = tk.Menubutton(top_frame, text="Queue", bg=BUTTON_BG, fg="white", reli
 queue_mb.pack(side="left", padx=4)
 queue_mb.menu = tk.Menu(queue_mb, tearoff=False, bg=BUTTON_BG, fg="white")
 queue_mb["menu"] = queue_mb.menu
+play_queue.listeners.append(on_queue_change)
+play_queue.listeners.append(queue_beats)
+refresh_queue_dropdown()
 
 ensure_music_folder()
 playlist_dict = scan_playlists()
@@ -364,6 +1650,9 @@ now_playing_label.pack(pady=4)
 time_label = tk.Label(right_frame, text="0:00 / 0:00", fg="white", bg=BACKGROUND, font=("Arial",12))
 time_label.pack(pady=2)
 
+visualizer_canvas = make_visualizer(right_frame)
+visualizer_canvas.pack(pady=6)
+
 
 # ----------------- BOTTOM CONTROLS ----------------- #
 bottom = tk.Frame(right_frame, bg=PANEL_BG)
@@ -390,7 +1679,7 @@ repeat_label.grid(row=0, column=5, padx=6)
 
 volume_var = tk.DoubleVar(value=0.3)
 volume_slider = tk.Scale(controls, from_=0, to=1, resolution=0.01, orient="horizontal", variable=volume_var,
-                         command=lambda v: pygame.mixer.music.set_volume(float(v)), length=140, bg=PANEL_BG, fg="white")
+                         command=lambda v: engine.set_volume(float(v)), length=140, bg=PANEL_BG, fg="white")
 volume_slider.grid(row=0, column=6, padx=8)
 
 # Progress bar
@@ -402,10 +1691,19 @@ progress_bar.bind("<Button-1>", start_seek)
 progress_bar.bind("<B1-Motion>", seek_to)
 progress_bar.bind("<ButtonRelease-1>", stop_seek)
 
-pygame.mixer.music.set_volume(volume_var.get())
+engine.set_volume(volume_var.get())
+engine.on_end = play_next_song
 
 
 # ----------------- INITIALIZE ----------------- #
 
 update_progress()
+update_visualizer()
+update_game()
+update_stats()
+if PROFILE:
+    set_sampler(True)
 root.mainloop()
+if PROFILE:
+    set_sampler(False)
+    print("Trace written to", save_trace())
@@ -1,41 +1,2033 @@
-from flask import Flask, jsonify, send_from_directory, request, Response
+from flask import Flask, abort, jsonify, send_from_directory, request, Response
+from werkzeug.http import http_date, parse_content_range_header, quote_etag
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import ClosingIterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import base64
+import bisect
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import mimetypes
+import mmap
 import os
+import re
+import shutil
+import sqlite3
+import struct
+import tarfile
+import threading
+import time
+import urllib.parse
+import zipfile
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 BASE = os.path.dirname(__file__)
-MUSIC = os.path.join(BASE, "music")
+MUSIC = os.environ.get("BRICKIFY_MUSIC") or os.path.join(BASE, "music")
 STATIC = os.path.join(BASE, "static")
+# everything Brickify generates lives in a hidden folder inside the library
+# so Playerlocal pointed at the same music folder can share it
+CACHE = os.path.join(MUSIC, ".brickify")
+INDEX_DB = os.path.join(CACHE, "index.db")
+AUDIO_EXTS = (".mp3",".wav",".ogg",".flac")
+RESCAN_INTERVAL = 1.0  # seconds between mtime checks on /api/playlists
 os.makedirs(MUSIC, exist_ok=True)
 os.makedirs(STATIC, exist_ok=True)
+os.makedirs(CACHE, exist_ok=True)
 
-# ---------------- BACKEND ----------------
+# ---------------- LIBRARY INDEX ----------------
+# dirs:    every folder under MUSIC ("" is MUSIC itself, "/" separated) + its mtime
+# tracks:  audio files directly inside a folder with size and mtime
+# changes: added/removed tracks per library generation, for ?since= and /api/events
+#          ("tagged", playlist, "") when metadata for some of its tracks landed
+#          or one of its files was rewritten in place
+# tags:    header metadata per track path, see TRACK METADATA
+# loudness: integrated loudness and peak per file sha1, see LOUDNESS
+# sessions: queue/history/shuffle state per player, see SESSIONS
+# a folder is only re-listed when its mtime changed since the last scan, so a
+# rescan of an unchanged library is one stat() per folder
 
-def scan_playlists():
-    data = {}
-    for folder in os.listdir(MUSIC):
-        p = os.path.join(MUSIC, folder)
-        if os.path.isdir(p):
-            songs = [f for f in os.listdir(p)
-                     if f.lower().endswith((".mp3",".wav",".ogg",".flac"))]
-            if songs:
-                data[folder] = songs
-    return data
+CHANGE_LOG_KEEP = 5000  # change rows kept for delta clients, older ones get a full reload
+
+def open_index():
+    db = sqlite3.connect(INDEX_DB, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS dirs(
+        path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS tracks(
+        dir TEXT NOT NULL, name TEXT NOT NULL,
+        size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        PRIMARY KEY(dir, name));
+    CREATE TABLE IF NOT EXISTS changes(
+        gen INTEGER NOT NULL, op TEXT NOT NULL, dir TEXT NOT NULL, name TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS changes_gen ON changes(gen);
+    CREATE INDEX IF NOT EXISTS tracks_size ON tracks(dir, size, name);
+    CREATE INDEX IF NOT EXISTS tracks_mtime ON tracks(dir, mtime_ns, name);
+    CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS hashes(
+        path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        sha1 TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS tags(
+        path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        title TEXT, artist TEXT, album TEXT, duration REAL, samplerate INTEGER, bitrate INTEGER);
+    CREATE TABLE IF NOT EXISTS loudness(
+        sha1 TEXT PRIMARY KEY, lufs REAL, peak REAL);
+    CREATE TABLE IF NOT EXISTS sessions(
+        id TEXT PRIMARY KEY, state TEXT NOT NULL, touched REAL NOT NULL);
+    """)
+    return db
+
+index_db = open_index()
+index_lock = threading.RLock()
+library_changed = threading.Condition(index_lock)
+last_rescan = 0.0
+scan_changes = []  # (op, dir, name) collected while a rescan runs
+
+def get_meta(key, default=0):
+    row = index_db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(key, value):
+    index_db.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (key, value))
+
+library_generation = get_meta("generation")
+
+def index_children(rel):
+    prefix = rel + "/" if rel else ""
+    rows = index_db.execute(
+        "SELECT path FROM dirs WHERE path > ? AND path < ?", (prefix, prefix + "\uffff"))
+    return [p for (p,) in rows if p and "/" not in p[len(prefix):]]
+
+def forget_dir(rel):
+    prefix = rel + "/"
+    where = "dir = ? OR (dir > ? AND dir < ?)"
+    args = (rel, prefix, prefix + "\uffff")
+    for d, name in index_db.execute("SELECT dir, name FROM tracks WHERE " + where, args):
+        scan_changes.append(("removed", d, name))
+    index_db.execute("DELETE FROM dirs WHERE " + where.replace("dir", "path"), args)
+    index_db.execute("DELETE FROM tracks WHERE " + where, args)
+
+def relist_dir(rel, full, mtime_ns):
+    subdirs, tracks = [], []
+    with os.scandir(full) as it:
+        for e in it:
+            if e.name.startswith("."):
+                continue
+            if e.is_dir():
+                subdirs.append(e.name)
+            elif rel and e.name.lower().endswith(AUDIO_EXTS):
+                st = e.stat()
+                tracks.append((rel, e.name, st.st_size, st.st_mtime_ns))
+    old = {n: (size, mtime) for n, size, mtime in index_db.execute(
+        "SELECT name, size, mtime_ns FROM tracks WHERE dir = ?", (rel,))}
+    new = {t[1] for t in tracks}
+    scan_changes.extend(("added", rel, n) for n in sorted(new - set(old)))
+    scan_changes.extend(("removed", rel, n) for n in sorted(set(old) - new))
+    if any(old.get(t[1], t[2:]) != t[2:] for t in tracks):
+        # a file rewritten in place, its tags and loudness have to be read again
+        scan_changes.append(("tagged", rel, ""))
+    index_db.execute("DELETE FROM tracks WHERE dir = ?", (rel,))
+    index_db.executemany("INSERT INTO tracks VALUES (?,?,?,?)", tracks)
+    index_db.execute("INSERT OR REPLACE INTO dirs VALUES (?,?)", (rel, mtime_ns))
+    for old_dir in index_children(rel):
+        if old_dir.rsplit("/", 1)[-1] not in subdirs:
+            forget_dir(old_dir)
+    return [rel + "/" + d if rel else d for d in subdirs]
+
+def rescan_dir(rel, known):
+    full = os.path.join(MUSIC, *rel.split("/")) if rel else MUSIC
+    try:
+        mtime_ns = os.stat(full).st_mtime_ns
+    except OSError:
+        forget_dir(rel)
+        return
+    if known.get(rel) == mtime_ns:
+        children = index_children(rel)
+    else:
+        children = relist_dir(rel, full, mtime_ns)
+    for child in children:
+        rescan_dir(child, known)
+
+def begin_write():
+    # other worker processes (--serve --workers N) write the same index, so
+    # take the write lock up front and pick up any generation they logged
+    global library_generation
+    index_db.execute("BEGIN IMMEDIATE")
+    library_generation = get_meta("generation")
+
+def log_changes(changes):
+    global library_generation
+    library_generation += 1
+    if len(changes) > CHANGE_LOG_KEEP:
+        # too big to be worth replaying, delta clients just reload everything
+        index_db.execute("DELETE FROM changes")
+        set_meta("oldest", library_generation)
+    else:
+        index_db.executemany("INSERT INTO changes VALUES (?,?,?,?)",
+                             [(library_generation,) + c for c in changes])
+        total = index_db.execute("SELECT count(*) FROM changes").fetchone()[0]
+        if total > CHANGE_LOG_KEEP:
+            cut = index_db.execute("SELECT gen FROM changes ORDER BY gen DESC LIMIT 1 OFFSET ?",
+                                   (CHANGE_LOG_KEEP,)).fetchone()[0]
+            index_db.execute("DELETE FROM changes WHERE gen <= ?", (cut,))
+            set_meta("oldest", cut + 1)
+    set_meta("generation", library_generation)
+
+def rescan_index(stale=()):
+    # folders in `stale` are re-listed even if their mtime didn't change
+    global last_rescan
+    with index_lock:
+        started = time.perf_counter()
+        before = library_generation
+        begin_write()
+        known = dict(index_db.execute("SELECT path, mtime_ns FROM dirs"))
+        for rel in stale:
+            known.pop(rel, None)
+        del scan_changes[:]
+        rescan_dir("", known)
+        changes = [c for c in scan_changes if "/" not in c[1]]
+        if changes:
+            log_changes(changes)
+        index_db.commit()
+        last_rescan = time.monotonic()
+        scan_stats["last"] = time.perf_counter() - started
+        scan_stats["seconds"] += scan_stats["last"]
+        scan_stats["count"] += 1
+        if library_generation != before:
+            library_changed.notify_all()
+            ensure_tagger()
+
+def library_delta(since):
+    # None when `since` is older than the change log, the client must reload
+    with index_lock:
+        if since < get_meta("oldest") or since > library_generation:
+            return None
+        net, tagged = {}, set()
+        rows = index_db.execute(
+            "SELECT op, dir, name FROM changes WHERE gen > ? ORDER BY gen", (since,))
+        for op, pl, song in rows:
+            if op == "tagged":
+                tagged.add(pl)
+            elif net.get((pl, song), op) != op:
+                del net[(pl, song)]  # added then removed again (or the reverse)
+            else:
+                net[(pl, song)] = op
+        return {"generation": library_generation,
+                "added": [list(k) for k, op in net.items() if op == "added"],
+                "removed": [list(k) for k, op in net.items() if op == "removed"],
+                "tagged": sorted(tagged)}
+
+# ---------------- LIBRARY WATCHER ----------------
+# keeps the index fresh in the background so requests never have to rescan.
+# uses inotify when inotify_simple is installed, otherwise polls folder mtimes.
+# a file written in place (or still being copied when its folder was listed)
+# doesn't touch the folder's mtime, so CLOSE_WRITE re-lists its folder
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+POLL_INTERVAL = 2.0
+WATCH_DEBOUNCE = 0.25  # seconds to let a burst of file events settle
+watcher_thread = None
+
+def watch_inotify():
+    ino = INotify()
+    mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_FROM |
+            inotify_flags.MOVED_TO | inotify_flags.DELETE_SELF | inotify_flags.CLOSE_WRITE)
+    watches, folders = {}, {}  # rel -> watch descriptor, and back
+    while True:
+        with index_lock:
+            wanted = {p for (p,) in index_db.execute("SELECT path FROM dirs")}
+        for rel in set(watches) - wanted:
+            wd = watches.pop(rel)
+            folders.pop(wd, None)
+            try:
+                ino.rm_watch(wd)
+            except OSError:
+                pass
+        for rel in wanted - set(watches):
+            try:
+                watches[rel] = ino.add_watch(os.path.join(MUSIC, *rel.split("/")) if rel else MUSIC, mask)
+                folders[watches[rel]] = rel
+            except OSError:
+                pass
+        stale = set()
+        events = ino.read()  # block until something happens
+        while events:
+            stale.update(folders[e.wd] for e in events
+                         if e.mask & inotify_flags.CLOSE_WRITE and e.wd in folders)
+            events = ino.read(timeout=int(WATCH_DEBOUNCE * 1000))
+        rescan_index(stale)
+
+def watch_polling():
+    while True:
+        time.sleep(POLL_INTERVAL)
+        rescan_index()
+
+def run_watcher():
+    if INotify is not None:
+        try:
+            watch_inotify()
+        except OSError as e:
+            print("inotify unavailable, polling instead:", e)
+    watch_polling()
+
+def ensure_watcher():
+    global watcher_thread
+    with index_lock:
+        if watcher_thread is None:
+            rescan_index()
+            watcher_thread = threading.Thread(target=run_watcher, daemon=True)
+            watcher_thread.start()
+            ensure_tagger()  # picks up anything an earlier run didn't get to
+
+def known_hash(rel, st):
+    with index_lock:
+        row = index_db.execute("SELECT sha1 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                               (rel, st.st_size, st.st_mtime_ns)).fetchone()
+    metrics_hit("hashes", row is not None)
+    return row[0] if row else None
+
+def content_hash(path):
+    # sha1 of the file, remembered in the index until size or mtime change
+    st = os.stat(path)
+    rel = os.path.relpath(path, MUSIC).replace(os.sep, "/")
+    known = known_hash(rel, st)
+    if known:
+        return known
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    remember_hash(path, h.hexdigest())
+    return h.hexdigest()
+
+def remember_hash(path, sha1):
+    st = os.stat(path)
+    rel = os.path.relpath(path, MUSIC).replace(os.sep, "/")
+    with index_lock:
+        index_db.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)",
+                         (rel, st.st_size, st.st_mtime_ns, sha1))
+        index_db.commit()
+
+def find_duplicate(size, sha1):
+    # only tracks of exactly the same size can match, so at most a handful
+    # of files ever get hashed here (and only once, thanks to the hashes table)
+    with index_lock:
+        rows = index_db.execute("SELECT dir, name FROM tracks WHERE size = ?", (size,)).fetchall()
+    for d, name in rows:
+        try:
+            if content_hash(os.path.join(MUSIC, *d.split("/"), name)) == sha1:
+                return d + "/" + name
+        except OSError:
+            pass
+    return None
+
+def index_add_file(rel, name):
+    # hands one new file to the index without rescanning anything; the
+    # folder's mtime moved, so the next rescan re-lists just that folder
+    if not name.lower().endswith(AUDIO_EXTS):
+        return
+    st = os.stat(os.path.join(MUSIC, *rel.split("/"), name))
+    with index_lock:
+        begin_write()
+        existed = index_db.execute("SELECT 1 FROM tracks WHERE dir = ? AND name = ?",
+                                   (rel, name)).fetchone()
+        index_db.execute("INSERT OR REPLACE INTO tracks VALUES (?,?,?,?)",
+                         (rel, name, st.st_size, st.st_mtime_ns))
+        if not existed and "/" not in rel:
+            log_changes([("added", rel, name)])
+        index_db.commit()
+        if not existed:
+            library_changed.notify_all()
+    ensure_tagger()
+
+# ---------------- TRACK METADATA ----------------
+# title/artist/album/duration/sample rate/bitrate come from the file headers
+# (nothing is decoded) on a process pool after each scan, and stay in the tags
+# table until the file's size or mtime changes. Playerlocal reads the same rows
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+TAG_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+TAG_BATCH = 256     # files per trip to the pool, and per generation bump
+TAG_CLAIM_TTL = 60  # seconds before another worker process may take over tagging
+TAG_FIELDS = ("title", "artist", "album", "duration", "samplerate", "bitrate")
+tagger_thread = None
+tag_again = False
+
+def first_tag(tags, key):
+    try:
+        value = tags.get(key)
+    except (KeyError, ValueError):
+        return None
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+def read_tags(path):
+    # runs in the pool, so it takes a path and hands back plain values
+    title = artist = album = duration = samplerate = bitrate = None
+    if mutagen is not None:
+        try:
+            f = mutagen.File(path, easy=True)
+        except Exception:
+            f = None
+        if f is not None:
+            if f.tags is not None:
+                title, artist, album = (first_tag(f.tags, k) for k in ("title", "artist", "album"))
+            duration = getattr(f.info, "length", None) or None
+            samplerate = getattr(f.info, "sample_rate", None) or None
+            bitrate = getattr(f.info, "bitrate", None) or None
+    if duration is None and sf is not None:
+        try:
+            with sf.SoundFile(path) as f:
+                duration = f.frames / f.samplerate if f.frames > 0 else None
+                samplerate = f.samplerate
+                strings = f.copy_metadata()
+            title = title or strings.get("title")
+            artist = artist or strings.get("artist")
+            album = album or strings.get("album")
+        except Exception:
+            pass
+    if duration and not bitrate:
+        try:
+            bitrate = int(os.path.getsize(path) * 8 / duration)
+        except OSError:
+            pass
+    return title, artist, album, duration, samplerate, bitrate
+
+def tag_fields(values):
+    # the non-empty ones, for json
+    d = dict(zip(TAG_FIELDS, values))
+    if d["duration"] is not None:
+        d["duration"] = round(d["duration"], 3)
+    return {k: v for k, v in d.items() if v is not None}
+
+def untagged(limit):
+    with index_lock:
+        return index_db.execute("""
+            SELECT t.dir, t.name, t.size, t.mtime_ns FROM tracks t
+            LEFT JOIN tags g ON g.path = t.dir || '/' || t.name
+            WHERE g.path IS NULL OR g.size != t.size OR g.mtime_ns != t.mtime_ns
+            LIMIT ?""", (limit,)).fetchall()
+
+def claim_tagging():
+    # with --serve --workers N every process sees the same new files, only
+    # one of them tags while the claim is fresh
+    with index_lock:
+        begin_write()
+        if (time.time() - get_meta("tag_claim") < TAG_CLAIM_TTL
+                and get_meta("tag_pid") != os.getpid()):
+            index_db.commit()
+            return False
+        set_meta("tag_claim", int(time.time()))
+        set_meta("tag_pid", os.getpid())
+        index_db.commit()
+        return True
+
+def tag_library():
+    if not claim_tagging():
+        return
+    pool = None
+    try:
+        while True:
+            rows = untagged(TAG_BATCH)
+            if not rows:
+                with index_lock:
+                    # re-check under the write lock so a file another worker
+                    # adds right now is either seen here or finds the claim free
+                    begin_write()
+                    if not untagged(1):
+                        index_db.execute("DELETE FROM tags WHERE path NOT IN "
+                                         "(SELECT dir || '/' || name FROM tracks)")
+                        set_meta("tag_claim", 0)
+                        index_db.commit()
+                        break
+                    index_db.commit()
+                continue
+            paths = [os.path.join(MUSIC, *d.split("/"), name) for d, name, _, _ in rows]
+            results = None
+            if pool is not False:
+                try:
+                    pool = pool or ProcessPoolExecutor(TAG_WORKERS)
+                    results = list(pool.map(read_tags, paths, chunksize=16))
+                except (OSError, BrokenProcessPool) as e:
+                    print("Tag pool error, reading tags in-process:", e)
+                    pool = False
+            if results is None:
+                results = [read_tags(p) for p in paths]
+            with index_lock:
+                begin_write()
+                index_db.executemany("INSERT OR REPLACE INTO tags VALUES (?,?,?,?,?,?,?,?,?)",
+                                     [(d + "/" + name, size, mtime_ns) + r
+                                      for (d, name, size, mtime_ns), r in zip(rows, results)])
+                playlists = sorted({d for d, _, _, _ in rows if "/" not in d})
+                if playlists:
+                    log_changes([("tagged", pl, "") for pl in playlists])
+                set_meta("tag_claim", int(time.time()))
+                index_db.commit()
+                library_changed.notify_all()
+    finally:
+        if pool:
+            pool.shutdown()
+
+def run_tagger():
+    global tagger_thread, tag_again
+    while True:
+        try:
+            tag_library()
+            measure_library()
+        except Exception as e:
+            print("Tag error:", e)
+        with index_lock:
+            if not tag_again:
+                tagger_thread = None
+                return
+            tag_again = False
+
+def ensure_tagger():
+    global tagger_thread, tag_again
+    with index_lock:
+        if tagger_thread is not None:
+            tag_again = True  # one more pass once the running one is done
+            return
+        tagger_thread = threading.Thread(target=run_tagger, daemon=True)
+        tagger_thread.start()
+
+# ---------------- LOUDNESS ----------------
+# integrated loudness (ITU-R BS.1770, the measure ReplayGain 2 uses) and
+# sample peak per track, measured after tagging on the same kind of pool. the
+# audio is decoded LOUDNESS_READ sub-blocks at a time; each 100 ms sub-block's
+# K-weighted power comes from its spectrum (Parseval) so the filter is one
+# vectorised multiply, and the 400 ms gating blocks are means of 4 of them.
+# results are keyed by the file's sha1 (see content_hash), so a renamed or
+# copied track is never decoded twice. clients get a "gain" in dB next to the
+# tags that brings the track to LOUDNESS_TARGET without clipping
+LOUDNESS_TARGET = -18.0  # LUFS
+LOUDNESS_STEP = 0.1      # seconds per sub-block
+LOUDNESS_READ = 100      # sub-blocks per decode
+LOUDNESS_BATCH = 32      # files per trip to the pool
+LOUDNESS_JOIN = """
+    LEFT JOIN hashes h ON h.path = t.dir || '/' || t.name
+        AND h.size = t.size AND h.mtime_ns = t.mtime_ns
+    LEFT JOIN loudness l ON l.sha1 = h.sha1"""
+
+def k_weighting(rate, n):
+    # power response of the BS.1770 pre-filter (high shelf into high pass)
+    # at the rfft bins of an n-sample block, scaled so that summing it
+    # against |rfft|^2 gives the block's mean square
+    z = np.exp(-2j * np.pi * np.fft.rfftfreq(n, 1.0 / rate) / rate)
+    k, q = math.tan(math.pi * 1681.974450955533 / rate), 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    h = ((vh + vb * k / q + k * k) + 2 * (k * k - vh) * z + (vh - vb * k / q + k * k) * z * z) / \
+        ((1 + k / q + k * k) + 2 * (k * k - 1) * z + (1 - k / q + k * k) * z * z)
+    k, q = math.tan(math.pi * 38.13547087602444 / rate), 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    h *= a0 * (1 - z) ** 2 / (a0 + 2 * (k * k - 1) * z + (1 - k / q + k * k) * z * z)
+    w = np.abs(h) ** 2 * 2 / (n * n)
+    w[0] /= 2
+    if n % 2 == 0:
+        w[-1] /= 2
+    return w
+
+def measure_loudness(path):
+    # runs in the pool: (integrated LUFS or None when it's all silence, peak)
+    try:
+        with sf.SoundFile(path) as f:
+            n = max(1, int(f.samplerate * LOUDNESS_STEP))
+            weights = k_weighting(f.samplerate, n)
+            powers, peak = [], 0.0
+            for block in f.blocks(blocksize=n * LOUDNESS_READ, dtype="float32", always_2d=True):
+                if not len(block):
+                    continue
+                peak = max(peak, float(np.abs(block).max()))
+                k = len(block) // n
+                if k:
+                    spec = np.fft.rfft(block[:k * n].reshape(k, n, -1), axis=1)
+                    # channels summed with weight 1: no surround weighting for music
+                    powers.append(np.einsum("kfc,f->k", spec.real ** 2 + spec.imag ** 2, weights))
+    except Exception:
+        return None, None
+    powers = np.concatenate(powers) if powers else np.zeros(0)
+    if len(powers) < 4:
+        return None, peak or None
+    blocks = np.convolve(powers, np.full(4, 0.25), mode="valid")
+    gated = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]  # absolute gate, -70 LUFS
+    if not gated.size:
+        return None, peak or None
+    gated = gated[gated > gated.mean() / 10]  # relative gate, 10 LU down
+    return round(-0.691 + 10 * math.log10(gated.mean()), 2), peak or None
+
+def loudness_gain(lufs, peak):
+    # dB to bring a track to LOUDNESS_TARGET, held back so the peak stays <= 1
+    if lufs is None:
+        return None
+    gain = LOUDNESS_TARGET - lufs
+    if peak:
+        gain = min(gain, -20 * math.log10(peak))
+    return round(gain, 2)
+
+def gain_field(lufs, peak):
+    gain = loudness_gain(lufs, peak)
+    return {} if gain is None else {"gain": gain}
+
+def track_gain(pl, song):
+    with index_lock:
+        row = index_db.execute("SELECT l.lufs, l.peak FROM tracks t" + LOUDNESS_JOIN +
+                               " WHERE t.dir = ? AND t.name = ?", (pl, song)).fetchone()
+    return loudness_gain(*row) if row else None
+
+def unmeasured(limit):
+    # tracks whose content isn't hashed yet, or whose hash has no loudness;
+    # hashed copies of one file come back once
+    with index_lock:
+        return index_db.execute("""
+            SELECT t.dir, t.name, h.sha1 FROM tracks t""" + LOUDNESS_JOIN + """
+            WHERE l.sha1 IS NULL GROUP BY coalesce(h.sha1, t.dir || '/' || t.name)
+            LIMIT ?""", (limit,)).fetchall()
+
+def measure_library():
+    if np is None or sf is None or not claim_tagging():
+        return
+    pool = None
+    failed = set()  # vanished while hashing, don't spin on them this pass
+    pending = lambda limit: [r for r in unmeasured(limit + len(failed)) if r[:2] not in failed][:limit]
+    try:
+        while True:
+            rows = pending(LOUDNESS_BATCH)
+            if not rows:
+                with index_lock:
+                    begin_write()  # same hand-off as tag_library
+                    if pending(1):
+                        index_db.commit()
+                        continue
+                    index_db.execute("DELETE FROM loudness WHERE sha1 NOT IN (SELECT sha1 FROM hashes)")
+                    set_meta("tag_claim", 0)
+                    index_db.commit()
+                    break
+            todo = []
+            for d, name, sha1 in rows:
+                path = os.path.join(MUSIC, *d.split("/"), name)
+                try:
+                    sha1 = sha1 or content_hash(path)
+                except OSError:
+                    failed.add((d, name))
+                    continue
+                todo.append((d, sha1, path))
+            with index_lock:
+                # a copy or rename of a file that's measured already
+                todo = [t for t in todo if not index_db.execute(
+                    "SELECT 1 FROM loudness WHERE sha1 = ?", (t[1],)).fetchone()]
+            paths = [t[2] for t in todo]
+            results = None
+            if pool is not False and paths:
+                try:
+                    pool = pool or ProcessPoolExecutor(TAG_WORKERS)
+                    results = list(pool.map(measure_loudness, paths))
+                except (OSError, BrokenProcessPool) as e:
+                    print("Loudness pool error, measuring in-process:", e)
+                    pool = False
+            if results is None:
+                results = [measure_loudness(p) for p in paths]
+            with index_lock:
+                begin_write()
+                index_db.executemany("INSERT OR REPLACE INTO loudness VALUES (?,?,?)",
+                                     [(sha1, lufs, peak) for (_, sha1, _), (lufs, peak) in zip(todo, results)])
+                playlists = sorted({d for d, _, _ in rows if "/" not in d})
+                if playlists:
+                    log_changes([("tagged", pl, "") for pl in playlists])
+                set_meta("tag_claim", int(time.time()))
+                index_db.commit()
+                library_changed.notify_all()
+    finally:
+        if pool:
+            pool.shutdown()
+
+def rescan_if_due():
+    # without a watcher the index is only as fresh as the last mtime check
+    with index_lock:
+        if watcher_thread is None and time.monotonic() - last_rescan > RESCAN_INTERVAL:
+            rescan_index()
+
+def scan_playlists(tags=False):
+    # {playlist: [song names]}, or with tags {playlist: [{"name": ..., tag fields, "gain"}]}
+    with index_lock:
+        rescan_if_due()
+        if not tags:
+            rows = index_db.execute(
+                "SELECT dir, name FROM tracks WHERE instr(dir, '/') = 0 ORDER BY dir, name")
+            data = {}
+            for pl, song in rows:
+                data.setdefault(pl, []).append(song)
+            return data
+        rows = index_db.execute("""
+            SELECT t.dir, t.name, g.title, g.artist, g.album, g.duration, g.samplerate, g.bitrate,
+                l.lufs, l.peak, h.sha1
+            FROM tracks t LEFT JOIN tags g ON g.path = t.dir || '/' || t.name
+                AND g.size = t.size AND g.mtime_ns = t.mtime_ns""" + LOUDNESS_JOIN + """
+            WHERE instr(t.dir, '/') = 0 ORDER BY t.dir, t.name""")
+        data = {}
+        for row in rows:
+            data.setdefault(row[0], []).append(dict(name=row[1], **tag_fields(row[2:8]),
+                                                    **gain_field(*row[8:10]), **url_field(row[10])))
+        return data
+
+def playlist_counts():
+    with index_lock:
+        rescan_if_due()
+        return dict(index_db.execute(
+            "SELECT dir, count(*) FROM tracks WHERE instr(dir, '/') = 0 GROUP BY dir ORDER BY dir"))
+
+def library_etag():
+    return "lib-%d" % library_generation
+
+def library_response(build, extra=""):
+    # every library view is a pure function of the generation (plus `extra`
+    # for views that also show something outside the index), so they share
+    # one validator and idle clients only ever get 304s
+    etag = library_etag() + extra
+    resp = Response(status=304) if request.if_none_match.contains_weak(etag) else build()
+    resp.set_etag(etag)
+    resp.headers["X-Library-Generation"] = str(library_generation)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 @app.route("/api/playlists")
 def playlists():
-    return jsonify(scan_playlists())
+    # ?summary=1 gives {playlist: track count} for clients that page songs in,
+    # ?tags=1 gives each song as {"name", "title", "artist", "duration", ...}
+    ensure_watcher()
+    if request.args.get("summary"):
+        listing = playlist_counts
+    elif request.args.get("tags"):
+        listing = lambda: scan_playlists(tags=True)
+    else:
+        listing = scan_playlists
+    since = request.args.get("since", type=int)
+    if since is None:
+        return library_response(lambda: jsonify(listing()))
+    def delta():
+        d = library_delta(since)
+        if d is None:
+            d = {"generation": library_generation, "reset": True, "playlists": listing()}
+        return jsonify(d)
+    return library_response(delta)
+
+# ---------------- PAGINATION ----------------
+# /api/playlists/<pl>?limit=&sort=[-]name|size|mtime and either ?offset= (for
+# jumping around a scrollbar) or ?cursor= from the previous page's "next"
+# (keyset paging, cost doesn't grow with depth)
+PAGE_SORTS = {"name": "name", "size": "size", "mtime": "mtime_ns"}
+PAGE_LIMIT = 200
+PAGE_LIMIT_MAX = 1000
+
+def encode_cursor(key, name):
+    return base64.urlsafe_b64encode(json.dumps([key, name]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        key, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return key, name
+    except (ValueError, TypeError):
+        return None
+
+@app.route("/api/playlists/<pl>")
+def playlist_page(pl):
+    ensure_watcher()
+    sort = request.args.get("sort", "name")
+    col = PAGE_SORTS.get(sort.lstrip("-"))
+    if col is None:
+        return jsonify(error="sort must be one of " + ", ".join(PAGE_SORTS)), 400
+    order = "DESC" if sort.startswith("-") else "ASC"
+    limit = max(1, min(PAGE_LIMIT_MAX, request.args.get("limit", PAGE_LIMIT, type=int)))
+    cursor = request.args.get("cursor")
+    after = decode_cursor(cursor) if cursor else None
+    if cursor and after is None:
+        return jsonify(error="bad cursor"), 400
+    offset = max(0, request.args.get("offset", 0, type=int))
+
+    def build():
+        select = ("""SELECT t.name, t.size, t.mtime_ns, t.%s,
+                    g.title, g.artist, g.album, g.duration, g.samplerate, g.bitrate, l.lufs, l.peak, h.sha1
+                    FROM tracks t LEFT JOIN tags g ON g.path = t.dir || '/' || t.name
+                        AND g.size = t.size AND g.mtime_ns = t.mtime_ns""" % col + LOUDNESS_JOIN + """
+                    WHERE t.dir = ?""")
+        with index_lock:
+            total = index_db.execute("SELECT count(*) FROM tracks WHERE dir = ?", (pl,)).fetchone()[0]
+            if after:
+                rows = index_db.execute(
+                    select + " AND (t.%s, t.name) %s (?, ?) ORDER BY t.%s %s, t.name %s LIMIT ?"
+                    % (col, "<" if order == "DESC" else ">", col, order, order),
+                    (pl, after[0], after[1], limit)).fetchall()
+            else:
+                rows = index_db.execute(
+                    select + " ORDER BY t.%s %s, t.name %s LIMIT ? OFFSET ?" % (col, order, order),
+                    (pl, limit, offset)).fetchall()
+        items = [dict(name=r[0], size=r[1], mtime=r[2] // 10**9, **tag_fields(r[4:10]),
+                      **gain_field(*r[10:12]), **url_field(r[12])) for r in rows]
+        nxt = encode_cursor(rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+        return jsonify(playlist=pl, total=total, offset=None if after else offset,
+                       items=items, next=nxt, art=art_url(pl))
+    return library_response(build, art_state(pl))
+
+@app.route("/api/events")
+def library_events():
+    ensure_watcher()
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", library_generation, type=int)
+
+    def stream():
+        seen = since
+        while True:
+            with library_changed:
+                if library_generation == seen:
+                    library_changed.wait(timeout=15)
+                gen = library_generation
+            if gen == seen:
+                yield ": ping\n\n"
+                continue
+            delta = library_delta(seen) or {"generation": gen, "reset": True}
+            seen = delta["generation"]
+            yield "id: %d\nevent: library\ndata: %s\n\n" % (seen, json.dumps(delta))
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------------- SEARCH ----------------
+# in-memory inverted index over playlist names, file names and the title,
+# artist and album tags:
+#   token_docs: word -> track ids        (exact hits)
+#   vocab:      sorted words             (prefix hits via bisect)
+#   tri_words:  (trigram, word length) -> words   (typo-tolerant hits)
+# it follows the library through the change log, so whatever added or removed
+# tracks (watcher, uploads, another worker) is picked up on the next query,
+# and a playlist is re-read when its tags land ("tagged" changes)
+SEARCH_LIMIT = 20
+SEARCH_LIMIT_MAX = 200
+SEARCH_PREFIX_WORDS = 200  # a one-letter prefix shouldn't expand to the whole vocabulary
+SEARCH_FUZZY = 0.25        # least trigram overlap for a typo match, see SearchIndex.fuzzy
+SEARCH_TYPO_LENGTH = 2     # ...from a word at most this many letters longer or shorter
+WORD_RE = re.compile(r"[^\W_]+")
+SEARCH_ROWS = """
+    SELECT t.dir, t.name, g.title, g.artist, g.album
+    FROM tracks t LEFT JOIN tags g ON g.path = t.dir || '/' || t.name
+        AND g.size = t.size AND g.mtime_ns = t.mtime_ns"""
+
+def words_of(text):
+    return WORD_RE.findall(text.lower())
+
+def trigrams(word):
+    w = "  %s " % word
+    return {w[i:i + 3] for i in range(len(w) - 2)}
+
+class SearchIndex:
+    def __init__(self):
+        self.generation = None
+        self.docs = {}       # id -> (playlist, song, words)
+        self.ids = {}        # (playlist, song) -> id
+        self.next_id = 0
+        self.token_docs = {}
+        self.vocab = []
+        self.tri_words = {}
+        self.tri_count = {}  # word -> size of its trigram set
+
+    def add(self, pl, song, *tags):
+        # tags: title, artist, album (None where unknown)
+        if (pl, song) in self.ids:
+            return
+        doc = self.next_id
+        self.next_id += 1
+        words = words_of(pl) + words_of(os.path.splitext(song)[0])
+        for tag in tags:
+            if tag:
+                words += words_of(tag)
+        words = tuple(set(words))
+        self.docs[doc] = (pl, song, words)
+        self.ids[(pl, song)] = doc
+        for w in words:
+            docs = self.token_docs.get(w)
+            if docs is None:
+                docs = self.token_docs[w] = set()
+                bisect.insort(self.vocab, w)
+                grams = trigrams(w)
+                self.tri_count[w] = len(grams)
+                for t in grams:
+                    self.tri_words.setdefault((t, len(w)), set()).add(w)
+            docs.add(doc)
+
+    def remove(self, pl, song):
+        doc = self.ids.pop((pl, song), None)
+        if doc is None:
+            return
+        for w in self.docs.pop(doc)[2]:
+            docs = self.token_docs[w]
+            docs.discard(doc)
+            if not docs:
+                del self.token_docs[w]
+                del self.vocab[bisect.bisect_left(self.vocab, w)]
+                del self.tri_count[w]
+                for t in trigrams(w):
+                    self.tri_words[(t, len(w))].discard(w)
+
+    def rebuild(self):
+        self.__init__()
+        for row in index_db.execute(SEARCH_ROWS + " WHERE instr(t.dir, '/') = 0"):
+            self.add(*row)
+        self.generation = library_generation
+
+    def sync(self):
+        if self.generation == library_generation:
+            return
+        delta = library_delta(self.generation) if self.generation is not None else None
+        if delta is None:
+            self.rebuild()
+            return
+        for pl, song in delta["removed"]:
+            self.remove(pl, song)
+        for pl, song in delta["added"]:
+            self.add(pl, song)
+        for pl in delta["tagged"]:
+            for row in index_db.execute(SEARCH_ROWS + " WHERE t.dir = ?", (pl,)).fetchall():
+                self.remove(*row[:2])
+                self.add(*row)
+        self.generation = delta["generation"]
+
+    def matches(self, q):
+        # word -> how well it matches q: 3 exact, 2 prefix, <1 typo
+        found = {}
+        if q in self.token_docs:
+            found[q] = 3.0
+        i = bisect.bisect_left(self.vocab, q)
+        for w in self.vocab[i:i + SEARCH_PREFIX_WORDS]:
+            if not w.startswith(q):
+                break
+            found.setdefault(w, 2.0)
+        if len(q) >= 3 and q not in found and len(found) < 3:
+            found.update(self.fuzzy(q, found))
+        return found
+
+    def fuzzy(self, q, skip):
+        # words of about q's length whose trigram sets overlap q's (jaccard)
+        # at least as much as one wrong, missing or extra letter leaves:
+        # (n - 3) / (n + 3) for q's n trigrams, never under SEARCH_FUZZY. a
+        # word sharing `need` of q's trigrams must contain one of q's
+        # n - need + 1 rarest ones, so only those few buckets are ever walked
+        grams = trigrams(q)
+        n = len(grams)
+        cutoff = max(SEARCH_FUZZY, (n - 3) / (n + 3))
+        need = math.ceil(cutoff * n)
+        lengths = range(max(1, len(q) - SEARCH_TYPO_LENGTH), len(q) + SEARCH_TYPO_LENGTH + 1)
+        out = {}
+        for length in lengths:
+            buckets = sorted((self.tri_words.get((t, length), ()) for t in grams), key=len)
+            rare, common = buckets[:n - need + 1], buckets[n - need + 1:]
+            counts = {}
+            for b in rare:
+                for w in b:
+                    counts[w] = counts.get(w, 0) + 1
+            for w, shared in counts.items():
+                if w in skip:
+                    continue
+                shared += sum(1 for b in common if w in b)
+                score = shared / (n + self.tri_count[w] - shared)
+                if score >= cutoff:
+                    out[w] = score
+        return out
+
+    def search(self, query, limit):
+        scores = None
+        for q in set(words_of(query)):
+            hits = {}
+            # best match first, so each doc only takes the score of the
+            # first word that reaches it (set ops, a typo can reach most docs)
+            for w, score in sorted(self.matches(q).items(), key=lambda kv: -kv[1]):
+                hits.update(dict.fromkeys(self.token_docs[w].difference(hits), score))
+            if scores is None:
+                scores = hits
+            else:  # every query word has to match something
+                scores = {d: s + hits[d] for d, s in scores.items() if d in hits}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        best = heapq.nlargest(limit, scores.items(), key=lambda kv: (kv[1], -len(self.docs[kv[0]][1])))
+        return [{"playlist": self.docs[d][0], "song": self.docs[d][1], "score": round(s, 2)}
+                for d, s in best]
+
+search_index = SearchIndex()
+
+@app.route("/api/search")
+def search():
+    ensure_watcher()
+    q = request.args.get("q", "")
+    limit = max(1, min(SEARCH_LIMIT_MAX, request.args.get("limit", SEARCH_LIMIT, type=int)))
+    with index_lock:
+        search_index.sync()
+        results = search_index.search(q, limit)
+    return jsonify(query=q, results=results)
+
+# ---------------- SESSIONS ----------------
+# what a player is doing, kept server side so the client only ever asks for
+# the next few tracks instead of holding the whole library:
+#   POST   /api/session                     -> new session {id, ...state}
+#   GET    /api/session/<id>                -> state
+#   PATCH  /api/session/<id>                {shuffle: off|playlist|all, repeat: off|playlist, playlist}
+#   POST   /api/session/<id>/play           {playlist, song}, started by hand -> state + its gain
+#   POST   /api/session/<id>/advance        [{queue: i}] -> state + the track to play + gain
+#   POST   /api/session/<id>/back           -> state + the track before + gain
+#   GET    /api/session/<id>/next?count=N   -> upcoming tracks, nothing consumed
+#   POST   /api/session/<id>/queue          {playlist, song}
+#   DELETE /api/session/<id>/queue/<i>
+#   GET    /api/prefetch?session=<id>&count=N   -> what the service worker should
+#          have on the phone: current + next N tracks with size, etag and sha1
+# state is a json row in the index so every --serve worker sees the same one.
+# shuffle is a permutation of track numbers that is computed, never stored:
+# a seed, the track count when it started and how far along it we are
+SESSION_MAX_AGE = 30 * 24 * 3600  # untouched sessions are dropped after this
+SESSION_HISTORY = 100
+SESSION_QUEUE_MAX = 1000
+SESSION_QUEUE_SHOWN = 50
+SESSION_NEXT_MAX = 50
+PREFETCH_TRACKS = 5
+SHUFFLE_ROUNDS = 4
+MASK64 = (1 << 64) - 1
+
+def mix64(x):
+    # splitmix64 finaliser
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+def shuffle_index(pos, n, seed):
+    # pos-th entry of the permutation of range(n) picked by seed: a feistel
+    # network over the next even power of two, re-applied until it lands
+    # below n (under 4 rounds on average)
+    half = (max(2, (n - 1).bit_length()) + 1) // 2
+    mask = (1 << half) - 1
+    keys = [mix64(seed + r) for r in range(SHUFFLE_ROUNDS)]
+    x = pos
+    while True:
+        left, right = x >> half, x & mask
+        for k in keys:
+            left, right = right, left ^ (mix64(right ^ k) & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
+
+shuffle_layout = (None, [], [])  # (generation, playlists, running track counts)
+
+def library_layout():
+    global shuffle_layout
+    metrics_hit("shuffle_layout", shuffle_layout[0] == library_generation)
+    if shuffle_layout[0] != library_generation:
+        names, running, total = [], [], 0
+        for pl, c in index_db.execute("SELECT dir, count(*) FROM tracks WHERE instr(dir, '/') = 0 "
+                                      "GROUP BY dir ORDER BY dir"):
+            total += c
+            names.append(pl)
+            running.append(total)
+        shuffle_layout = (library_generation, names, running)
+    return shuffle_layout[1:]
+
+def nth_track(pl, i):
+    row = index_db.execute("SELECT name FROM tracks WHERE dir = ? ORDER BY name LIMIT 1 OFFSET ?",
+                           (pl, i)).fetchone()
+    return [pl, row[0]] if row else None
+
+def shuffle_track(state, i):
+    # i-th track in (playlist, name) order over the shuffle's scope; None if
+    # the library shrank since. tracks added or removed mid-shuffle shift the
+    # numbering, so a few may come up twice or not at all until the next pass
+    if state["shuffle"] == "playlist":
+        return nth_track(state["playlist"], i)
+    names, running = library_layout()
+    k = bisect.bisect_right(running, i)
+    if k >= len(names):
+        return None
+    return nth_track(names[k], i - (running[k - 1] if k else 0))
+
+def reshuffle(state):
+    state["seed"] = int.from_bytes(os.urandom(8), "big")
+    state["pos"] = 0
+    if state["shuffle"] == "all":
+        state["n"] = (library_layout()[1] or [0])[-1]
+    elif state["playlist"]:
+        state["n"] = index_db.execute("SELECT count(*) FROM tracks WHERE dir = ?",
+                                      (state["playlist"],)).fetchone()[0]
+    else:
+        state["n"] = 0
+
+def track_after(pl, name):
+    row = index_db.execute("SELECT name FROM tracks WHERE dir = ? AND name > ? ORDER BY name LIMIT 1",
+                           (pl, name)).fetchone()
+    return [pl, row[0]] if row else None
+
+def upcoming(state, count):
+    # the next `count` tracks once the queue is empty, and the state that
+    # playing them would leave behind
+    state = dict(state)
+    found = []
+    for _ in range(count * 4 + 8):  # skipped and wrapped shuffle slots
+        if len(found) >= count:
+            break
+        if state["shuffle"] != "off":
+            if state["pos"] >= state["n"]:
+                if state["repeat"] == "off" or not state["n"]:
+                    break
+                reshuffle(state)
+                continue
+            track = shuffle_track(state, shuffle_index(state["pos"], state["n"], state["seed"]))
+            state["pos"] += 1
+        else:
+            pl = state["playlist"]
+            if not pl:
+                break
+            track = track_after(pl, found[-1][1] if found else state["at"])
+            if track is None and state["repeat"] == "playlist":
+                track = track_after(pl, "")
+            if track is None:
+                break
+        if track:
+            found.append(track)
+    return found, state
+
+def played(state, track):
+    if state["current"]:
+        state["history"] = (state["history"] + [state["current"]])[-SESSION_HISTORY:]
+    state["current"] = track
+    if track[0] == state["playlist"]:
+        state["at"] = track[1]  # where in-order play carries on after queued tracks
+
+def json_body():
+    # the request's JSON object, {} when it has none; any other JSON is a 400
+    body = request.get_json(force=True, silent=True)
+    if body is None:
+        return {}
+    if not isinstance(body, dict):
+        abort(Response(json.dumps({"error": "expected a JSON object"}), 400, mimetype="application/json"))
+    return body
+
+def session_track(body):
+    pl, song = body.get("playlist"), body.get("song")
+    if not isinstance(pl, str) or not isinstance(song, str):
+        return None
+    if not index_db.execute("SELECT 1 FROM tracks WHERE dir = ? AND name = ?", (pl, song)).fetchone():
+        return None
+    return [pl, song]
+
+def save_session(id, state):
+    index_db.execute("INSERT OR REPLACE INTO sessions VALUES (?,?,?)",
+                     (id, json.dumps(state), time.time()))
+
+def session_view(id, state, **extra):
+    return jsonify(id=id, current=state["current"], playlist=state["playlist"],
+                   shuffle=state["shuffle"], repeat=state["repeat"],
+                   queue=state["queue"][:SESSION_QUEUE_SHOWN], queue_length=len(state["queue"]),
+                   history=state["history"][-SESSION_QUEUE_SHOWN:], **extra)
+
+def session_route(fn):
+    # runs fn(id, state, ...) inside one write transaction, so two workers
+    # can't interleave updates to a session; fn saves what it changed
+    def route(id, *args, **kwargs):
+        ensure_watcher()
+        rescan_if_due()
+        with index_lock:
+            begin_write()
+            try:
+                row = index_db.execute("SELECT state FROM sessions WHERE id = ?", (id,)).fetchone()
+                if row is None:
+                    return jsonify(error="no such session"), 404
+                return fn(id, json.loads(row[0]), *args, **kwargs)
+            finally:
+                index_db.commit()
+    route.__name__ = fn.__name__
+    return route
+
+@app.route("/api/session", methods=["POST"])
+def session_start():
+    id = os.urandom(12).hex()
+    state = {"queue": [], "history": [], "current": None, "playlist": None, "at": "",
+             "shuffle": "off", "repeat": "off", "seed": 0, "n": 0, "pos": 0}
+    with index_lock:
+        index_db.execute("DELETE FROM sessions WHERE touched < ?", (time.time() - SESSION_MAX_AGE,))
+        save_session(id, state)
+        index_db.commit()
+    return session_view(id, state)
+
+@app.route("/api/session/<id>", methods=["GET"])
+@session_route
+def session_get(id, state):
+    return session_view(id, state)
+
+@app.route("/api/session/<id>", methods=["PATCH"])
+@session_route
+def session_update(id, state):
+    body = json_body()
+    if body.get("shuffle", state["shuffle"]) not in ("off", "playlist", "all"):
+        return jsonify(error="shuffle must be off, playlist or all"), 400
+    if body.get("repeat", state["repeat"]) not in ("off", "playlist"):
+        return jsonify(error="repeat must be off or playlist"), 400
+    if "playlist" in body and not isinstance(body["playlist"], str):
+        return jsonify(error="playlist must be a string"), 400
+    moved = any(k in body and body[k] != state[k] for k in ("shuffle", "playlist"))
+    if "playlist" in body and body["playlist"] != state["playlist"]:
+        state["at"] = ""
+    for k in ("shuffle", "repeat", "playlist"):
+        state[k] = body.get(k, state[k])
+    if moved and state["shuffle"] != "off":
+        reshuffle(state)
+    save_session(id, state)
+    return session_view(id, state)
+
+@app.route("/api/session/<id>/play", methods=["POST"])
+@session_route
+def session_play(id, state):
+    track = session_track(json_body())
+    if track is None:
+        return jsonify(error="playlist and song of an indexed track required"), 400
+    if state["playlist"] != track[0]:
+        state["playlist"] = track[0]
+        if state["shuffle"] == "playlist":
+            reshuffle(state)
+    played(state, track)
+    save_session(id, state)
+    return session_view(id, state, **track_media(track))
+
+@app.route("/api/session/<id>/advance", methods=["POST"])
+@session_route
+def session_advance(id, state):
+    i = json_body().get("queue", 0)
+    if state["queue"]:
+        if not isinstance(i, int) or not 0 <= i < len(state["queue"]):
+            return jsonify(error="no such queue entry"), 404
+        track = state["queue"].pop(i)
+    else:
+        found, after = upcoming(state, 1)
+        track = found[0] if found else None
+        for k in ("seed", "n", "pos"):
+            state[k] = after[k]
+    if track:
+        played(state, track)
+    save_session(id, state)
+    return session_view(id, state, track=track, **track_media(track))
+
+@app.route("/api/session/<id>/back", methods=["POST"])
+@session_route
+def session_back(id, state):
+    track = state["history"].pop() if state["history"] else None
+    if track:
+        state["current"] = track
+    save_session(id, state)
+    return session_view(id, state, track=track, **track_media(track))
+
+@app.route("/api/session/<id>/next")
+@session_route
+def session_next(id, state):
+    count = max(1, min(SESSION_NEXT_MAX, request.args.get("count", 5, type=int)))
+    tracks = state["queue"][:count]
+    if len(tracks) < count:
+        tracks += upcoming(state, count - len(tracks))[0]
+    return jsonify(id=id, tracks=tracks, queue_length=len(state["queue"]))
+
+@app.route("/api/session/<id>/queue", methods=["POST"])
+@session_route
+def session_enqueue(id, state):
+    track = session_track(json_body())
+    if track is None:
+        return jsonify(error="playlist and song of an indexed track required"), 400
+    if len(state["queue"]) >= SESSION_QUEUE_MAX:
+        return jsonify(error="queue is full"), 409
+    state["queue"].append(track)
+    save_session(id, state)
+    return session_view(id, state)
+
+@app.route("/api/session/<id>/queue/<int:i>", methods=["DELETE"])
+@session_route
+def session_dequeue(id, state, i):
+    if not 0 <= i < len(state["queue"]):
+        return jsonify(error="no such queue entry"), 404
+    state["queue"].pop(i)
+    save_session(id, state)
+    return session_view(id, state)
+
+hash_pool = ThreadPoolExecutor(1, thread_name_prefix="hash")
+hashing = set()
+
+def hash_later(path):
+    # a cold sha1 reads the whole file, so the manifest never waits for one;
+    # it shows up in the next manifest instead
+    def run():
+        try:
+            content_hash(path)
+        except OSError:
+            pass
+        finally:
+            hashing.discard(path)
+    if path not in hashing:
+        hashing.add(path)
+        hash_pool.submit(run)
+
+@app.route("/api/prefetch")
+def prefetch():
+    return prefetch_manifest(request.args.get("session", ""))
+
+@session_route
+def prefetch_manifest(id, state):
+    count = max(1, min(SESSION_NEXT_MAX, request.args.get("count", PREFETCH_TRACKS, type=int)))
+    tracks = state["queue"][:count]
+    if len(tracks) < count:
+        tracks += upcoming(state, count - len(tracks))[0]
+    items = []
+    for i, (pl, song) in enumerate(([state["current"]] if state["current"] else []) + tracks):
+        path = safe_join(MUSIC, pl, song)
+        try:
+            st = os.stat(path)
+        except (OSError, TypeError):
+            continue
+        sha1 = known_hash(pl + "/" + song, st)
+        if sha1 is None:
+            hash_later(path)
+        items.append({"playlist": pl, "song": song, "current": i == 0 and state["current"] is not None,
+                      "url": "/m/" + sha1 if sha1 else music_url(pl, song),
+                      "size": st.st_size, "etag": file_etag(st),
+                      "sha1": sha1})
+    return jsonify(session=id, tracks=items)
+
+# ---------------- STREAMING ----------------
+# Range/206 (single and multipart), If-Range and conditional GETs for audio.
+# ranges that run to the end of the file go through the server's
+# wsgi.file_wrapper (sendfile under gunicorn), everything else is sliced out
+# of an mmap, so a connection never holds more than STREAM_CHUNK in Python
+STREAM_CHUNK = 256 * 1024
+MAX_RANGES = 16  # more parts than this is a scanner, not a player: send 200
+mimetypes.add_type("audio/flac", ".flac")
+mimetypes.add_type("audio/ogg", ".ogg")
+
+class MmapRanges:
+    def __init__(self, f, size, parts, boundary=None, ctype=None):
+        self.f = f
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.size = size
+        self.parts = parts
+        self.boundary = boundary
+        self.ctype = ctype
+
+    def __iter__(self):
+        for start, stop in self.parts:
+            if self.boundary:
+                yield part_header(self.boundary, self.ctype, start, stop, self.size)
+            for pos in range(start, stop, STREAM_CHUNK):
+                yield self.map[pos:min(pos + STREAM_CHUNK, stop)]
+        if self.boundary:
+            yield ("\r\n--%s--\r\n" % self.boundary).encode()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
+
+def part_header(boundary, ctype, start, stop, size):
+    return ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+            % (boundary, ctype, start, stop - 1, size)).encode()
+
+def resolve_ranges(rng, size):
+    parts = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(0, size + start), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            parts.append([start, stop])
+    parts.sort()
+    merged = []
+    for start, stop in parts:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return [tuple(p) for p in merged]
+
+def if_range_matches(etag, mtime):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(mtime)
+    return True
+
+def file_etag(st):
+    return "%x-%x" % (st.st_size, st.st_mtime_ns)
+
+def stream_file(path, ctype=None):
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return "", 404
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    etag = file_etag(st)
+    ctype = ctype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"ETag": quote_etag(etag), "Last-Modified": http_date(st.st_mtime),
+               "Accept-Ranges": "bytes"}
+
+    ims = request.if_modified_since
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and ims and int(st.st_mtime) <= ims.timestamp()):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    rng = request.range
+    parts = None
+    if rng is not None and rng.units == "bytes" and len(rng.ranges) <= MAX_RANGES \
+            and if_range_matches(etag, st.st_mtime):
+        parts = resolve_ranges(rng, size)
+        if not parts:
+            f.close()
+            headers["Content-Range"] = "bytes */%d" % size
+            return Response(status=416, headers=headers)
+
+    if parts is None or parts == [(0, size)]:
+        status, parts = 200, [(0, size)]
+    else:
+        status = 206
+
+    if len(parts) == 1:
+        start, stop = parts[0]
+        headers["Content-Length"] = str(stop - start)
+        if status == 206:
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+        if request.method == "HEAD":
+            f.close()
+            return Response(status=status, headers=headers, content_type=ctype)
+        if stop == size and "wsgi.file_wrapper" in request.environ:
+            f.seek(start)
+            body = request.environ["wsgi.file_wrapper"](f, STREAM_CHUNK)
+        else:
+            body = MmapRanges(f, size, parts)
+        return Response(body, status=status, headers=headers, content_type=ctype,
+                        direct_passthrough=True)
+
+    boundary = os.urandom(12).hex()
+    length = sum(len(part_header(boundary, ctype, a, b, size)) + b - a for a, b in parts)
+    length += len("\r\n--%s--\r\n" % boundary)
+    headers["Content-Length"] = str(length)
+    body = MmapRanges(f, size, parts, boundary, ctype)
+    if request.method == "HEAD":
+        body.close()
+        body = None
+    return Response(body, status=206, headers=headers, direct_passthrough=True,
+                    content_type="multipart/byteranges; boundary=" + boundary)
+
+# ---------------- TRANSCODING ----------------
+# ?format=ogg&quality=N re-encodes with soundfile on a small worker pool.
+# output is keyed by the source's content hash and quality, streamed to the
+# client while it is being written, and kept in TRANSCODE_DIR until the
+# cache grows past TRANSCODE_CACHE_BYTES (least recently served goes first).
+# a second request for a track that is still encoding tails the same file
+TRANSCODE_DIR = os.path.join(CACHE, "transcode")
+TRANSCODE_CACHE_BYTES = 2 * 1024**3
+TRANSCODE_WORKERS = 2
+TRANSCODE_FORMATS = {"ogg": ("OGG", "VORBIS", "audio/ogg")}
+os.makedirs(TRANSCODE_DIR, exist_ok=True)
+
+transcode_pool = ThreadPoolExecutor(TRANSCODE_WORKERS, thread_name_prefix="transcode")
+transcode_jobs = {}  # cache file name -> TranscodeJob still encoding
+transcode_lock = threading.Lock()
+
+class TranscodeJob:
+    def __init__(self, src, dest, fmt, quality):
+        self.src = src
+        self.dest = dest
+        self.part = "%s.%d.part" % (dest, os.getpid())  # workers may encode the same track
+        self.fmt = fmt
+        self.quality = quality
+        self.done = False
+        self.error = None
+        self.progress = threading.Condition()
+        open(self.part, "wb").close()
+
+    def run(self):
+        container, subtype, _ = TRANSCODE_FORMATS[self.fmt]
+        try:
+            info = sf.info(self.src)
+            with sf.SoundFile(self.part, "w", info.samplerate, info.channels,
+                              format=container, subtype=subtype,
+                              compression_level=1 - self.quality / 10) as out:
+                for block in sf.blocks(self.src, blocksize=65536, dtype="float32", always_2d=True):
+                    out.write(block)
+                    with self.progress:
+                        self.progress.notify_all()
+        except Exception as e:
+            print("Transcode error:", self.src, e)
+            self.error = e
+        # the job goes away in the same step as its part file, so a request
+        # either finds the job (and can still open the part) or the result
+        with transcode_lock:
+            transcode_jobs.pop(os.path.basename(self.dest), None)
+            try:
+                if self.error is None:
+                    os.replace(self.part, self.dest)
+                else:
+                    os.remove(self.part)
+            except OSError as e:
+                print("Transcode error:", self.src, e)
+                self.error = self.error or e
+        with self.progress:
+            self.done = True
+            self.progress.notify_all()
+        evict_transcodes()
+
+    def follow(self, f):
+        # yields the encoder's output as it lands on disk until it finishes
+        with f:
+            while True:
+                chunk = f.read(STREAM_CHUNK)
+                if chunk:
+                    yield chunk
+                    continue
+                with self.progress:
+                    if self.done:
+                        if self.error is not None:
+                            # break off the chunked response instead of
+                            # ending it cleanly, so the client sees a failure
+                            raise IOError("transcode failed: %s" % self.error)
+                        chunk = f.read()
+                        if chunk:
+                            yield chunk
+                        return
+                    self.progress.wait(1.0)
+
+def cacheable(resp, cache_control):
+    # sets Cache-Control on a successful stream_file() response
+    if cache_control and isinstance(resp, Response) and resp.status_code in (200, 206, 304):
+        resp.headers["Cache-Control"] = cache_control
+    return resp
+
+def evict_transcodes():
+    entries = []
+    with os.scandir(TRANSCODE_DIR) as it:
+        for e in it:
+            if not e.name.endswith(".part"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= TRANSCODE_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def transcoded(path, fmt, quality, cache_control=None):
+    # cache_control goes on a finished cache file only; a stream still being
+    # encoded may yet fail, so it always stays no-cache
+    if sf is None:
+        return "transcoding needs the soundfile package", 501
+    if fmt not in TRANSCODE_FORMATS:
+        return "unsupported format", 400
+    quality = max(0, min(10, quality))
+    name = "%s-q%d.%s" % (content_hash(path), quality, fmt)
+    dest = os.path.join(TRANSCODE_DIR, name)
+    with transcode_lock:
+        job = transcode_jobs.get(name)
+        metrics_hit("transcode", job is not None or os.path.exists(dest))
+        if job is None:
+            if os.path.exists(dest):
+                os.utime(dest)  # mtime doubles as the LRU clock
+                return cacheable(stream_file(dest, TRANSCODE_FORMATS[fmt][2]), cache_control)
+            job = transcode_jobs[name] = TranscodeJob(path, dest, fmt, quality)
+            f = open(job.part, "rb")
+            transcode_pool.submit(job.run)
+        else:
+            f = open(job.part, "rb")
+    return Response(job.follow(f), mimetype=TRANSCODE_FORMATS[fmt][2],
+                    headers={"Cache-Control": "no-cache"})
 
 @app.route("/music/<pl>/<song>")
 def music(pl, song):
-    return send_from_directory(os.path.join(MUSIC, pl), song)
+    path = safe_join(MUSIC, pl, song)
+    if path is None or not os.path.isfile(path):
+        return "", 404
+    fmt = request.args.get("format")
+    if fmt:
+        return transcoded(path, fmt.lower(), request.args.get("quality", 5, type=int))
+    return stream_file(path)
+
+# ---------------- ALBUM ART ----------------
+# covers are resized once into THUMB_SIZES square variants in THUMB_DIR,
+# named after the cover's path and mtime so a new cover gets new thumbnails.
+# Playerlocal reads (and fills) the same folder for its 300px album image
+ART_NAMES = ("cover.jpg","folder.jpg","cover.png","folder.png")
+THUMB_DIR = os.path.join(CACHE, "thumbs")
+THUMB_SIZES = (96, 300, 600)
+ART_MAX_AGE = 7 * 24 * 3600
+os.makedirs(THUMB_DIR, exist_ok=True)
+
+art_sources = {}  # playlist -> (folder mtime_ns, cover path or None)
+thumb_lock = threading.Lock()
+
+def find_art(pl):
+    folder = safe_join(MUSIC, pl)
+    if folder is None:
+        return None
+    try:
+        mtime_ns = os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+    cached = art_sources.get(pl)
+    metrics_hit("art_lookup", bool(cached and cached[0] == mtime_ns))
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+    path = None
+    for f in ART_NAMES:
+        if os.path.isfile(os.path.join(folder, f)):
+            path = os.path.join(folder, f)
+            break
+    art_sources[pl] = (mtime_ns, path)
+    return path
+
+def thumb_ext():
+    return "webp" if features.check("webp") else "jpg"
+
+def thumb_prefix(src):
+    rel = os.path.relpath(src, MUSIC).replace(os.sep, "/")
+    return hashlib.sha1(rel.encode()).hexdigest()[:16]
+
+def make_thumbs(src, mtime_ns):
+    prefix = thumb_prefix(src)
+    ext = thumb_ext()
+    img = ImageOps.exif_transpose(Image.open(src)).convert("RGB")
+    for size in THUMB_SIZES:
+        dest = os.path.join(THUMB_DIR, "%s-%x-%d.%s" % (prefix, mtime_ns, size, ext))
+        tmp = "%s.%d.tmp" % (dest, os.getpid())
+        ImageOps.fit(img, (size, size), Image.LANCZOS).save(
+            tmp, "WEBP" if ext == "webp" else "JPEG", quality=82)
+        os.replace(tmp, dest)
+    # thumbnails of an older version of this cover
+    for f in os.listdir(THUMB_DIR):
+        if f.startswith(prefix + "-") and not f.startswith("%s-%x-" % (prefix, mtime_ns)):
+            try:
+                os.remove(os.path.join(THUMB_DIR, f))
+            except OSError:
+                pass
+
+def album_thumb(src, size):
+    size = next((s for s in THUMB_SIZES if s >= size), THUMB_SIZES[-1])
+    mtime_ns = os.stat(src).st_mtime_ns
+    name = "%s-%x-%d." % (thumb_prefix(src), mtime_ns, size)
+    for ext in ("webp", "jpg"):
+        if os.path.exists(os.path.join(THUMB_DIR, name + ext)):
+            metrics_hit("thumbs", True)
+            return os.path.join(THUMB_DIR, name + ext)
+    metrics_hit("thumbs", False)
+    with thumb_lock:
+        if not os.path.exists(os.path.join(THUMB_DIR, name + thumb_ext())):
+            make_thumbs(src, mtime_ns)
+    return os.path.join(THUMB_DIR, name + thumb_ext())
 
 @app.route("/art/<pl>")
 def art(pl):
-    for f in ("cover.jpg","folder.jpg","cover.png"):
-        p = os.path.join(MUSIC, pl, f)
-        if os.path.exists(p):
-            return send_from_directory(os.path.join(MUSIC, pl), f)
-    return "", 404
+    src = find_art(pl)
+    if src is None:
+        return "", 404
+    size = request.args.get("size", type=int)
+    if size and Image is not None:
+        try:
+            src = album_thumb(src, size)
+        except Exception as e:
+            print("Thumbnail error:", src, e)
+    resp = stream_file(src)
+    if isinstance(resp, Response):
+        resp.headers["Cache-Control"] = "public, max-age=%d" % ART_MAX_AGE
+    return resp
+
+# ---------------- CONTENT URLS ----------------
+# /m/<sha1> serves whatever library file has that content hash (see
+# content_hash), so its URL changes exactly when its bytes do and browsers
+# and the service worker can keep it forever without revalidating. tracks
+# get one once their hash is in the index (the loudness pass hashes every
+# track), until then clients use /music/<pl>/<song>. covers are hashed on
+# first use; /m/<cover sha1>?size= is its thumbnail, ?format= works as on /music
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+def music_url(pl, song):
+    return "/music/%s/%s" % (urllib.parse.quote(pl), urllib.parse.quote(song))
+
+def url_field(sha1):
+    return {"url": "/m/" + sha1} if sha1 else {}
+
+def track_sha1(pl, song):
+    with index_lock:
+        row = index_db.execute("""
+            SELECT h.sha1 FROM tracks t JOIN hashes h ON h.path = t.dir || '/' || t.name
+                AND h.size = t.size AND h.mtime_ns = t.mtime_ns
+            WHERE t.dir = ? AND t.name = ?""", (pl, song)).fetchone()
+    return row[0] if row else None
+
+def art_url(pl):
+    src = find_art(pl)
+    if src is None:
+        return None
+    try:
+        return "/m/" + content_hash(src)
+    except OSError:
+        return "/art/" + urllib.parse.quote(pl)
+
+def art_state(pl):
+    # the page's "art" url follows the cover's bytes, which a cover
+    # rewritten in place changes without touching the folder (so without a
+    # new generation); its size and mtime go into the page's ETag instead
+    src = find_art(pl)
+    try:
+        st = os.stat(src) if src else None
+    except OSError:
+        st = None
+    return "-art-%x-%x" % (st.st_size, st.st_mtime_ns) if st else ""
+
+def track_media(track):
+    # what a client needs to play `track`: gain, audio url and cover url
+    if not track:
+        return {"gain": None}
+    pl, song = track
+    sha1 = track_sha1(pl, song)
+    return {"gain": track_gain(pl, song), "url": "/m/" + sha1 if sha1 else music_url(pl, song),
+            "art": art_url(pl)}
+
+@app.route("/m/<sha1>")
+def media(sha1):
+    if not re.fullmatch(r"[0-9a-f]{40}", sha1):
+        return "", 404
+    with index_lock:
+        rows = index_db.execute("SELECT path, size, mtime_ns FROM hashes WHERE sha1 = ?", (sha1,)).fetchall()
+    path = None
+    for rel, size, mtime_ns in rows:
+        candidate = safe_join(MUSIC, *rel.split("/"))
+        try:
+            st = os.stat(candidate)
+        except (OSError, TypeError):
+            continue
+        if st.st_size == size and st.st_mtime_ns == mtime_ns:
+            path = candidate
+            break
+    if path is None:
+        return "", 404
+    fmt = request.args.get("format")
+    if fmt:
+        return transcoded(path, fmt.lower(), request.args.get("quality", 5, type=int), IMMUTABLE)
+    size = request.args.get("size", type=int)
+    if size and Image is not None and os.path.basename(path).lower() in ART_NAMES:
+        try:
+            path = album_thumb(path, size)
+        except Exception as e:
+            print("Thumbnail error:", path, e)
+    return cacheable(stream_file(path), IMMUTABLE)
+
+# ---------------- PEAKS ----------------
+# waveform envelope of a track: min/max/rms of the mono mix per window of
+# 1/PEAKS_RATE s, built with soundfile.blocks so only one block is ever in
+# memory. stored as PEAKS_DIR/<sha1(rel path)[:16]>-<mtime_ns>.peaks:
+#   "BRKPEAKS" + <u32 samplerate> + <u32 samples per window>, then int16 rows
+#   of (min, max, rms) scaled to +-32767
+# the same files are read (with np.memmap) and written by Playerlocal
+PEAKS_DIR = os.path.join(CACHE, "peaks")
+PEAKS_RATE = 50  # windows per second
+PEAKS_MAGIC = b"BRKPEAKS"
+PEAKS_HEADER = 16
+PEAKS_WIDTH_MAX = 4096
+os.makedirs(PEAKS_DIR, exist_ok=True)
+
+peaks_pool = ThreadPoolExecutor(2, thread_name_prefix="peaks")
+peaks_jobs = {}  # peaks file name -> Future still building it
+peaks_lock = threading.Lock()
+
+def peaks_name(path, mtime_ns):
+    rel = os.path.relpath(path, MUSIC).replace(os.sep, "/")
+    return "%s-%x.peaks" % (hashlib.sha1(rel.encode()).hexdigest()[:16], mtime_ns)
+
+def reduce_windows(mono, window):
+    # (n, 3) int16 min/max/rms for whole windows of a 1-d float block
+    w = mono[:len(mono) // window * window].reshape(-1, window)
+    rows = np.stack([w.min(axis=1), w.max(axis=1), np.sqrt((w * w).mean(axis=1))], axis=1)
+    return np.clip(rows * 32767, -32767, 32767).astype("<i2")
+
+def build_peaks(src, dest):
+    info = sf.info(src)
+    window = max(1, info.samplerate // PEAKS_RATE)
+    tmp = "%s.%d.tmp" % (dest, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(PEAKS_MAGIC + struct.pack("<II", info.samplerate, window))
+        rest = np.zeros(0, "float32")
+        for block in sf.blocks(src, blocksize=window * 1024, dtype="float32", always_2d=True):
+            mono = np.concatenate([rest, block.mean(axis=1)])
+            out.write(reduce_windows(mono, window).tobytes())
+            rest = mono[len(mono) // window * window:]
+        if len(rest):
+            out.write(reduce_windows(rest, len(rest)).tobytes())
+    os.replace(tmp, dest)
+    # peaks of an older version of this file
+    prefix = os.path.basename(dest).split("-")[0] + "-"
+    for f in os.listdir(PEAKS_DIR):
+        if f.startswith(prefix) and f != os.path.basename(dest) and not f.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(PEAKS_DIR, f))
+            except OSError:
+                pass
+
+def track_peaks(path):
+    # path of the .peaks file, built (once, even with concurrent callers) if needed
+    dest = os.path.join(PEAKS_DIR, peaks_name(path, os.stat(path).st_mtime_ns))
+    metrics_hit("peaks", os.path.exists(dest))
+    if os.path.exists(dest):
+        return dest
+    name = os.path.basename(dest)
+    with peaks_lock:
+        job = peaks_jobs.get(name)
+        if job is None:
+            job = peaks_jobs[name] = peaks_pool.submit(build_peaks, path, dest)
+            job.add_done_callback(lambda _: peaks_jobs.pop(name, None))
+    job.result()
+    return dest
+
+def read_peaks(dest):
+    # (samplerate, samples per window, (n, 3) int16 memmap)
+    with open(dest, "rb") as f:
+        header = f.read(PEAKS_HEADER)
+    if header[:8] != PEAKS_MAGIC:
+        raise ValueError("not a peaks file: " + dest)
+    samplerate, window = struct.unpack("<II", header[8:])
+    if os.path.getsize(dest) == PEAKS_HEADER:
+        return samplerate, window, np.zeros((0, 3), "<i2")
+    return samplerate, window, np.memmap(dest, "<i2", "r", offset=PEAKS_HEADER).reshape(-1, 3)
+
+def peaks_columns(rows, width):
+    # squeeze the windows into `width` columns for drawing, as -1..1 floats
+    if len(rows) == 0:
+        return [], [], []
+    edges = np.linspace(0, len(rows), min(width, len(rows)) + 1).astype(int)
+    data = rows.astype("float32") / 32767
+    mins = np.minimum.reduceat(data[:, 0], edges[:-1])
+    maxs = np.maximum.reduceat(data[:, 1], edges[:-1])
+    rms = np.sqrt(np.add.reduceat(data[:, 2] ** 2, edges[:-1]) / np.diff(edges))
+    return [[round(float(v), 3) for v in a] for a in (mins, maxs, rms)]
+
+@app.route("/api/peaks/<pl>/<song>")
+def peaks(pl, song):
+    # the raw .peaks file, or ?width=N for {duration, min, max, rms} with N columns
+    if sf is None or np is None:
+        return jsonify(error="peaks need the soundfile and numpy packages"), 501
+    path = safe_join(MUSIC, pl, song)
+    if path is None or not os.path.isfile(path):
+        return "", 404
+    try:
+        dest = track_peaks(path)
+    except Exception as e:
+        print("Peaks error:", path, e)
+        return jsonify(error="could not read " + song), 415
+    width = request.args.get("width", type=int)
+    if not width:
+        return stream_file(dest, "application/octet-stream")
+    samplerate, window, rows = read_peaks(dest)
+    mins, maxs, rms = peaks_columns(rows, max(1, min(PEAKS_WIDTH_MAX, width)))
+    resp = jsonify(duration=round(len(rows) * window / samplerate, 3) if samplerate else 0,
+                   min=mins, max=maxs, rms=rms)
+    resp.set_etag(os.path.basename(dest) + "-%d" % width)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# ---------------- UPLOADS ----------------
+# resumable, chunked uploads:
+#   POST /api/uploads {playlist, name, size}  -> {id, offset} (or {status: "exists"})
+#   PUT  /api/uploads/<id> + Content-Range    -> {offset, status}
+#   GET  /api/uploads/<id>                    -> {offset}
+# chunks are streamed straight from the socket into UPLOAD_DIR/<id>.part while
+# being hashed; a finished file that is already in the library is dropped,
+# anything else is renamed into MUSIC/<playlist> and added to the index.
+# asking for the same playlist/name/size again resumes the same session
+UPLOAD_DIR = os.path.join(CACHE, "uploads")
+UPLOAD_SESSION_MAX_AGE = 7 * 24 * 3600
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+upload_sessions = {}
+upload_lock = threading.Lock()
+
+class UploadSession:
+    def __init__(self, id, playlist, name, size):
+        self.id = id
+        self.playlist = playlist
+        self.name = name
+        self.size = size
+        self.part = os.path.join(UPLOAD_DIR, id + ".part")
+        self.sha1 = hashlib.sha1()
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, id):
+        # a session from before a restart: re-hash what already arrived
+        with open(os.path.join(UPLOAD_DIR, id + ".json")) as f:
+            meta = json.load(f)
+        session = cls(id, meta["playlist"], meta["name"], meta["size"])
+        with open(session.part, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                session.sha1.update(block)
+                session.offset += len(block)
+        return session
+
+    def save(self):
+        with open(os.path.join(UPLOAD_DIR, self.id + ".json"), "w") as f:
+            json.dump({"playlist": self.playlist, "name": self.name, "size": self.size}, f)
+        open(self.part, "ab").close()
+
+    def write(self, stream, length):
+        with open(self.part, "ab") as f:
+            while length > 0:
+                chunk = stream.read(min(STREAM_CHUNK, length))
+                if not chunk:
+                    break
+                f.write(chunk)
+                self.sha1.update(chunk)
+                self.offset += len(chunk)
+                length -= len(chunk)
+
+    def finish(self):
+        sha1 = self.sha1.hexdigest()
+        dest = safe_join(MUSIC, self.playlist, self.name)
+        if find_duplicate(self.size, sha1):
+            os.remove(self.part)
+            status = "duplicate"
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(self.part, dest)
+            remember_hash(dest, sha1)
+            index_add_file(self.playlist, self.name)
+            status = "done"
+        self.discard()
+        return status
+
+    def discard(self):
+        with upload_lock:
+            upload_sessions.pop(self.id, None)
+        for f in (self.part, os.path.join(UPLOAD_DIR, self.id + ".json")):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+def session_key(playlist, name, size):
+    return hashlib.sha1(("%s/%s/%d" % (playlist, name, size)).encode()).hexdigest()
+
+def get_upload(id):
+    with upload_lock:
+        session = upload_sessions.get(id)
+        if session is not None and not session.lock.locked():
+            try:
+                if os.path.getsize(session.part) != session.offset:
+                    session = None  # another worker process took chunks since
+            except OSError:
+                session = None
+        if session is None and os.path.exists(os.path.join(UPLOAD_DIR, id + ".json")):
+            try:
+                session = upload_sessions[id] = UploadSession.load(id)
+            except (OSError, ValueError, KeyError):
+                session = None
+        return session
+
+def expire_uploads():
+    cutoff = time.time() - UPLOAD_SESSION_MAX_AGE
+    for f in os.listdir(UPLOAD_DIR):
+        p = os.path.join(UPLOAD_DIR, f)
+        try:
+            if os.path.getmtime(p) < cutoff:
+                os.remove(p)
+        except OSError:
+            pass
+
+@app.route("/api/uploads", methods=["POST"])
+def upload_start():
+    body = json_body()
+    playlist, name, size = body.get("playlist"), body.get("name"), body.get("size")
+    if not isinstance(playlist, str) or not isinstance(name, str) or not playlist or not name \
+            or not isinstance(size, int) or size < 0:
+        return jsonify(error="playlist, name and size are required"), 400
+    dest = safe_join(MUSIC, playlist, name)
+    # one file straight inside one playlist folder, like the scan expects
+    if dest is None or "/" in playlist.strip("/") or playlist.startswith(".") \
+            or "/" in name or name.startswith("."):
+        return jsonify(error="bad playlist or file name"), 400
+    if os.path.isfile(dest) and os.path.getsize(dest) == size:
+        return jsonify(status="exists")
+    expire_uploads()
+    id = session_key(playlist, name, size)
+    session = get_upload(id)
+    if session is None:
+        session = UploadSession(id, playlist, name, size)
+        session.save()
+        with upload_lock:
+            session = upload_sessions.setdefault(id, session)
+    if size == 0:
+        with session.lock:
+            return jsonify(id=id, offset=0, status=session.finish())
+    return jsonify(id=id, offset=session.offset)
+
+@app.route("/api/uploads/<id>", methods=["GET"])
+def upload_status(id):
+    session = get_upload(id)
+    if session is None:
+        return jsonify(error="no such upload"), 404
+    return jsonify(id=id, offset=session.offset, size=session.size)
+
+@app.route("/api/uploads/<id>", methods=["PUT"])
+def upload_chunk(id):
+    session = get_upload(id)
+    if session is None:
+        return jsonify(error="no such upload"), 404
+    crange = parse_content_range_header(request.headers.get("Content-Range"))
+    if crange is None or crange.start is None or crange.length != session.size:
+        return jsonify(error="Content-Range: bytes start-end/size required"), 400
+    if not session.lock.acquire(blocking=False):
+        return jsonify(error="upload already in progress", offset=session.offset), 409
+    try:
+        if crange.start != session.offset:
+            return jsonify(error="expected offset", offset=session.offset), 409
+        session.write(request.stream, crange.stop - crange.start)
+        if session.offset < session.size:
+            return jsonify(offset=session.offset, status="partial")
+        return jsonify(offset=session.offset, status=session.finish())
+    finally:
+        session.lock.release()
 
 @app.route("/upload", methods=["POST"])
 def upload():
@@ -45,8 +2037,177 @@ def upload():
     os.makedirs(dest, exist_ok=True)
     for f in files:
         f.save(os.path.join(dest, f.filename))
+        index_add_file(playlist, f.filename)
     return "", 204
 
+# ---------------- ARCHIVE IMPORT ----------------
+# .zip/.tar(.gz/.bz2/.xz) straight into the library, one member at a time:
+#   POST /api/import {path}           -> import an archive already on this machine
+#   POST /api/import {name, size}     -> {id}, then PUT /api/import/<id> with the archive
+#   GET  /api/import/<id>             -> progress
+# a member's folder inside the archive becomes its playlist (files at the top
+# go to `playlist`, default the archive name). only audio and cover art are
+# kept. uploaded tars are extracted while they arrive; zips need their
+# central directory, so an uploaded zip is spooled once and then extracted
+TAR_EXTS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+import_pool = ThreadPoolExecutor(1, thread_name_prefix="import")
+import_jobs = {}
+
+class CountingReader:
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.count += len(data)
+        return data
+
+class ImportJob:
+    def __init__(self, name, size, playlist=None):
+        self.id = os.urandom(8).hex()
+        self.name = name
+        self.size = size
+        self.playlist = playlist or os.path.basename(name).split(".")[0] or "Imported"
+        self.read = 0
+        self.files = 0
+        self.skipped = 0
+        self.status = "waiting"
+        self.error = None
+        import_jobs[self.id] = self
+        self.save()
+
+    @classmethod
+    def load(cls, id):
+        # a job started by another worker process
+        try:
+            with open(os.path.join(UPLOAD_DIR, id + ".import.json")) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls.__new__(cls)
+        job.__dict__.update(state, read=state["bytes"])
+        del job.__dict__["bytes"]
+        return job
+
+    def save(self):
+        state = dict(self.progress(), playlist=self.playlist)
+        tmp = os.path.join(UPLOAD_DIR, "%s.%d.import.tmp" % (self.id, os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(UPLOAD_DIR, self.id + ".import.json"))
+
+    def progress(self):
+        return {"id": self.id, "name": self.name, "status": self.status, "error": self.error,
+                "bytes": self.read, "size": self.size, "files": self.files, "skipped": self.skipped}
+
+    def extract_member(self, member_path, src):
+        parts = [p for p in member_path.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+        name = parts[-1] if parts else ""
+        pl = parts[-2] if len(parts) > 1 else self.playlist
+        wanted = name.lower().endswith(AUDIO_EXTS) or name.lower() in ART_NAMES
+        dest = safe_join(MUSIC, pl, name) if wanted and not pl.startswith(".") else None
+        if dest is None:
+            self.skipped += 1
+            return
+        tmp = os.path.join(UPLOAD_DIR, "%s-%d.import" % (self.id, self.files))
+        with open(tmp, "wb") as out:
+            shutil.copyfileobj(src, out, STREAM_CHUNK)
+        if os.path.isfile(dest) and os.path.getsize(dest) == os.path.getsize(tmp):
+            os.remove(tmp)
+            self.skipped += 1
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp, dest)
+        index_add_file(pl, name)
+        self.files += 1
+        self.save()
+
+    def extract_tar(self, f):
+        reader = CountingReader(f)
+        with tarfile.open(fileobj=reader, mode="r|*") as tar:
+            for member in tar:
+                if member.isfile():
+                    self.extract_member(member.name, tar.extractfile(member))
+                self.read = reader.count
+
+    def extract_zip(self, path):
+        with zipfile.ZipFile(path) as z:
+            for info in z.infolist():
+                if not info.is_dir():
+                    with z.open(info) as src:
+                        self.extract_member(info.filename, src)
+                self.read += info.compress_size
+
+    def run(self, extract, *args, cleanup=None):
+        self.status = "running"
+        self.save()
+        try:
+            extract(*args)
+            self.status = "done"
+        except Exception as e:
+            print("Import error:", self.name, e)
+            self.status = "error"
+            self.error = str(e)
+        finally:
+            self.save()
+            if cleanup:
+                try:
+                    os.remove(cleanup)
+                except OSError:
+                    pass
+
+def import_local(job, path):
+    if zipfile.is_zipfile(path):
+        job.extract_zip(path)
+    else:
+        with open(path, "rb") as f:
+            job.extract_tar(f)
+
+@app.route("/api/import", methods=["POST"])
+def import_start():
+    body = json_body()
+    path, name, size, playlist = body.get("path"), body.get("name"), body.get("size"), body.get("playlist")
+    if not isinstance(path, (str, type(None))) or not isinstance(name, (str, type(None))) \
+            or not isinstance(playlist, (str, type(None))) or not isinstance(size, (int, type(None))) \
+            or (size or 0) < 0:
+        return jsonify(error="path, name and playlist must be strings and size a whole number"), 400
+    if path:
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isfile(path):
+            return jsonify(error="no such archive"), 404
+        job = ImportJob(path, os.path.getsize(path), playlist)
+        import_pool.submit(job.run, import_local, job, path)
+        return jsonify(job.progress()), 202
+    if not (name or "").lower().endswith(TAR_EXTS + (".zip",)):
+        return jsonify(error="expected a .zip or .tar archive"), 400
+    job = ImportJob(name, size or 0, playlist)
+    return jsonify(job.progress())
+
+@app.route("/api/import/<id>", methods=["PUT"])
+def import_upload(id):
+    job = import_jobs.get(id) or ImportJob.load(id)
+    if job is None or job.status != "waiting":
+        return jsonify(error="no such import waiting for data"), 404
+    if job.name.lower().endswith(TAR_EXTS):
+        job.run(job.extract_tar, request.stream)
+        return jsonify(job.progress())
+    spool = os.path.join(UPLOAD_DIR, id + ".zip")
+    job.status = "uploading"
+    job.save()
+    with open(spool, "wb") as out:
+        shutil.copyfileobj(request.stream, out, STREAM_CHUNK)
+    import_pool.submit(job.run, job.extract_zip, spool, cleanup=spool)
+    return jsonify(job.progress()), 202
+
+@app.route("/api/import/<id>")
+def import_progress(id):
+    job = import_jobs.get(id) or ImportJob.load(id)
+    if job is None:
+        return jsonify(error="no such import"), 404
+    return jsonify(job.progress())
+
 # ---------------- PWA STATIC ----------------
 @app.route('/manifest.json')
 def manifest():
@@ -92,14 +2253,17 @@ body{margin:0;background:#111;color:white;font-family:Arial;display:flex;flex-di
 #time{margin-bottom:8px;}
 button{background:#333;color:white;border:none;border-radius:12px;padding:12px;margin:4px;font-size:20px;cursor:pointer;}
 button:hover{background:#1DB954;color:black;}
-.song{display:flex;justify-content:space-between;align-items:center;padding:6px 0;}
+.song{display:flex;justify-content:space-between;align-items:center;position:absolute;left:0;right:0;height:44px;box-sizing:border-box;}
+.song span{overflow:hidden;text-overflow:ellipsis;white-space:nowrap;}
+#songs{position:relative;height:50vh;overflow-y:auto;}
 .menu{display:flex;gap:8px;}
 #controls{display:flex;justify-content:center;align-items:center;gap:12px;padding:8px;flex-wrap:wrap;}
 #seek,#vol{width:100%;}
+#wave{width:100%;height:48px;display:block;}
 #menu{position:absolute;top:72px;right:12px;width:300px;background:#222;border-radius:18px;padding:12px;display:none;flex-direction:column;max-height:70%;overflow:auto;}
 #queuePanel{position:fixed;bottom:-60%;left:0;width:100%;max-height:60%;background:#222;border-top-left-radius:18px;border-top-right-radius:18px;padding:12px;overflow:auto;transition:bottom 0.3s;}
 #queuePanel.show{bottom:0;}
-.song button{padding:8px;font-size:18px;}
+.song button{padding:4px 8px;font-size:18px;}
 ul{list-style:none;padding:0;margin:0;}
 li{padding:6px 0;display:flex;justify-content:space-between;align-items:center;}
 </style>
@@ -116,6 +2280,7 @@ li{padding:6px 0;display:flex;justify-content:space-between;align-items:center;}
   <div id="info">
     <h3 id="title">Nothing Playing</h3>
     <div id="time">0:00 / 0:00</div>
+    <canvas id="wave"></canvas>
     <input id="seek" type="range" min="0" max="100">
     <div id="controls">
       <button id="prev">⏮</button>
@@ -129,11 +2294,20 @@ li{padding:6px 0;display:flex;justify-content:space-between;align-items:center;}
 </div>
 
 <button onclick="addFolder()">Add Folder</button>
+<button onclick="importArchive()">Import Archive</button>
+<span id="importStatus"></span>
 
 <div id="menu">
   <h4>Playlists</h4>
+  <input id="search" type="search" placeholder="Search">
+  <ul id="results"></ul>
   <select id="playlist"></select>
-  <div id="songs"></div>
+  <select id="sort">
+    <option value="name">A–Z</option>
+    <option value="-mtime">Newest</option>
+    <option value="-size">Largest</option>
+  </select>
+  <div id="songs"><div id="songsSpacer"></div></div>
 </div>
 
 <button id="queueBtn">Queue 🎵</button>
@@ -141,13 +2315,18 @@ li{padding:6px 0;display:flex;justify-content:space-between;align-items:center;}
 
 <script>
 const audio = new Audio();
-let playlists={},currentPl="",currentIdx=0,queue=[],allSongs=[];
+let counts={},currentPl="",currentIdx=0,generation=0;
 const playlistEl=document.getElementById("playlist");
+const sortEl=document.getElementById("sort");
+const searchEl=document.getElementById("search");
+const resultsEl=document.getElementById("results");
 const songsEl=document.getElementById("songs");
+const spacer=document.getElementById("songsSpacer");
 const art=document.getElementById("album");
 const titleEl=document.getElementById("title");
 const timeEl=document.getElementById("time");
 const seek=document.getElementById("seek");
+const wave=document.getElementById("wave");
 const vol=document.getElementById("vol");
 const play=document.getElementById("play");
 const prev=document.getElementById("prev");
@@ -163,8 +2342,8 @@ const queueEl=document.getElementById("queue");
 let shuffleMode=0; // 0=off, 1=shuffle playlist, 2=shuffle all songs
 let loopMode="off"; // off, song, playlist
 
-moreBtn.onclick=()=>{menu.style.display=menu.style.display==="flex"?"none":"flex";}
-queueBtn.onclick=()=>{queuePanel.classList.toggle("show");}
+moreBtn.onclick=()=>{menu.style.display=menu.style.display==="flex"?"none":"flex";renderRows();}
+queueBtn.onclick=()=>{queuePanel.classList.toggle("show");renderQueue();}
 
 shuffleBtn.onclick = () => {
   shuffleMode = (shuffleMode + 1) % 3; 
@@ -172,49 +2351,243 @@ shuffleBtn.onclick = () => {
   else{ shuffleBtn.style.background="#1DB954"; }
   if(shuffleMode===1) shuffleBtn.textContent="🔀 (Playlist)";
   else if(shuffleMode===2) shuffleBtn.textContent="🔀 (All)";
+  sessionModes().then(renderQueue);
 };
 
 loopBtn.onclick=()=>{
   if(loopMode==="off"){ loopMode="playlist"; loopBtn.style.background="#1DB954"; loopBtn.textContent="🔁"; }
   else if(loopMode==="playlist"){ loopMode="song"; loopBtn.textContent="🔂"; }
   else{ loopMode="off"; loopBtn.style.background="#333"; loopBtn.textContent="🔁"; }
+  sessionModes().then(renderQueue);
 };
 
+// queue, history and shuffle order live in a server session (/api/session),
+// the page only ever asks it for the next few tracks. without one (server
+// unreachable) next/prev just walk the current playlist
+let sessionId=localStorage.getItem("session");
+async function sessionCall(path,method,body){
+ const opts={method:method||"GET",headers:{"Content-Type":"application/json"}};
+ if(body) opts.body=JSON.stringify(body);
+ try{
+  if(!sessionId) await newSession();
+  let r=await fetch("/api/session/"+sessionId+path,opts);
+  if(r.status===404){ await newSession(); r=await fetch("/api/session/"+sessionId+path,opts); }
+  if(r.ok&&opts.method!=="GET") prefetchAhead();
+  return r.ok?await r.json():null;
+ }catch(e){ return null; }
+}
+// whatever the session will play next gets downloaded by the service worker
+// (see /api/prefetch), so it keeps playing through a dead spot
+function prefetchAhead(){
+ const sw=navigator.serviceWorker&&navigator.serviceWorker.controller;
+ if(sw) sw.postMessage({type:"prefetch",session:sessionId});
+}
+async function newSession(){
+ const s=await fetch("/api/session",{method:"POST"}).then(r=>r.json());
+ sessionId=s.id;
+ localStorage.setItem("session",sessionId);
+ await sessionModes();
+}
+function sessionModes(){
+ return sessionCall("","PATCH",{shuffle:["off","playlist","all"][shuffleMode],
+  repeat:loopMode==="playlist"?"playlist":"off",playlist:currentPl});
+}
+
 fetchPlaylists();
 playlistEl.onchange=loadPlaylist;
+sortEl.onchange=loadPlaylist;
 
+// the client only ever holds {playlist: track count}; song names are paged
+// in from /api/playlists/<pl> as rows scroll into view
 function fetchPlaylists(){
- fetch("/api/playlists").then(r=>r.json()).then(d=>{
-  playlists=d;
+ fetch("/api/playlists?summary=1").then(r=>{
+  generation=+r.headers.get("X-Library-Generation")||0;
+  return r.json();
+ }).then(d=>{
+  counts=d;
+  pages.clear();
+  renderPlaylists();
+  watchLibrary();
+ });
+}
+
+// only asks for what changed since the generation we already have
+function refreshPlaylists(){
+ fetch("/api/playlists?summary=1&since="+generation).then(r=>r.json()).then(applyDelta);
+}
+
+function applyDelta(d){
+ if(d.reset){
+  if(!d.playlists) return fetchPlaylists();
+  counts=d.playlists;
+  pages.clear();
+ } else {
+  d.removed.forEach(([p])=>{ if(counts[p]&&!--counts[p]) delete counts[p]; forgetPages(p); });
+  d.added.forEach(([p])=>{ counts[p]=(counts[p]||0)+1; forgetPages(p); });
+  (d.tagged||[]).forEach(forgetPages);
+ }
+ generation=d.generation;
+ renderPlaylists();
+}
+
+let libraryEvents=null;
+function watchLibrary(){
+ if(libraryEvents||!window.EventSource) return;
+ libraryEvents=new EventSource("/api/events?since="+generation);
+ libraryEvents.addEventListener("library",e=>applyDelta(JSON.parse(e.data)));
+}
+
+function renderPlaylists(){
+  const keep=playlistEl.value;
   playlistEl.innerHTML="";
-  allSongs=[]; 
-  for(let p in d){
-    playlistEl.add(new Option(p,p));
-    d[p].forEach(s=>allSongs.push({pl:p,song:s}));
-  }
-  loadPlaylist();
+  for(let p in counts) playlistEl.add(new Option(p,p));
+  if(keep in counts) playlistEl.value=keep;
+  if(playlistEl.value===currentPl){ rowPool.forEach(r=>r.dataset.key=""); renderRows(); }
+  else loadPlaylist();
+}
+
+// ---- paged, windowed song list ----
+const ROW_H=44, PAGE=200, PAGES_KEPT=16;
+const pages=new Map(); // "pl|sort" -> Map(page number -> Promise of track items)
+const arts={}; // playlist -> its cover's /m/ url, from the pages
+const rowPool=[];
+
+function forgetPages(pl){
+ for(const k of [...pages.keys()]) if(k.startsWith(pl+"|")) pages.delete(k);
+}
+
+// {name, size, mtime} plus title/artist/album/duration/... once the server has read the tags
+function trackAt(pl,i){
+ const key=pl+"|"+sortEl.value, n=Math.floor(i/PAGE);
+ if(!pages.has(key)) pages.set(key,new Map());
+ const cache=pages.get(key);
+ let page=cache.get(n);
+ if(page) cache.delete(n);
+ else page=fetch(`/api/playlists/${encodeURIComponent(pl)}?offset=${n*PAGE}&limit=${PAGE}&sort=${sortEl.value}`)
+  .then(r=>r.json()).then(d=>{ if(d.art) arts[pl]=d.art; return d.items; });
+ cache.set(n,page);
+ if(cache.size>PAGES_KEPT) cache.delete(cache.keys().next().value);
+ return page.then(list=>list[i-n*PAGE]);
+}
+
+function songAt(pl,i){
+ return trackAt(pl,i).then(t=>t&&t.name);
+}
+
+function fmtTime(t){
+ return Math.floor(t/60)+":"+Math.floor(t%60).toString().padStart(2,"0");
+}
+
+function renderRows(){
+ const total=counts[currentPl]||0;
+ spacer.style.height=total*ROW_H+"px";
+ const first=Math.max(0,Math.floor(songsEl.scrollTop/ROW_H)-5);
+ const last=Math.min(total,first+Math.ceil((songsEl.clientHeight||600)/ROW_H)+10);
+ while(rowPool.length<last-first){
+  const row=document.createElement("div");
+  row.className="song";
+  row.innerHTML=`<span></span><div class="menu">
+     <button data-act="play">▶ Play</button>
+     <button data-act="queue">➕</button>
+   </div>`;
+  spacer.appendChild(row);
+  rowPool.push(row);
+ }
+ rowPool.forEach((row,k)=>{
+  const i=first+k, pl=currentPl, key=pl+"|"+sortEl.value+"|"+i;
+  if(i>=last){ row.style.display="none"; return; }
+  row.style.display="";
+  row.style.top=i*ROW_H+"px";
+  row.dataset.i=i;
+  if(row.dataset.key===key) return;
+  row.dataset.key=key;
+  row.firstChild.textContent="…";
+  trackAt(pl,i).then(t=>{
+   if(row.dataset.key!==key) return;
+   row.firstChild.textContent=t?t.name+(t.duration?"  ·  "+fmtTime(t.duration):""):"";
+  });
  });
 }
 
+let rowsQueued=false;
+songsEl.onscroll=()=>{
+ if(rowsQueued) return;
+ rowsQueued=true;
+ requestAnimationFrame(()=>{ rowsQueued=false; renderRows(); });
+};
+
+songsEl.onclick=e=>{
+ const b=e.target.closest("button");
+ if(!b) return;
+ const i=+b.closest(".song").dataset.i;
+ if(b.dataset.act==="play") playSong(i);
+ else songAt(currentPl,i).then(addQueue);
+};
+
 function loadPlaylist(){
  currentPl=playlistEl.value;
- songsEl.innerHTML="";
- playlists[currentPl].forEach((s,i)=>{
-  let div=document.createElement("div");
-  div.className="song";
-  div.innerHTML=`${s}<div class="menu">
-     <button onclick="playSong(${i})">▶ Play</button>
-     <button onclick="addQueue('${s}')">➕</button>
-   </div>`;
-  songsEl.appendChild(div);
- });
+ songsEl.scrollTop=0;
+ rowPool.forEach(r=>r.dataset.key="");
+ renderRows();
+}
+
+// lossless files go over slow or metered connections as ogg instead.
+// url is the track's /m/<sha1> when the server has hashed it
+function songUrl(pl,s,url){
+ const c=navigator.connection;
+ const slow=c&&(c.saveData||/2g|3g/.test(c.effectiveType||""));
+ const lossless=/\\.(flac|wav)$/i.test(s);
+ return (url||`/music/${pl}/${s}`)+(slow&&lossless?"?format=ogg&quality=5":"");
 }
 
 function playSong(i){
  currentIdx=i;
- const s=playlists[currentPl][i];
- audio.src=`/music/${currentPl}/${s}`;
- art.style.backgroundImage="url('/art/"+currentPl+"')";
+ const pl=currentPl;
+ trackAt(pl,i).then(t=>{ if(t) pickTrack(pl,t.name,t.duration,t.gain,t.url); });
+}
+
+// played by hand rather than by next/prev, so the session hears about it
+function pickTrack(pl,s,duration,gain,url){
+ playTrack(pl,s,duration,gain,url);
+ const src=audio.src;
+ sessionCall("/play","POST",{playlist:pl,song:s}).then(d=>{
+  if(d&&audio.src===src) setGain(d.gain);
+  renderQueue();
+ });
+}
+
+let searchTimer=null;
+searchEl.oninput=()=>{
+ clearTimeout(searchTimer);
+ searchTimer=setTimeout(()=>{
+  const q=searchEl.value.trim();
+  if(!q){ resultsEl.innerHTML=""; return; }
+  fetch("/api/search?q="+encodeURIComponent(q)).then(r=>r.json()).then(d=>{
+   if(d.query!==searchEl.value.trim()) return;
+   resultsEl.innerHTML="";
+   d.results.forEach(r=>{
+    const li=document.createElement("li");
+    li.innerHTML=`<span></span><span class="menu"><button>▶</button><button>➕</button></span>`;
+    li.firstChild.textContent=r.playlist+" / "+r.song;
+    const [playBtn,queueBtn]=li.querySelectorAll("button");
+    playBtn.onclick=()=>pickTrack(r.playlist,r.song);
+    queueBtn.onclick=()=>sessionCall("/queue","POST",{playlist:r.playlist,song:r.song}).then(renderQueue);
+    resultsEl.appendChild(li);
+   });
+  });
+ },150);
+};
+
+// duration from the tags until the audio element has read its own
+let knownDuration=0;
+function playTrack(pl,s,duration,gain,url,cover){
+ knownDuration=duration||0;
+ setGain(gain);
+ timeEl.textContent="0:00 / "+fmtTime(knownDuration);
+ audio.src=songUrl(pl,s,url);
+ loadWave(pl,s);
+ if(cover) arts[pl]=cover;
+ art.style.backgroundImage="url('"+(arts[pl]||"/art/"+pl)+"?size="+(devicePixelRatio>1?600:300)+"')";
  art.style.backgroundSize="cover";
  titleEl.textContent=s;
  audio.play();
@@ -222,48 +2595,51 @@ function playSong(i){
 }
 
 function addQueue(s){
- queue.push({pl:currentPl,song:s});
- renderQueue();
+ sessionCall("/queue","POST",{playlist:currentPl,song:s}).then(renderQueue);
 }
 
+// queued tracks (playable, removable) followed by what plays after them
+const QUEUE_SHOWN=10;
 function renderQueue(){
- queueEl.innerHTML="";
- queue.forEach((q,i)=>{
-  let li=document.createElement("li");
-  li.innerHTML=`${q.song} <button onclick="playFromQueue(${i})">▶</button>`;
-  queueEl.appendChild(li);
+ if(!queuePanel.classList.contains("show")) return;
+ sessionCall("/next?count="+QUEUE_SHOWN).then(d=>{
+  queueEl.innerHTML="";
+  if(!d) return;
+  d.tracks.forEach(([pl,s],i)=>{
+   const li=document.createElement("li");
+   li.textContent=s+" ";
+   if(i<d.queue_length){
+    li.insertAdjacentHTML("beforeend",`<button data-i="${i}">▶</button><button data-i="${i}" data-drop="1">✕</button>`);
+   }else li.style.opacity=0.6;
+   queueEl.appendChild(li);
+  });
  });
 }
+queueEl.onclick=e=>{
+ const b=e.target.closest("button");
+ if(!b) return;
+ if(b.dataset.drop) sessionCall("/queue/"+b.dataset.i,"DELETE").then(renderQueue);
+ else nextTrack(+b.dataset.i);
+};
 
-function playFromQueue(i){
- const q=queue.splice(i,1)[0];
- audio.src=`/music/${q.pl}/${q.song}`;
- titleEl.textContent=q.song;
- audio.play();
+function playAdvanced(d){
+ if(!d||!d.track) return;
+ const [pl,s]=d.track;
+ playTrack(pl,s,0,d.gain,d.url,d.art);
  renderQueue();
 }
 
 play.onclick=()=>audio.paused?(audio.play(),play.textContent="⏸"):(audio.pause(),play.textContent="▶");
-prev.onclick=()=>playSong(Math.max(0,currentIdx-1));
-next.onclick=nextTrack;
-
-function nextTrack(){
- if(queue.length){ playFromQueue(0); }
- else if(shuffleMode===1){
-  let r=playlists[currentPl][Math.floor(Math.random()*playlists[currentPl].length)];
-  currentIdx=playlists[currentPl].indexOf(r);
-  playSong(currentIdx);
- } else if(shuffleMode===2){
-  let r=allSongs[Math.floor(Math.random()*allSongs.length)];
-  currentPl=r.pl;
-  currentIdx=playlists[currentPl].indexOf(r.song);
-  playSong(currentIdx);
- } else {
+prev.onclick=()=>sessionCall("/back","POST").then(d=>d?playAdvanced(d):playSong(Math.max(0,currentIdx-1)));
+next.onclick=()=>nextTrack();
+
+function nextTrack(queued){
+ sessionCall("/advance","POST",queued===undefined?null:{queue:queued}).then(d=>{
+  if(d) return playAdvanced(d);
   currentIdx++;
-  if(currentIdx<playlists[currentPl].length) playSong(currentIdx);
+  if(currentIdx<(counts[currentPl]||0)) playSong(currentIdx);
   else if(loopMode==="playlist") playSong(0);
- }
- renderQueue();
+ });
 }
 
 audio.onended=()=>{
@@ -271,26 +2647,113 @@ audio.onended=()=>{
   else nextTrack();
 };
 
+// waveform from /api/peaks, one column per device pixel, played part in green
+let peaks=null;
+function loadWave(pl,s){
+ peaks=null;
+ drawWave();
+ const width=Math.round(wave.clientWidth*devicePixelRatio)||600;
+ const src=audio.src;
+ fetch(`/api/peaks/${encodeURIComponent(pl)}/${encodeURIComponent(s)}?width=${width}`)
+  .then(r=>r.ok?r.json():null).then(d=>{ if(d&&audio.src===src){ peaks=d; drawWave(); } })
+  .catch(()=>{});
+}
+
+function drawWave(){
+ const w=wave.width=Math.round(wave.clientWidth*devicePixelRatio)||600;
+ const h=wave.height=Math.round(wave.clientHeight*devicePixelRatio)||48;
+ const ctx=wave.getContext("2d");
+ ctx.clearRect(0,0,w,h);
+ if(!peaks||!peaks.max.length) return;
+ const n=peaks.max.length, played=audio.currentTime/(trackLength()||1)*n;
+ for(let i=0;i<n;i++){
+  const x=i*w/n, top=(1-peaks.max[i])*h/2, bottom=(1-peaks.min[i])*h/2;
+  ctx.fillStyle=i<played?"#1DB954":"#555";
+  ctx.fillRect(x,top,Math.max(1,w/n),Math.max(1,bottom-top));
+ }
+}
+
+function trackLength(){
+ return isFinite(audio.duration)?audio.duration:knownDuration;
+}
+
 audio.ontimeupdate=()=>{
- seek.value=audio.currentTime/audio.duration*100||0;
- let min=Math.floor(audio.currentTime/60);
- let sec=Math.floor(audio.currentTime%60).toString().padStart(2,"0");
- let durMin=Math.floor(audio.duration/60)||0;
- let durSec=Math.floor(audio.duration%60).toString().padStart(2,"0");
- timeEl.textContent=`${min}:${sec} / ${durMin}:${durSec}`;
+ seek.value=audio.currentTime/trackLength()*100||0;
+ timeEl.textContent=fmtTime(audio.currentTime)+" / "+fmtTime(trackLength()||0);
+ if(peaks) drawWave();
 };
 
-seek.oninput=()=>audio.currentTime=seek.value/100*audio.duration;
-vol.oninput=e=>audio.volume=e.target.value;
+seek.oninput=()=>audio.currentTime=seek.value/100*trackLength();
+// the server's loudness gain (dB) evens tracks out under the slider; the
+// element can't go past 1, so loud tracks come down rather than quiet ones up
+let trackGain=1;
+function setGain(db){
+ trackGain=db?Math.pow(10,db/20):1;
+ applyVolume();
+}
+function applyVolume(){
+ audio.volume=Math.min(1,vol.value*trackGain);
+}
+vol.oninput=applyVolume;
+
+const UPLOAD_CHUNK=8*1024*1024;
+
+// sends one file in chunks, picking up where the server says it left off
+async function uploadFile(pl,f){
+ const s=await fetch("/api/uploads",{method:"POST",headers:{"Content-Type":"application/json"},
+  body:JSON.stringify({playlist:pl,name:f.name,size:f.size})}).then(r=>r.json());
+ if(s.status||s.error) return s.status||s.error;
+ let off=s.offset,fails=0;
+ while(true){
+  const end=Math.min(off+UPLOAD_CHUNK,f.size);
+  try{
+   const r=await fetch("/api/uploads/"+s.id,{method:"PUT",
+    headers:{"Content-Range":`bytes ${off}-${end-1}/${f.size}`},body:f.slice(off,end)}).then(r=>r.json());
+   off=r.offset;
+   if(r.status&&r.status!=="partial") return r.status;
+   fails=0;
+  }catch(e){
+   if(++fails>5) return "failed";
+   await new Promise(ok=>setTimeout(ok,1000*fails));
+   off=(await fetch("/api/uploads/"+s.id).then(r=>r.json())).offset;
+  }
+ }
+}
+
+function importArchive(){
+ let i=document.createElement("input");
+ i.type="file"; i.accept=".zip,.tar,.tgz,.gz,.bz2,.xz";
+ i.onchange=async()=>{
+  const f=i.files[0];
+  if(!f) return;
+  const status=document.getElementById("importStatus");
+  const job=await fetch("/api/import",{method:"POST",headers:{"Content-Type":"application/json"},
+   body:JSON.stringify({name:f.name,size:f.size})}).then(r=>r.json());
+  if(job.error){ status.textContent=job.error; return; }
+  status.textContent="Uploading "+f.name+"…";
+  const poll=setInterval(()=>fetch("/api/import/"+job.id).then(r=>r.json()).then(p=>{
+   if(p.status==="running") status.textContent=`Importing ${p.files} files (${Math.round(100*p.bytes/(p.size||1))}%)`;
+   if(p.status==="done"||p.status==="error"){
+    clearInterval(poll);
+    status.textContent=p.status==="done"?`Imported ${p.files} files`:p.error;
+    refreshPlaylists();
+   }
+  }),1000);
+  fetch("/api/import/"+job.id,{method:"PUT",body:f});
+ };
+ i.click();
+}
 
 function addFolder(){
  let i=document.createElement("input");
  i.type="file"; i.webkitdirectory=true; i.multiple=true;
- i.onchange=()=>{
-  let data=new FormData();
-  data.append("playlist",prompt("Playlist name"));
-  [...i.files].forEach(f=>data.append("files",f));
-  fetch("/upload",{method:"POST",body:data}).then(fetchPlaylists);
+ i.onchange=async()=>{
+  const pl=prompt("Playlist name");
+  if(!pl) return;
+  const files=[...i.files];
+  const next=async()=>{ while(files.length) await uploadFile(pl,files.shift()); };
+  await Promise.all([next(),next()]);
+  refreshPlaylists();
  };
  i.click();
 }
@@ -299,9 +2762,378 @@ function addFolder(){
 </html>
 """
 
+# ---------------- COMPRESSION ----------------
+# JSON, HTML and text responses go out as brotli (when the brotli package is
+# installed) or gzip if the client takes it. the page itself is compressed
+# once at startup at the highest levels; everything else on the fly at
+# levels that cost less than the bytes they save. a compressed response's
+# ETag becomes weak, the library views compare weakly to match
+COMPRESS_MIN = 1024  # bytes, smaller bodies aren't worth it
+COMPRESS_TYPES = ("application/json", "text/html", "text/plain", "text/css",
+                  "application/javascript", "image/svg+xml")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def encode(data, encoding, best=False):
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(data, 9 if best else GZIP_LEVEL, mtime=0)
+
+@app.after_request
+def compress(resp):
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code != 200
+            or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESS_TYPES
+            or request.method == "HEAD"):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    data = resp.get_data()
+    encoding = len(data) >= COMPRESS_MIN and pick_encoding()
+    if not encoding:
+        return resp
+    resp.set_data(encode(data, encoding))
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+HTML_BYTES = HTML.encode()
+HTML_ETAG = hashlib.sha1(HTML_BYTES).hexdigest()[:16]
+HTML_ENCODED = {"gzip": encode(HTML_BYTES, "gzip", best=True)}
+if brotli is not None:
+    HTML_ENCODED["br"] = encode(HTML_BYTES, "br", best=True)
+
 @app.route("/")
 def index():
-    return Response(HTML, mimetype="text/html")
+    if request.if_none_match.contains_weak(HTML_ETAG):
+        resp = Response(status=304)
+    else:
+        encoding = pick_encoding()
+        resp = Response(HTML_ENCODED[encoding] if encoding else HTML_BYTES, mimetype="text/html")
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(HTML_ETAG, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+# ---------------- METRICS ----------------
+# GET /metrics in the Prometheus text format. every thread counts into its
+# own shard (a threading.local registered once in metric_shards), so the
+# request path never takes a lock or races another thread's +=; a scrape
+# just adds the shards up. the shard of a thread that has exited is folded
+# into metric_retired (the dev server starts a thread per request). latency
+# is time to headers: a stream's body takes as long as the listener does.
+# with --workers N each process answers for itself, the pid label tells
+# them apart
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRIC_ROUTES = (("/api/playlists", "playlists"), ("/music/", "music"), ("/m/", "media"), ("/art/", "art"),
+                 ("/upload", "upload"), ("/api/uploads", "upload"), ("/api/import", "upload"),
+                 ("/api/session", "session"), ("/api/prefetch", "session"),
+                 ("/api/search", "search"), ("/api/events", "events"), ("/api/peaks", "peaks"),
+                 ("/metrics", "metrics"))
+
+metric_local = threading.local()
+metric_shards = []  # (thread, shard)
+metric_shards_lock = threading.Lock()
+scan_stats = {"count": 0, "seconds": 0.0, "last": 0.0}  # written under index_lock
+
+def new_shard():
+    return {"latency": {}, "responses": {}, "bytes": {}, "streams": [0, 0], "hits": {}, "misses": {},
+            "rejected": {}}
+
+def add_shard(into, shard):
+    for route, hist in list(shard["latency"].items()):
+        total = into["latency"].setdefault(route, [0] * len(hist))
+        for i, v in enumerate(list(hist)):
+            total[i] += v
+    for name in ("responses", "bytes", "hits", "misses", "rejected"):
+        for key, v in list(shard[name].items()):
+            into[name][key] = into[name].get(key, 0) + v
+    into["streams"][0] += shard["streams"][0]
+    into["streams"][1] += shard["streams"][1]
+
+def retire_shards():
+    # caller holds metric_shards_lock; a dead thread can't write its shard
+    # any more, so it's safe to fold in and drop
+    for entry in [e for e in metric_shards if not e[0].is_alive()]:
+        add_shard(metric_retired, entry[1])
+        metric_shards.remove(entry)
+
+metric_retired = new_shard()  # what threads that have exited counted
+
+def metric_shard():
+    shard = getattr(metric_local, "shard", None)
+    if shard is None:
+        shard = metric_local.shard = new_shard()
+        with metric_shards_lock:
+            retire_shards()
+            metric_shards.append((threading.current_thread(), shard))
+    return shard
+
+def metrics_hit(cache, hit):
+    counts = metric_shard()["hits" if hit else "misses"]
+    counts[cache] = counts.get(cache, 0) + 1
+
+def metrics_rejected(code):
+    counts = metric_shard()["rejected"]
+    counts[code] = counts.get(code, 0) + 1
+
+def route_label(path):
+    for prefix, label in METRIC_ROUTES:
+        if path.startswith(prefix):
+            return label
+    return "other"
+
+def on_close(environ, body, done):
+    # run done() once the server is finished with body, keeping the server's
+    # own file wrapper so it can still sendfile()
+    wrapper = environ.get("wsgi.file_wrapper")
+    if isinstance(wrapper, type) and isinstance(body, wrapper):
+        close = getattr(body, "close", None)
+        def close_and_done():
+            try:
+                if close:
+                    close()
+            finally:
+                done()
+        body.close = close_and_done
+        return body
+    return ClosingIterator(body, done)
+
+class CountedBody:
+    # passes a response body through, counting the bytes actually handed to
+    # the server; done(bytes) runs on close, so an aborted stream counts
+    # only what went out
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, "close", None)
+            if close:
+                close()
+        finally:
+            self.done(self.sent)
+
+class Metrics:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        route = route_label(environ.get("PATH_INFO", ""))
+        started = time.perf_counter()
+        seen = []
+        def start(status, headers, exc_info=None):
+            seen.append(status[:3])
+            seen.append(next((v for k, v in headers if k.lower() == "content-length"), None))
+            return start_response(status, headers, exc_info)
+        body = self.wsgi_app(environ, start)
+        elapsed = time.perf_counter() - started
+        shard = metric_shard()
+        hist = shard["latency"].get(route)
+        if hist is None:
+            hist = shard["latency"][route] = [0] * (len(METRIC_BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(METRIC_BUCKETS, elapsed)] += 1
+        hist[-1] += elapsed
+        key = (route, seen[0] if seen else "500")
+        shard["responses"][key] = shard["responses"].get(key, 0) + 1
+        stream = route in ("music", "media")
+        if stream:
+            shard["streams"][0] += 1
+        def done(sent):
+            shard = metric_shard()
+            shard["bytes"][route] = shard["bytes"].get(route, 0) + sent
+            if stream:
+                shard["streams"][1] += 1
+        wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(wrapper, type) and isinstance(body, wrapper):
+            # sendfile() moves the bytes without us seeing them, so this is
+            # the one case counted by Content-Length
+            sent = int(seen[1]) if len(seen) > 1 and seen[1] else 0
+            return on_close(environ, body, lambda: done(sent))
+        return CountedBody(body, done)
+
+app.wsgi_app = Metrics(app.wsgi_app)
+
+def metric_totals():
+    totals = new_shard()
+    with metric_shards_lock:
+        retire_shards()
+        add_shard(totals, metric_retired)
+        shards = [shard for thread, shard in metric_shards]
+    for shard in shards:
+        add_shard(totals, shard)
+    return totals
+
+def labels(**values):
+    return "{%s}" % ",".join('%s="%s"' % kv for kv in values.items())
+
+@app.route("/metrics")
+def metrics():
+    totals = metric_totals()
+    pid = str(os.getpid())
+    out = []
+    def metric(name, kind, help, samples):
+        out.append("# HELP %s %s" % (name, help))
+        out.append("# TYPE %s %s" % (name, kind))
+        for suffix, lbl, value in samples:
+            out.append("%s%s%s %s" % (name, suffix, labels(pid=pid, **lbl), repr(float(value))))
+
+    samples = []
+    for route, hist in sorted(totals["latency"].items()):
+        running = 0
+        for bound, count in zip(METRIC_BUCKETS + (math.inf,), hist):
+            running += count
+            samples.append(("_bucket", {"route": route, "le": "+Inf" if bound == math.inf else repr(bound)},
+                            running))
+        samples.append(("_sum", {"route": route}, hist[-1]))
+        samples.append(("_count", {"route": route}, running))
+    metric("brickify_request_duration_seconds", "histogram",
+           "Time from request to response headers.", samples)
+    metric("brickify_responses_total", "counter", "Responses by route and status code.",
+           [("", {"route": r, "code": c}, v) for (r, c), v in sorted(totals["responses"].items())])
+    metric("brickify_response_bytes_total", "counter", "Response body bytes sent.",
+           [("", {"route": r}, v) for r, v in sorted(totals["bytes"].items())])
+    metric("brickify_active_streams", "gauge", "/music and /m responses still being sent.",
+           [("", {}, totals["streams"][0] - totals["streams"][1])])
+    metric("brickify_rejected_total", "counter", "Requests turned away by --serve limits.",
+           [("", {"code": c}, v) for c, v in sorted(totals["rejected"].items())])
+    caches = sorted(set(totals["hits"]) | set(totals["misses"]))
+    metric("brickify_cache_hits_total", "counter", "Cache lookups answered from the cache.",
+           [("", {"cache": c}, totals["hits"].get(c, 0)) for c in caches])
+    metric("brickify_cache_misses_total", "counter", "Cache lookups that had to do the work.",
+           [("", {"cache": c}, totals["misses"].get(c, 0)) for c in caches])
+    with index_lock:
+        tracks = index_db.execute("SELECT count(*) FROM tracks").fetchone()[0]
+        scans = dict(scan_stats)
+    metric("brickify_library_scan_seconds", "summary", "Library rescans (mtime walk of MUSIC).",
+           [("_sum", {}, scans["seconds"]), ("_count", {}, scans["count"])])
+    metric("brickify_library_last_scan_seconds", "gauge", "Duration of the latest rescan.",
+           [("", {}, scans["last"])])
+    metric("brickify_library_tracks", "gauge", "Tracks in the library index.", [("", {}, tracks)])
+    metric("brickify_library_generation", "gauge", "Library generation.", [("", {}, library_generation)])
+    return Response("\n".join(out) + "\n", mimetype="text/plain; version=0.0.4")
+
+# ---------------- SERVING ----------------
+# `python Brickify.py --serve` runs under gunicorn (gthread workers, sendfile
+# for /music) or waitress where gunicorn isn't available (Windows).
+# every worker gets --threads for the API plus --stream-threads for
+# long-lived responses; a stream that finds no free stream slot gets a 503
+# instead of eating an API thread, and one client can't hold more than
+# --per-client requests at once
+
+def is_stream(environ):
+    path = environ.get("PATH_INFO", "")
+    return (path.startswith(("/music/", "/m/")) or path == "/api/events"
+            or environ.get("REQUEST_METHOD") == "PUT")
+
+def reject(start_response, status, retry_after=None):
+    headers = [("Content-Type", "text/plain"), ("Content-Length", str(len(status)))]
+    if retry_after:
+        headers.append(("Retry-After", str(retry_after)))
+    start_response(status, headers)
+    return [status.encode()]
+
+class ServeLimits:
+    def __init__(self, wsgi_app, stream_slots, per_client):
+        self.wsgi_app = wsgi_app
+        self.streams = threading.BoundedSemaphore(stream_slots)
+        self.per_client = per_client
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def release(self, client, stream):
+        if stream:
+            self.streams.release()
+        with self.lock:
+            left = self.clients[client] - 1
+            if left:
+                self.clients[client] = left
+            else:
+                del self.clients[client]
+
+    def __call__(self, environ, start_response):
+        client = environ.get("REMOTE_ADDR", "")
+        stream = is_stream(environ)
+        with self.lock:
+            if self.clients.get(client, 0) >= self.per_client:
+                metrics_rejected("429")
+                return reject(start_response, "429 Too Many Requests", 1)
+            self.clients[client] = self.clients.get(client, 0) + 1
+        if stream and not self.streams.acquire(blocking=False):
+            self.release(client, False)
+            metrics_rejected("503")
+            return reject(start_response, "503 Service Unavailable", 5)
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except Exception:
+            self.release(client, stream)
+            raise
+        return on_close(environ, body, lambda: self.release(client, stream))
+
+def reopen_index(server, worker):
+    # gunicorn post_fork hook: sqlite connections must not cross a fork
+    global index_db
+    index_db = open_index()
+
+def serve(args):
+    app.wsgi_app = ServeLimits(app.wsgi_app, args.stream_threads, args.per_client)
+    threads = args.threads + args.stream_threads
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+    if BaseApplication is None:
+        from waitress import serve as waitress_serve
+        if args.workers > 1:
+            print("waitress runs a single process, ignoring --workers")
+        waitress_serve(app, host=args.host, port=args.port, threads=threads,
+                       connection_limit=max(100, threads * 4), channel_timeout=300)
+        return
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {"bind": "%s:%d" % (args.host, args.port), "workers": args.workers,
+                       "worker_class": "gthread", "threads": threads, "timeout": 120,
+                       "keepalive": 5, "post_fork": reopen_index}
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="Brickify music server")
+    parser.add_argument("--serve", action="store_true",
+                        help="run the production server instead of the Flask debug server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=2, help="worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="API threads per worker")
+    parser.add_argument("--stream-threads", type=int, default=32,
+                        help="threads per worker reserved for audio streams, uploads and events")
+    parser.add_argument("--per-client", type=int, default=16,
+                        help="concurrent requests allowed from one address")
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        app.run(debug=True)
@@ -0,0 +1,128 @@
+# /api/playlists latency while audio streams are playing.
+#
+#   python bench/bench_load.py [--mode serve|dev] [--streams 50] [--seconds 10]
+#
+# starts Brickify.py on a throwaway library (--serve by default, --mode dev
+# for the Flask debug server), opens --streams slow readers on /music the way
+# a playing <audio> element would, then hammers /api/playlists and prints
+# p50/p99 latency
+import argparse
+import http.client
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BRICKIFY = os.path.join(HERE, "..", "Brickify.py")
+STREAM_RATE = 40 * 1024  # bytes/s per stream, about a 320 kbps mp3
+
+def make_library(root, playlists, tracks):
+    for p in range(playlists):
+        folder = os.path.join(root, "playlist%03d" % p)
+        os.makedirs(folder)
+        for t in range(tracks):
+            with open(os.path.join(folder, "track%04d.mp3" % t), "wb") as f:
+                f.write(os.urandom(1024))
+    with open(os.path.join(root, "playlist000", "long.mp3"), "wb") as f:
+        f.write(os.urandom(32 * 1024 * 1024))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/api/playlists")
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not come up")
+
+def listener(port, stop, errors):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    start = random.randrange(0, 16 * 1024 * 1024)
+    conn.request("GET", "/music/playlist000/long.mp3", headers={"Range": "bytes=%d-" % start})
+    resp = conn.getresponse()
+    if resp.status not in (200, 206):
+        errors.append(resp.status)
+        return
+    chunk = STREAM_RATE // 10
+    while not stop.is_set() and resp.read(chunk):
+        time.sleep(0.1)
+    conn.close()
+
+def api_client(port, stop, latencies):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while not stop.is_set():
+        started = time.perf_counter()
+        conn.request("GET", "/api/playlists")
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("serve", "dev"), default="serve")
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--api-clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--playlists", type=int, default=50)
+    parser.add_argument("--tracks", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    library = tempfile.mkdtemp(prefix="brickify-load-")
+    make_library(library, args.playlists, args.tracks)
+    port = free_port()
+    env = dict(os.environ, BRICKIFY_MUSIC=library)
+    if args.mode == "serve":
+        cmd = [sys.executable, BRICKIFY, "--serve", "--port", str(port),
+               "--workers", str(args.workers), "--stream-threads", str(args.streams),
+               "--per-client", str(args.streams + args.api_clients + 8)]
+    else:
+        # the debug server has no --port, drive it through flask's own runner
+        cmd = [sys.executable, "-m", "flask", "--app", BRICKIFY, "run", "--port", str(port)]
+    server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        stop = threading.Event()
+        errors, latencies = [], []
+        listeners = [threading.Thread(target=listener, args=(port, stop, errors))
+                     for _ in range(args.streams)]
+        for t in listeners:
+            t.start()
+        time.sleep(1)
+        clients = [threading.Thread(target=api_client, args=(port, stop, latencies))
+                   for _ in range(args.api_clients)]
+        for t in clients:
+            t.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for t in clients + listeners:
+            t.join()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(library, ignore_errors=True)
+
+    print("mode=%s streams=%d rejected=%d requests=%d" % (
+        args.mode, args.streams, len(errors), len(latencies)))
+    print("/api/playlists p50=%.1f ms p99=%.1f ms" % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# /api/search query latency on a synthetic 100k track library.
+#
+#   python bench/bench_search.py [--tracks 100000] [--queries 2000]
+#
+# fills the SearchIndex directly (no files needed) and times search() for a
+# mix of exact words, prefixes, multi-word and misspelt queries, then for
+# artist/album names that only appear in the tags. before that it checks
+# that one wrong, missing or extra letter in a short word still finds it
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ["BRICKIFY_MUSIC"] = tempfile.mkdtemp(prefix="brickify-bench-")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import Brickify
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "ven", "tor", "shi", "da", "neo", "bel", "sun", "zu",
+             "mor", "lia", "quin", "ex", "pa", "rho", "gal", "ti"]
+
+# tag words are built from syllables file names never use, so a hit on one
+# can only have come from the tags
+TAG_SYLLABLES = ["bo", "fy", "jem", "kru", "ow", "vy", "wex", "yol"]
+
+def word(rng, syllables=SYLLABLES):
+    return "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+
+def typo(rng, w):
+    i = rng.randrange(len(w))
+    return w[:i] + w[i + 1:]
+
+def one_letter_typos(w):
+    for i in range(len(w)):
+        yield w[:i] + w[i + 1:]
+        yield w[:i] + "x" + w[i + 1:]
+    for i in range(len(w) + 1):
+        yield w[:i] + "x" + w[i:]
+
+def check_typos(index, rng):
+    small = Brickify.SearchIndex()
+    small.add("rock", "01 song.mp3")
+    small.add("blues", "02 metal.mp3")
+    for q, want in (("rok", "rock"), ("sonf", "song"), ("bluez", "blues"), ("metl", "metal")):
+        results = small.search(q, Brickify.SEARCH_LIMIT)
+        assert any(want in r["playlist"] + " " + r["song"] for r in results), (q, results)
+    short = [w for w in index.vocab if 4 <= len(w) <= 5]
+    for w in rng.sample(short, min(200, len(short))):
+        for q in one_letter_typos(w):
+            if q != w:
+                assert w in index.fuzzy(q, ()), (q, w)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=100000)
+    parser.add_argument("--playlists", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    names = [" ".join(word(rng) for _ in range(2)) for _ in range(args.playlists)]
+    artists = [" ".join(word(rng, TAG_SYLLABLES) for _ in range(2)) for _ in range(args.playlists // 2)]
+    index = Brickify.SearchIndex()
+    tracks, tagged = [], {}
+    started = time.perf_counter()
+    for i in range(args.tracks):
+        pl = names[i % args.playlists]
+        song = "%02d %s.mp3" % (i % 100, " ".join(word(rng) for _ in range(rng.randint(1, 4))))
+        artist = rng.choice(artists)
+        index.add(pl, song, None, artist, artist + " live")
+        tracks.append(song)
+        tagged.setdefault(artist, set()).add((pl, song))
+    build = time.perf_counter() - started
+    check_typos(index, random.Random(2))
+
+    queries = []
+    for _ in range(args.queries):
+        w = rng.choice(rng.choice(tracks)[3:-4].split())
+        queries.append(rng.choice([w, w[:3], w[:2], typo(rng, w) if len(w) > 4 else w,
+                                   w + " " + rng.choice(names).split()[0][:3]]))
+    times = []
+    for q in queries:
+        t = time.perf_counter()
+        index.search(q, Brickify.SEARCH_LIMIT)
+        times.append(time.perf_counter() - t)
+    times.sort()
+    print("tracks=%d words=%d build=%.2fs" % (args.tracks, len(index.vocab), build))
+    print("query p50=%.2f ms p99=%.2f ms max=%.2f ms" % (
+        times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000, times[-1] * 1000))
+
+    times = []
+    for _ in range(args.queries):
+        artist = rng.choice(artists)
+        t = time.perf_counter()
+        results = index.search(artist, Brickify.SEARCH_LIMIT)
+        times.append(time.perf_counter() - t)
+        assert results and (results[0]["playlist"], results[0]["song"]) in tagged[artist], artist
+    times.sort()
+    print("artist p50=%.2f ms p99=%.2f ms max=%.2f ms" % (
+        times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000, times[-1] * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Throughput of range-seeking clients against /music (the streaming engine)
+# and the old send_from_directory route, at 1, 16 and 64 concurrent clients.
+#
+#   python bench/bench_stream.py [--seconds 5] [--size-mb 32]
+#
+# runs against a throwaway library so your real music folder is untouched
+import argparse
+import http.client
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+LIBRARY = tempfile.mkdtemp(prefix="brickify-bench-")
+os.environ["BRICKIFY_MUSIC"] = LIBRARY
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import send_from_directory
+from werkzeug.serving import WSGIRequestHandler, make_server
+import Brickify
+
+SEEK_BYTES = 256 * 1024  # what a browser asks for after a seek, roughly
+
+@Brickify.app.route("/legacy/<pl>/<song>")
+def legacy_music(pl, song):
+    return send_from_directory(os.path.join(Brickify.MUSIC, pl), song)
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+def make_track(size_mb):
+    os.makedirs(os.path.join(LIBRARY, "bench"), exist_ok=True)
+    path = os.path.join(LIBRARY, "bench", "track.flac")
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+    return os.path.getsize(path)
+
+def client(port, route, size, deadline, totals):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    done = requests = 0
+    while time.monotonic() < deadline:
+        start = random.randrange(0, size - SEEK_BYTES)
+        conn.request("GET", route, headers={"Range": "bytes=%d-%d" % (start, start + SEEK_BYTES - 1)})
+        resp = conn.getresponse()
+        done += len(resp.read())
+        requests += 1
+    conn.close()
+    totals.append((done, requests))
+
+def run(port, route, size, clients, seconds):
+    totals = []
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=client, args=(port, route, size, deadline, totals))
+               for _ in range(clients)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    nbytes = sum(t[0] for t in totals)
+    nreq = sum(t[1] for t in totals)
+    return nbytes / elapsed / 1e6, nreq / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--size-mb", type=int, default=32)
+    args = parser.parse_args()
+
+    size = make_track(args.size_mb)
+    server = make_server("127.0.0.1", 0, Brickify.app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    print("%-8s %8s %12s %12s" % ("route", "clients", "MB/s", "req/s"))
+    for clients in (1, 16, 64):
+        for name, route in (("legacy", "/legacy/bench/track.flac"), ("music", "/music/bench/track.flac")):
+            mbs, rps = run(port, route, size, clients, args.seconds)
+            print("%-8s %8d %12.1f %12.1f" % (name, clients, mbs, rps))
+    server.shutdown()
+    shutil.rmtree(LIBRARY, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# End-to-end timings of the hot paths on a synthetic library, saved as JSON
+# so two commits can be compared.
+#
+#   python bench/bench_suite.py [--playlists 20] [--tracks 50] [--out FILE] [--compare OLD.json]
+#
+# builds a library with bench/library.py in a temp folder and times
+#   - Brickify.scan_playlists() cold (empty index) and warm, plain and ?tags,
+#     and how long background tagging + loudness take after the first scan
+#   - Playerlocal's scan_playlists() and load_playlist() (walk and via the index)
+#   - /api/playlists through the Flask test client: full, ?summary, ?tags, 304
+#   - /music range requests (MB/s), /upload (MB/s), /art cold and warm
+# results go to bench/results/<git commit>.json unless --out says otherwise;
+# --compare prints each number against an earlier run
+import argparse
+import ast
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIBRARY = tempfile.mkdtemp(prefix="brickify-suite-")
+os.environ["BRICKIFY_MUSIC"] = LIBRARY
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import Brickify
+from library import LONG_PLAYLIST, LONG_TRACK, make_library
+
+PLAYERLOCAL = os.path.join(HERE, "..", "..", "Base design", "Playerlocal.py")
+PLAYER_FUNCTIONS = ("ensure_music_folder", "index_path", "read_library_index",
+                    "scan_playlists", "load_playlist")
+SEEK_BYTES = 256 * 1024
+UPLOAD_BYTES = 4 * 1024 * 1024
+WORSE = 1.10  # --compare flags anything this much slower
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def timed(fn, runs):
+    # latency of fn() over `runs` calls, in ms
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {"runs": runs, "p50_ms": percentile(times, 50) * 1000,
+            "p99_ms": percentile(times, 99) * 1000, "mean_ms": sum(times) / runs * 1000}
+
+def throughput(fn, seconds):
+    # fn() returns bytes moved; MB/s and calls/s over `seconds`
+    moved = calls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        moved += fn()
+        calls += 1
+    elapsed = time.perf_counter() - started
+    return {"calls": calls, "mb_s": moved / elapsed / 1e6, "calls_s": calls / elapsed}
+
+def player_module():
+    # Playerlocal opens its window at import, so only its config constants
+    # and library functions are taken out of the source and run here
+    with open(PLAYERLOCAL, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    ns = {"MUSIC_FOLDER": LIBRARY, "library_index": None}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            try:
+                exec(compile(ast.Module([node], []), PLAYERLOCAL, "exec"), ns)
+            except ImportError:
+                pass
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name) and node.targets[0].id.isupper()
+                and node.targets[0].id != "MUSIC_FOLDER"):
+            keep = node
+        elif isinstance(node, ast.FunctionDef) and node.name in PLAYER_FUNCTIONS:
+            keep = node
+        else:
+            continue
+        try:
+            exec(compile(ast.Module([keep], []), PLAYERLOCAL, "exec"), ns)
+        except Exception:
+            pass  # a constant built from something only the GUI has
+    return ns
+
+def reset_index():
+    # drop Brickify's index so the next scan starts from nothing
+    with Brickify.index_lock:
+        Brickify.begin_write()
+        Brickify.index_db.execute("DELETE FROM tracks")
+        Brickify.index_db.execute("DELETE FROM dirs")
+        Brickify.index_db.commit()
+        Brickify.last_rescan = 0
+
+def wait_for_tagger():
+    # the first scan starts tagging and loudness in the background; let it
+    # finish so it neither slows the other timings nor leaves ?tags half empty
+    started = time.perf_counter()
+    while Brickify.tagger_thread is not None:
+        time.sleep(0.05)
+    return {"seconds": time.perf_counter() - started}
+
+def bench_scan(results, runs):
+    results["scan_playlists_cold"] = timed(lambda: (reset_index(), Brickify.scan_playlists()), 3)
+    results["tag_and_measure"] = wait_for_tagger()
+    results["scan_playlists_warm"] = timed(lambda: Brickify.scan_playlists(), runs)
+    results["scan_playlists_tags"] = timed(lambda: Brickify.scan_playlists(tags=True), runs)
+
+def bench_player(results, runs):
+    player = player_module()
+    folders = player["scan_playlists"]()
+    biggest = os.path.join(LIBRARY, "playlist000")
+    player["library_index"] = None
+    results["player_load_playlist_walk"] = timed(lambda: player["load_playlist"](biggest), runs)
+    results["player_scan_playlists"] = timed(lambda: player["scan_playlists"](), runs)
+    if player["library_index"] is not None:
+        results["player_load_playlist_index"] = timed(lambda: player["load_playlist"](biggest), runs)
+    results["player_playlists"] = {"count": len(folders)}
+
+def bench_api(results, client, runs):
+    def get(url, **headers):
+        resp = client.get(url, headers=headers)
+        resp.get_data()
+        return resp
+    etag = get("/api/playlists").headers["ETag"]
+    results["api_playlists"] = timed(lambda: get("/api/playlists"), runs)
+    results["api_playlists_summary"] = timed(lambda: get("/api/playlists?summary=1"), runs)
+    results["api_playlists_tags"] = timed(lambda: get("/api/playlists?tags=1"), runs)
+    results["api_playlists_304"] = timed(lambda: get("/api/playlists", **{"If-None-Match": etag}), runs)
+
+def bench_stream(results, client, seconds):
+    url = "/music/%s/%s" % (LONG_PLAYLIST, LONG_TRACK)
+    size = os.path.getsize(os.path.join(LIBRARY, LONG_PLAYLIST, LONG_TRACK))
+    rng = random.Random(1)
+    def seek():
+        start = rng.randrange(0, size - SEEK_BYTES)
+        resp = client.get(url, headers={"Range": "bytes=%d-%d" % (start, start + SEEK_BYTES - 1)})
+        return len(resp.get_data())
+    results["music_range"] = throughput(seek, seconds)
+    results["music_full"] = throughput(lambda: len(client.get(url).get_data()), seconds)
+
+def bench_upload(results, client, seconds):
+    payload = os.urandom(UPLOAD_BYTES)
+    count = [0]
+    def upload():
+        count[0] += 1
+        client.post("/upload", content_type="multipart/form-data", data={
+            "playlist": "uploads", "files": (io.BytesIO(payload), "upload%05d.wav" % count[0])})
+        return len(payload)
+    results["upload"] = throughput(upload, seconds)
+
+def bench_art(results, client, runs):
+    names = sorted(d for d in os.listdir(LIBRARY) if d.startswith("playlist"))
+    covers = iter(names * runs)
+    # cold: each playlist's first request makes its thumbnails
+    results["art_thumb_cold"] = timed(lambda: client.get("/art/%s?size=300" % next(covers)).get_data(),
+                                      len(names))
+    results["art_thumb_warm"] = timed(lambda: client.get("/art/%s?size=300" % next(covers)).get_data(), runs)
+    results["art_original"] = timed(lambda: client.get("/art/%s" % next(covers)).get_data(), runs)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def headline(result):
+    # the number to compare and whether bigger is better
+    if "mb_s" in result:
+        return result["mb_s"], True
+    if "p50_ms" in result:
+        return result["p50_ms"], False
+    if "seconds" in result:
+        return result["seconds"] * 1000, False
+    return None, None
+
+def compare(old, new):
+    print("%-28s %12s %12s %8s" % ("", "before", "after", ""))
+    for name, result in new["results"].items():
+        value, higher = headline(result)
+        before = old["results"].get(name)
+        if value is None or before is None:
+            continue
+        was = headline(before)[0]
+        ratio = (was / value if higher else value / was) if was and value else 1.0
+        print("%-28s %12.2f %12.2f %8s" % (name, was, value, "WORSE" if ratio > WORSE else ""))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--playlists", type=int, default=20)
+    parser.add_argument("--tracks", type=int, default=50)
+    parser.add_argument("--formats", default="wav,flac,ogg")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--out")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    try:
+        started = time.perf_counter()
+        library = make_library(LIBRARY, args.playlists, args.tracks, args.formats.split(","))
+        library["generate_s"] = time.perf_counter() - started
+        client = Brickify.app.test_client()
+        results = {}
+        bench_scan(results, args.runs)
+        bench_player(results, args.runs)
+        bench_api(results, client, args.runs)
+        bench_stream(results, client, args.seconds)
+        bench_upload(results, client, args.seconds)
+        bench_art(results, client, args.runs)
+    finally:
+        shutil.rmtree(LIBRARY, ignore_errors=True)
+
+    commit = git_commit()
+    report = {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "machine": platform.machine(),
+              "library": dict(library, formats=args.formats), "results": results}
+    out = args.out or os.path.join(HERE, "results", commit + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+
+    for name, result in results.items():
+        value, higher = headline(result)
+        if value is not None:
+            print("%-28s %10.2f %s" % (name, value, "MB/s" if higher else "ms"))
+    print("wrote", out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
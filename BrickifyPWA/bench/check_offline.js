@@ -0,0 +1,211 @@
+// Offline playback check for static/service-worker.js.
+//
+//   node bench/check_offline.js
+//
+// runs the service worker in a vm with an in-memory Cache API against a stub
+// server that speaks /api/prefetch and /music, prefetches a session, cuts the
+// network and plays the cached tracks back with Range requests; then checks
+// the byte budget, LRU eviction, etag refresh and /m/ urls. exits non-zero on failure
+const assert = require('assert');
+const fs = require('fs');
+const http = require('http');
+const path = require('path');
+const vm = require('vm');
+
+const SW = path.join(__dirname, '..', 'static', 'service-worker.js');
+const KB = 1024;
+
+// ---------------- stub server ----------------
+const tracks = {};  // url -> {body, etag}
+let manifest = [];
+let downloads = 0;
+
+function addTrack(url, size, seed) {
+  const body = Buffer.alloc(size);
+  for (let i = 0; i < size; i++) body[i] = (i * 31 + seed) & 255;
+  tracks[url] = {body, etag: size.toString(16) + '-' + seed.toString(16)};
+}
+
+const server = http.createServer((req, res) => {
+  const url = new URL(req.url, 'http://stub');
+  if (url.pathname === '/api/prefetch') {
+    res.setHeader('Content-Type', 'application/json');
+    return res.end(JSON.stringify({session: url.searchParams.get('session'), tracks: manifest.map(u => ({
+      url: u, size: tracks[u].body.length, etag: tracks[u].etag, sha1: null}))}));
+  }
+  const t = tracks[url.pathname];
+  if (!t) { res.statusCode = 404; return res.end(); }
+  downloads++;
+  res.setHeader('ETag', '"' + t.etag + '"');
+  res.setHeader('Content-Type', 'audio/mpeg');
+  res.setHeader('Content-Length', t.body.length);
+  res.end(t.body);
+});
+
+// ---------------- service worker host ----------------
+class MemoryCache {
+  constructor() { this.entries = new Map(); }
+  key(req) { return new URL(typeof req === 'string' ? req : req.url, base).href; }
+  async match(req) {
+    const e = this.entries.get(this.key(req));
+    return e ? new Response(e.body, {status: e.status, headers: e.headers}) : undefined;
+  }
+  async put(req, res) {
+    const body = Buffer.from(await res.arrayBuffer());
+    this.entries.set(this.key(req), {body, status: res.status, headers: [...res.headers]});
+  }
+  async delete(req) { return this.entries.delete(this.key(req)); }
+  async addAll() {}
+}
+
+let base, online = true, quota = 1e12;
+const stores = new Map();
+const handlers = {};
+const pending = [];
+
+const sandbox = {
+  URL, Request, Response, Headers, Blob, setTimeout, console,
+  navigator: {storage: {estimate: async () => ({quota})}},
+  caches: {
+    async open(name) {
+      if (!stores.has(name)) stores.set(name, new MemoryCache());
+      return stores.get(name);
+    },
+    async match(req) {
+      for (const c of stores.values()) {
+        const r = await c.match(req);
+        if (r) return r;
+      }
+    },
+    async keys() { return [...stores.keys()]; },
+    async delete(name) { return stores.delete(name); },
+  },
+  fetch(req) {
+    if (!online) return Promise.reject(new TypeError('offline'));
+    return fetch(typeof req === 'string' ? new URL(req, base).href : req);
+  },
+};
+sandbox.self = sandbox;
+sandbox.addEventListener = (type, fn) => { handlers[type] = fn; };
+vm.createContext(sandbox);
+vm.runInContext(fs.readFileSync(SW, 'utf8'), sandbox, {filename: SW});
+
+function extendable(extra) {
+  return Object.assign({waitUntil(p) { pending.push(p); }}, extra);
+}
+
+async function settle() {
+  while (pending.length) await pending.shift();
+}
+
+async function prefetch(urls) {
+  manifest = urls;
+  handlers.message(extendable({data: {type: 'prefetch', session: 'stub'}}));
+  await settle();
+}
+
+async function get(url, range) {
+  let response;
+  const headers = range ? {Range: range} : {};
+  handlers.fetch(extendable({request: new Request(new URL(url, base), {headers}),
+    respondWith(p) { response = p; }}));
+  const res = await response;
+  await settle();
+  return res;
+}
+
+async function cached(url) {
+  const res = await get(url).catch(() => null);
+  return !!res;
+}
+
+async function check(name, fn) {
+  await fn();
+  console.log('ok  ', name);
+}
+
+async function main() {
+  await new Promise(ok => server.listen(0, '127.0.0.1', ok));
+  base = 'http://127.0.0.1:' + server.address().port + '/';
+  sandbox.location = new URL(base);
+  addTrack('/music/a/one.mp3', 300 * KB, 1);
+  addTrack('/music/a/two%20(live).mp3', 200 * KB, 2);
+  addTrack('/music/b/three.mp3', 500 * KB, 3);
+  addTrack('/music/b/four.mp3', 350 * KB, 4);
+
+  // quota * STORAGE_SHARE is the budget: 800 KB
+  quota = 1600 * KB;
+
+  await check('prefetch stops at the byte budget', async () => {
+    await prefetch(['/music/a/one.mp3', '/music/a/two%20(live).mp3', '/music/b/three.mp3']);
+    assert.strictEqual(downloads, 2);
+    online = false;
+    assert(await cached('/music/a/one.mp3'));
+    assert(await cached('/music/a/two%20(live).mp3'));
+    assert(!await cached('/music/b/three.mp3'));
+  });
+
+  await check('cached ranges play offline', async () => {
+    const body = tracks['/music/a/one.mp3'].body;
+    let res = await get('/music/a/one.mp3', 'bytes=1000-1999');
+    assert.strictEqual(res.status, 206);
+    assert.strictEqual(res.headers.get('Content-Range'), 'bytes 1000-1999/' + body.length);
+    assert(Buffer.from(await res.arrayBuffer()).equals(body.subarray(1000, 2000)));
+    res = await get('/music/a/one.mp3', 'bytes=-100');
+    assert(Buffer.from(await res.arrayBuffer()).equals(body.subarray(body.length - 100)));
+    res = await get('/music/a/one.mp3', 'bytes=0-');
+    assert.strictEqual(res.status, 206);
+    assert.strictEqual((await res.arrayBuffer()).byteLength, body.length);
+    res = await get('/music/a/one.mp3', 'bytes=999999999-');
+    assert.strictEqual(res.status, 416);
+  });
+
+  await check('page and manifest escaping hit the same entry', async () => {
+    const res = await get('/music/a/two (live).mp3', 'bytes=0-9');
+    assert.strictEqual(res.status, 206);
+  });
+
+  await check('least recently used tracks are evicted first', async () => {
+    online = true;
+    // two was played last, one should go to make room for four
+    await get('/music/a/one.mp3', 'bytes=0-1');
+    await get('/music/a/two%20(live).mp3', 'bytes=0-1');
+    await prefetch(['/music/b/four.mp3']);
+    online = false;
+    assert(await cached('/music/b/four.mp3'));
+    assert(await cached('/music/a/two%20(live).mp3'));
+    assert(!await cached('/music/a/one.mp3'));
+  });
+
+  await check('a changed file is downloaded again', async () => {
+    online = true;
+    const before = downloads;
+    await prefetch(['/music/b/four.mp3']);
+    assert.strictEqual(downloads, before);
+    addTrack('/music/b/four.mp3', 350 * KB, 5);
+    await prefetch(['/music/b/four.mp3']);
+    assert.strictEqual(downloads, before + 1);
+    online = false;
+    const res = await get('/music/b/four.mp3', 'bytes=0-99');
+    assert(Buffer.from(await res.arrayBuffer()).equals(tracks['/music/b/four.mp3'].body.subarray(0, 100)));
+  });
+
+  await check('content-hashed urls are kept and served offline', async () => {
+    online = true;
+    const url = '/m/' + 'ab'.repeat(20);
+    addTrack(url, 100 * KB, 6);
+    await prefetch([url]);
+    online = false;
+    const res = await get(url, 'bytes=10-19');
+    assert.strictEqual(res.status, 206);
+    assert(Buffer.from(await res.arrayBuffer()).equals(tracks[url].body.subarray(10, 20)));
+    assert(!await cached(url + '?size=300'));
+  });
+
+  server.close();
+}
+
+main().catch(e => {
+  console.error(e);
+  process.exit(1);
+});
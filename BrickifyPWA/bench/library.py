@@ -0,0 +1,73 @@
+# Synthetic music library for the benchmarks.
+#
+#   python bench/library.py DEST [--playlists 20] [--tracks 50] [--formats wav,flac,ogg]
+#
+# every playlist is a folder of short real audio files (a few seconds of
+# tone and noise written with soundfile, so tag reading, decoding and
+# loudness all have something to chew on) plus a cover.jpg, and one
+# playlist holds a long WAV for range streaming
+import argparse
+import os
+
+import numpy as np
+import soundfile as sf
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FORMATS = {"wav": ("WAV", "PCM_16"), "flac": ("FLAC", "PCM_16"), "ogg": ("OGG", "VORBIS")}
+SAMPLERATE = 22050
+LONG_PLAYLIST = "long"
+LONG_TRACK = "long.wav"
+
+def tone(rng, seconds):
+    t = np.arange(int(SAMPLERATE * seconds)) / SAMPLERATE
+    freq = rng.uniform(110, 880)
+    mono = 0.3 * np.sin(2 * np.pi * freq * t) + 0.05 * rng.standard_normal(len(t))
+    return np.stack([mono, np.roll(mono, 7)], axis=1).astype("float32")
+
+def write_cover(path, rng):
+    if Image is None:
+        return
+    pixels = rng.integers(0, 256, (600, 600, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(path, "JPEG", quality=85)
+
+def make_library(root, playlists=20, tracks=50, formats=("wav", "flac", "ogg"), seconds=2.0,
+                 long_seconds=120, seed=1):
+    # returns {"playlists", "tracks", "bytes"} of what was written under root
+    rng = np.random.default_rng(seed)
+    count = size = 0
+    for p in range(playlists):
+        folder = os.path.join(root, "playlist%03d" % p)
+        os.makedirs(folder, exist_ok=True)
+        write_cover(os.path.join(folder, "cover.jpg"), rng)
+        for t in range(tracks):
+            ext = formats[(p * tracks + t) % len(formats)]
+            path = os.path.join(folder, "%02d track %04d.%s" % (t % 100, t, ext))
+            fmt, subtype = FORMATS[ext]
+            sf.write(path, tone(rng, seconds), SAMPLERATE, format=fmt, subtype=subtype)
+            count += 1
+            size += os.path.getsize(path)
+    folder = os.path.join(root, LONG_PLAYLIST)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, LONG_TRACK)
+    with sf.SoundFile(path, "w", SAMPLERATE, 2, "PCM_16") as f:
+        for _ in range(int(long_seconds)):
+            f.write(tone(rng, 1.0))
+    return {"playlists": playlists + 1, "tracks": count + 1, "bytes": size + os.path.getsize(path)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dest")
+    parser.add_argument("--playlists", type=int, default=20)
+    parser.add_argument("--tracks", type=int, default=50)
+    parser.add_argument("--formats", default="wav,flac,ogg")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    info = make_library(args.dest, args.playlists, args.tracks, args.formats.split(","), args.seconds)
+    print("%(playlists)d playlists, %(tracks)d tracks, %(bytes)d bytes" % info)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-const cacheName = 'brickify-cache-v1';
+const cacheName = 'brickify-cache-v3';
 const assets = [
   '/',
   '/static/icon-192.png',
@@ -6,25 +6,64 @@ const assets = [
   // Add any other static files you want cached
 ];
 
+// audio and covers live in their own cache under a byte budget. the page
+// asks us to fill it ahead of playback from /api/prefetch (the session's
+// current and next few tracks), least recently used entries go first, and
+// cached tracks answer Range requests locally so seeking works offline.
+// /m/<sha1> urls name their content, so they are never fetched twice
+const mediaCache = 'brickify-media-v1';
+const MEDIA_BUDGET = 512 * 1024 * 1024;  // bytes at most...
+const STORAGE_SHARE = 0.5;               // ...and never more than this share of our quota
+const INDEX_URL = '/__brickify/media-index';
+const INDEX_SAVE_MS = 1000;
+
+let media = null;       // cache key -> {size, used, etag, sha1}
+let pinned = new Set(); // keys in the latest manifest, never evicted for each other
+let saving = null;
+let prefetching = Promise.resolve();
+
 self.addEventListener('install', e => {
   e.waitUntil(
     caches.open(cacheName).then(cache => cache.addAll(assets))
   );
 });
 
+self.addEventListener('activate', e => {
+  // v1 kept every track it ever saw, drop it
+  e.waitUntil(caches.keys().then(keys => Promise.all(
+    keys.filter(k => k !== cacheName && k !== mediaCache).map(k => caches.delete(k)))));
+});
+
+self.addEventListener('message', e => {
+  if (e.data && e.data.type === 'prefetch') {
+    const session = e.data.session;
+    prefetching = prefetching.then(() => prefetch(session)).catch(() => {});
+    e.waitUntil(prefetching);
+  }
+});
+
 self.addEventListener('fetch', e => {
   const url = new URL(e.request.url);
 
-  // If the request is for music or art, try network first, then cache
-  if (url.pathname.startsWith('/music/') || url.pathname.startsWith('/art/')) {
+  if (url.pathname.startsWith('/music/') || url.pathname.startsWith('/m/')) {
+    // transcoded variants (?format=) aren't worth keeping, /m/ covers come ?size=
+    if (url.pathname.startsWith('/m/') ? url.searchParams.has('format') : url.search) return;
+    e.respondWith(
+      fromCache(e.request).then(res => res || fetch(e.request).then(res => {
+        // a plain 200 is the whole file; 206s are only pieces and never stored
+        if (res.status === 200) e.waitUntil(store(mediaKey(url), res.clone(), {}).catch(() => {}));
+        return res;
+      }))
+    );
+  } else if (url.pathname.startsWith('/art/')) {
+    // network first so a new cover shows up, cache when offline
     e.respondWith(
       fetch(e.request)
         .then(res => {
-          const resClone = res.clone();
-          caches.open(cacheName).then(cache => cache.put(e.request, resClone));
+          if (res.status === 200) e.waitUntil(store(mediaKey(url), res.clone(), {}).catch(() => {}));
           return res;
         })
-        .catch(() => caches.match(e.request))
+        .catch(() => fromCache(e.request).then(res => res || Response.error()))
     );
   } else {
     // For other requests, cache first, then network
@@ -33,3 +72,120 @@ self.addEventListener('fetch', e => {
     );
   }
 });
+
+// the page and the manifest escape paths differently, so compare them decoded
+function mediaKey(url) {
+  const path = decodeURIComponent(url.pathname) + (url.pathname.startsWith('/music/') ? '' : url.search);
+  return '/__brickify/media?' + encodeURIComponent(path);
+}
+
+async function loadIndex() {
+  if (!media) {
+    const res = await (await caches.open(mediaCache)).match(INDEX_URL);
+    media = res ? await res.json() : {};
+  }
+  return media;
+}
+
+function saveIndex() {
+  // a burst of touches ends up as one write
+  if (!saving) {
+    saving = new Promise(ok => setTimeout(ok, INDEX_SAVE_MS)).then(async () => {
+      saving = null;
+      const cache = await caches.open(mediaCache);
+      await cache.put(INDEX_URL, new Response(JSON.stringify(media),
+        {headers: {'Content-Type': 'application/json'}}));
+    });
+  }
+  return saving;
+}
+
+async function budget() {
+  let limit = MEDIA_BUDGET;
+  if (self.navigator && navigator.storage && navigator.storage.estimate) {
+    const {quota} = await navigator.storage.estimate();
+    if (quota) limit = Math.min(limit, quota * STORAGE_SHARE);
+  }
+  return limit;
+}
+
+// room for `size` more bytes, not counting what `replacing` holds now
+async function makeRoom(size, replacing) {
+  const limit = await budget();
+  if (size > limit) return false;
+  const cache = await caches.open(mediaCache);
+  let total = Object.keys(media).reduce((sum, k) => k === replacing ? sum : sum + media[k].size, 0);
+  const victims = Object.keys(media).filter(k => k !== replacing && !pinned.has(k))
+    .sort((a, b) => media[a].used - media[b].used);
+  while (total + size > limit && victims.length) {
+    const key = victims.shift();
+    total -= media[key].size;
+    delete media[key];
+    await cache.delete(key);
+  }
+  return total + size <= limit;
+}
+
+async function store(key, res, meta) {
+  await loadIndex();
+  const size = meta.size || +res.headers.get('Content-Length');
+  if (!size || !await makeRoom(size, key)) return false;
+  await (await caches.open(mediaCache)).put(key, res);
+  media[key] = {size, used: Date.now(), sha1: meta.sha1 || null,
+    etag: meta.etag || (res.headers.get('ETag') || '').replace(/^W\//, '').replace(/"/g, '')};
+  saveIndex();
+  return true;
+}
+
+async function fromCache(request) {
+  const key = mediaKey(new URL(request.url));
+  const res = await (await caches.open(mediaCache)).match(key);
+  if (!res) return null;
+  await loadIndex();
+  if (media[key]) {
+    media[key].used = Date.now();
+    saveIndex();
+  }
+  const range = /^bytes=(\d*)-(\d*)$/.exec((request.headers.get('Range') || '').trim());
+  if (!range || (range[1] === '' && range[2] === '')) return res;
+  const blob = await res.blob();
+  const size = blob.size;
+  let start, end;
+  if (range[1] === '') {
+    start = Math.max(0, size - +range[2]);
+    end = size - 1;
+  } else {
+    start = +range[1];
+    end = range[2] === '' ? size - 1 : Math.min(+range[2], size - 1);
+  }
+  if (start > end) {
+    return new Response(null, {status: 416, headers: {'Content-Range': `bytes */${size}`}});
+  }
+  return new Response(blob.slice(start, end + 1), {status: 206, headers: {
+    'Content-Type': res.headers.get('Content-Type') || 'application/octet-stream',
+    'Content-Range': `bytes ${start}-${end}/${size}`,
+    'Content-Length': String(end - start + 1),
+    'Accept-Ranges': 'bytes'}});
+}
+
+async function prefetch(session) {
+  const manifest = await fetch('/api/prefetch?session=' + encodeURIComponent(session))
+    .then(r => r.ok ? r.json() : null).catch(() => null);
+  if (!manifest) return;
+  await loadIndex();
+  const cache = await caches.open(mediaCache);
+  const tracks = manifest.tracks.map(t => Object.assign({key: mediaKey(new URL(t.url, self.location))}, t));
+  pinned = new Set(tracks.map(t => t.key));
+  for (const t of tracks) {
+    const have = media[t.key];
+    if (have && have.etag === t.etag) continue;
+    // the budget can't take the rest of the manifest either, it's in play order
+    if (!await makeRoom(t.size, t.key)) break;
+    // the same bytes under another name (one file in two playlists)
+    const twin = t.sha1 && Object.keys(media).find(k => media[k].sha1 === t.sha1);
+    let res = twin ? await cache.match(twin) : null;
+    if (!res) res = await fetch(t.url).catch(() => null);
+    if (!res || res.status !== 200) continue;
+    await store(t.key, res, t);
+  }
+}